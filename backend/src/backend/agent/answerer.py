@@ -2,7 +2,7 @@ import json
 import os
 from bson import ObjectId
 from openai import AsyncOpenAI
-from datetime import datetime
+from datetime import datetime, timezone
 from collections import defaultdict
 
 
@@ -24,6 +24,14 @@ def _system_prompt(user_locale: str) -> str:
             "Utilise du code pour les cas connus et LLM uniquement pour le reste."
         )
 
+def _freshness(tool_result: dict, user_locale: str) -> str:
+    """Mention « données au … » quand le résultat vient du rollup."""
+    as_of = tool_result.get("as_of")
+    if not isinstance(as_of, datetime):
+        return ""
+    stamp = as_of.strftime("%d/%m %H:%M UTC")
+    return f" _(as of {stamp})_" if user_locale.lower().startswith("en") else f" _(données au {stamp})_"
+
 async def answer(
     user_locale: str,
     tool_result: dict,
@@ -40,6 +48,12 @@ async def answer(
     • 'items'    → vue de connectivité.
     • 'counts'   → résumé état batterie.
     • 'category' → liste des adresses d’une même catégorie batterie.
+    • 'fleet'    → totaux connectivité / batteries multi-entreprises.
+    • 'topology_query' → analyses de graphe (chemins, relais critiques…).
+    • 'reparented'     → changements de topologie (delta depuis X heures).
+    • 'transmitters'   → transmetteurs avec le plus de MP.
+    • 'anomalies'      → taux d’erreur anormaux vs baseline p₀.
+    • 'suspects'       → tasks suspectes selon le modèle ML.
     • sinon      → fallback LLM.
     """
 
@@ -107,6 +121,62 @@ async def answer(
         label = "Available fields: " if user_locale.lower().startswith("en") else "Champs disponibles : "
         return label + ", ".join(tool_result["fields"])
     
+    # ------------------------------------------------------------------ #
+    # Transmetteurs les plus chargés (top_transmitters)                  #
+    # ------------------------------------------------------------------ #
+    if "transmitters" in tool_result:
+        rows = tool_result["transmitters"]
+        is_en = user_locale.lower().startswith("en")
+        if not rows:
+            return "No transmitter found." if is_en else "Aucun transmetteur trouvé."
+        head = "**Transmitters with most MPs**" if is_en else "**Transmetteurs avec le plus de MP**"
+        return "\n".join([head] + [
+            f"- {r['name'] or r['transmitter']} : {r['totalMP']} MP" for r in rows
+        ])
+
+    # ------------------------------------------------------------------ #
+    # Taux d’erreur anormaux (error_rate_anomalies)                      #
+    # ------------------------------------------------------------------ #
+    if "anomalies" in tool_result:
+        rows  = tool_result["anomalies"]
+        hours = tool_result.get("hours", 24)
+        is_en = user_locale.lower().startswith("en")
+        if not rows:
+            return (f"No abnormal error rate over the last {hours} h."
+                    if is_en else f"Aucun taux d’erreur anormal sur les {hours} dernières heures.")
+        head = (f"**Abnormal error rates (last {hours} h)**" if is_en
+                else f"**Taux d’erreur anormaux ({hours} dernières heures)**")
+        usual = "usual" if is_en else "habituel"
+        return "\n".join([head] + [
+            f"- {r.get('name') or r['asset_id']} : {r['errors']}/{r['runs']} "
+            f"({r['rate']:.0%}, {usual} {r['p0']:.1%}, p = {r['p_value']:.1e})"
+            for r in rows
+        ])
+
+    # ------------------------------------------------------------------ #
+    # Tasks suspectes selon le modèle ML (misconfig_ml_overview)         #
+    # ------------------------------------------------------------------ #
+    if "suspects" in tool_result:
+        per   = tool_result.get("companies", {})
+        is_en = user_locale.lower().startswith("en")
+        scored = sum(c["scored"] for c in per.values())
+        flagged = sum(c["anomalies"] for c in per.values())
+        if is_en:
+            lines = [f"**ML scoring** : {flagged} suspicious tasks out of {scored} scored "
+                     f"({len(per)} database(s))."]
+        else:
+            lines = [f"**Scoring ML** : {flagged} tasks suspectes sur {scored} scorées "
+                     f"({len(per)} base(s))."]
+        lines += [
+            f"- {s['company']} · task {s['task']} : score {s['anomaly_score']:.3f}, "
+            f"{s['err_freq_20runs']}/20 err."
+            for s in tool_result["suspects"][:10]
+        ]
+        if tool_result.get("errors"):
+            failed = ", ".join(sorted(tool_result["errors"]))
+            lines.append(f"_Failed: {failed}_" if is_en else f"_En échec : {failed}_")
+        return "\n".join(lines)
+
     # ------------------------------------------------------------------ #
     # Résumé misconfig si counts présent, même si documents = []
     # ------------------------------------------------------------------ #
@@ -203,10 +273,11 @@ async def answer(
         conn = tool_result["connected_count"]
         disc = tool_result["disconnected_count"]
 
+        fresh = _freshness(tool_result, user_locale)
         if user_locale.lower().startswith("en"):
-            return f"**{disc} offline sensors**, {conn} connected."
+            return f"**{disc} offline sensors**, {conn} connected.{fresh}"
         else:
-            return f"Il y a {disc} capteurs hors ligne, et {conn} connectés. \n Voici la liste : \n"
+            return f"Il y a {disc} capteurs hors ligne, et {conn} connectés.{fresh} \n Voici la liste : \n"
 
 
     # ------------------------------------------------------------------ #
@@ -216,14 +287,14 @@ async def answer(
         cnt = tool_result["counts"]
         if user_locale.lower().startswith("en"):
             lines = [
-                "**Battery Status**",
+                "**Battery Status**" + _freshness(tool_result, user_locale),
                 f"🔴 Critical : {cnt['critical']}",
                 f"🟠 Warning  : {cnt['warning']}",
                 f"✅ OK       : {cnt['ok']}"
             ]
         else:
             lines = [
-                "**État des batteries**",
+                "**État des batteries**" + _freshness(tool_result, user_locale),
                 f"🔴 Critique : {cnt['critical']}",
                 f"🟠 Alerte   : {cnt['warning']}",
                 f"✅ OK       : {cnt['ok']}"
@@ -244,6 +315,96 @@ async def answer(
         items = [f"- {addr}" for addr in addrs]
         return "\n".join([header] + items)
     # ------------------------------------------------------------------ #
+    # 6 bis. Vues flotte (connectivité / batteries multi-entreprises)    #
+    # ------------------------------------------------------------------ #
+    if {"fleet", "per_company", "totals"} <= tool_result.keys():
+        tot  = tool_result["totals"]
+        errs = tool_result.get("errors") or {}
+        is_en = user_locale.lower().startswith("en")
+        n = len(tool_result["per_company"])
+
+        if tool_result["fleet"] == "battery":
+            lines = [
+                f"**Battery status – {n} companies**" if is_en
+                else f"**État des batteries – {n} entreprises**",
+                f"🔴 {'Critical' if is_en else 'Critique'} : {tot['critical']}",
+                f"🟠 {'Warning ' if is_en else 'Alerte  '} : {tot['warning']}",
+                f"✅ OK       : {tot['ok']}",
+            ]
+        else:
+            lines = [
+                f"**Connectivity – {n} companies**" if is_en
+                else f"**Connectivité – {n} entreprises**",
+                f"{tot['disconnected_count']} offline sensors, {tot['connected_count']} connected."
+                if is_en else
+                f"{tot['disconnected_count']} capteurs hors ligne, {tot['connected_count']} connectés.",
+            ]
+        if errs:
+            lines.append(
+                ("Unavailable: " if is_en else "Indisponibles : ") + ", ".join(sorted(errs))
+            )
+        return "\n".join(lines)
+
+    # ------------------------------------------------------------------ #
+    # 6 ter. Analyses de graphe (topology_analysis)                      #
+    # ------------------------------------------------------------------ #
+    if "topology_query" in tool_result:
+        q, res = tool_result["topology_query"], tool_result["result"]
+        is_en = user_locale.lower().startswith("en")
+
+        if q == "path_to_gateway":
+            if res["gateway"] is None:
+                return (f"{res['address']} has no path to any gateway." if is_en
+                        else f"{res['address']} n’a aucun chemin vers une gateway.")
+            path = " → ".join(res["path"])
+            return (f"{res['address']} reaches gateway {res['gateway']} in {res['hops']} hops: {path}"
+                    if is_en else
+                    f"{res['address']} atteint la gateway {res['gateway']} en {res['hops']} sauts : {path}")
+        if q == "removal_impact":
+            n = res["isolated_count"]
+            return (f"If {res['address']} goes down, {n} sensors lose every gateway." if is_en
+                    else f"Si {res['address']} tombe, {n} capteurs n’ont plus aucune gateway.")
+        if q == "articulation_points":
+            if not res:
+                return ("No single point of failure." if is_en
+                        else "Aucun relais critique : aucune panne isolée ne coupe de capteur.")
+            top = ", ".join(f"{r['address']} ({r['isolated_sensors']})" for r in res[:5])
+            return (f"{len(res)} critical relays. Most critical: {top}" if is_en
+                    else f"{len(res)} relais critiques. Les plus critiques : {top}")
+        if q == "orphaned_sensors":
+            return (f"{len(res)} sensors have no path to a gateway." if is_en
+                    else f"{len(res)} capteurs n’ont aucun chemin vers une gateway.")
+        if q == "gateway_subtrees":
+            lines = [f"- {r['gateway']} : {r['sensors']} "
+                     + ("sensors" if is_en else "capteurs")
+                     + f", {r['extenders']} extenders" for r in res]
+            return "\n".join([("**Sensors per gateway**" if is_en else "**Capteurs par gateway**")] + lines)
+
+    # ------------------------------------------------------------------ #
+    # 6 quater. Changements de topologie (topology_changes)              #
+    # ------------------------------------------------------------------ #
+    if "reparented" in tool_result and "nodes_added" in tool_result:
+        is_en = user_locale.lower().startswith("en")
+        since = datetime.fromtimestamp(tool_result.get("covered_from", 0), timezone.utc)
+        added, removed = tool_result["nodes_added"], tool_result["nodes_removed"]
+        moved, quality = tool_result["reparented"], tool_result["link_quality"]
+        degraded = [q for q in quality if (q["from"], q["to"]) in
+                    {("good", "medium"), ("good", "poor"), ("medium", "poor")}]
+
+        if is_en:
+            lines = [f"**Network changes since {since:%d/%m %H:%M} UTC**",
+                     f"Nodes added : {len(added)}", f"Nodes removed : {len(removed)}",
+                     f"Re-parented : {len(moved)}",
+                     f"Link quality changes : {len(quality)} ({len(degraded)} degraded)"]
+        else:
+            lines = [f"**Changements réseau depuis le {since:%d/%m %H:%M} UTC**",
+                     f"Nœuds apparus : {len(added)}", f"Nœuds disparus : {len(removed)}",
+                     f"Changements de parent : {len(moved)}",
+                     f"Qualité de lien modifiée : {len(quality)} ({len(degraded)} dégradés)"]
+        lines += [f"- {m['id']} : {m['from'] or '∅'} → {m['to'] or '∅'}" for m in moved[:10]]
+        return "\n".join(lines)
+
+    # ------------------------------------------------------------------ #
     # 7. Network topology                                                #
     # ------------------------------------------------------------------ #
     if "topology" in tool_result:
@@ -254,6 +415,8 @@ async def answer(
             gws   = sum(1 for n in nodes if n.get("type") == "gateway")
             ext   = sum(1 for n in nodes if n.get("type") == "extender")
             sens  = sum(1 for n in nodes if n.get("type") == "sensor")
+            # vue LOD : capteurs regroupés dans les nœuds `cluster`
+            sens += sum(n.get("count", 0) for n in nodes if n.get("type") == "cluster")
         else:
             gws  = len(topo)
             ext  = sum(len(g.get("extenders", [])) for g in topo)
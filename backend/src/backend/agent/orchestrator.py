@@ -6,16 +6,29 @@ import json
 from dotenv import load_dotenv
 from typing import Any, Dict, Optional
 
-from cachetools import TTLCache, cached
+from backend.utils.cache import ByteBudgetCache
 
 from backend.tools import sensor_tools as st
-from backend.tools.sensor_tools import battery_overview, battery_list
+from backend.tools.sensor_tools import (
+    battery_overview, battery_list, fleet_battery_overview, fleet_connectivity_overview,
+)
 from backend.tools.topology import get_network_topology, topology_to_d3
-from backend.tools.dynamic_projection import build_dynamic_projection, build_dynamic_projection_multi
-from backend.tools.misconfiguration import detect_misconfig
+from backend.tools.topology_lod import get_topology_view
+from backend.tools.topology_engine import topology_changes
+from backend.tools.topology_graph import analyze_topology
+from backend.tools.dynamic_projection import (
+    PAGE_SIZE as DYN_PAGE_SIZE, build_dynamic_projection, build_dynamic_projection_multi,
+)
+from backend.tools.misconfiguration import detect_misconfig, scan_misconfig
+from backend.tools.transmitter_totals import top_transmitters
+from backend.tools.error_rate_anomalies import error_rate_anomalies
+from backend.tools.misconfiguration_ml import scan_misconfig_ml
 from backend.rag.vector_store import query_sensors
 from backend.agent import planner, answerer
-from backend.db import list_companies, find_company_candidates, execute_db_query, describe_schema, execute_cross_db_query, sample_fields, get_asset_by_id
+from backend.db import (
+    run_db, alist_companies, afind_company_candidates, aexecute_db_query,
+    adescribe_schema, aexecute_cross_db_query, aget_asset_by_id,
+)
 from backend.utils.slugify_company import slugify_company
 from backend.utils.serialize import serialize_docs, extract_columns, clean_jsonable
 #from backend.search.run_query import run_query
@@ -27,15 +40,16 @@ from backend.agent.state import PENDING, CONVERSATIONS
 load_dotenv()
 BATTERY_CRITICAL_DEFAULT = int(os.getenv("BATTERY_CRITICAL", "3200"))
 BATTERY_WARNING_DEFAULT  = int(os.getenv("BATTERY_WARNING", "3500"))
+TOPO_LOD_THRESHOLD       = int(os.getenv("TOPO_LOD_THRESHOLD", "2000"))   # nœuds
 
 # ---------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------
-def resolve_company(raw: str) -> Optional[str]:
+async def resolve_company(raw: str) -> Optional[str]:
     """Essaie de faire correspondre le texte libre à un nom complet d’entreprise."""
-    cands = find_company_candidates(raw)
+    cands = await afind_company_candidates(raw)
     if not cands:
-        for comp in list_companies():
+        for comp in await alist_companies():
             if slugify_company(comp).endswith(raw.lower()):
                 return comp
         return None
@@ -44,11 +58,15 @@ def resolve_company(raw: str) -> Optional[str]:
 # ---------------------------------------------------------------------
 # Cache 1 minute pour l’overview
 # ---------------------------------------------------------------------
-_overview_cache = TTLCache(maxsize=100, ttl=60)
+_overview_cache = ByteBudgetCache("connectivity_overview", ttl=60,
+                                  maxsize=int(os.getenv("OVERVIEW_CACHE_BYTES", str(16 * 1024 * 1024))))
 
-@cached(_overview_cache)
 def cached_overview(company: str) -> Dict[str, Any]:
-    return st.connectivity_overview(company)
+    res = _overview_cache.lookup(company)
+    if res is None:
+        res = st.connectivity_overview(company)
+        _overview_cache.store(company, res)
+    return res
 
 # ---------------------------------------------------------------------
 # Orchestrateur principal
@@ -70,13 +88,13 @@ async def handle_query(
     pending = PENDING.get(session_id)
     if pending and pending["func_name"] == "connectivity_overview":
         raw = text.strip()
-        cands = find_company_candidates(raw)
+        cands = await afind_company_candidates(raw)
         print(f"[DEBUG] pending branch – find_company_candidates('{raw}') → {cands}", flush=True)
 
         # 1a) Un seul candidat → on exécute
         if len(cands) == 1:
             matched = cands[0]
-            data = cached_overview(company=matched)
+            data = await run_db(cached_overview, company=matched)
             del PENDING[session_id]
             return {
                 "session_id": session_id,
@@ -125,7 +143,7 @@ async def handle_query(
         # -----------------------------------------------------------------
         if func_name == "connectivity_overview":
             raw     = func_args.get("company", "").strip()
-            matched = resolve_company(raw)
+            matched = await resolve_company(raw)
             if not matched:
                 PENDING[session_id] = {
                     "func_name": func_name,
@@ -136,7 +154,7 @@ async def handle_query(
                     "clarify": {
                         "field": "company",
                         "raw": raw,
-                        "candidates": find_company_candidates(raw)
+                        "candidates": await afind_company_candidates(raw)
                     }
                 }
                 return {
@@ -145,7 +163,7 @@ async def handle_query(
                 }
 
             # ── appel du helper corrigé ───────────────────────────────────────
-            data = cached_overview(company=matched)          # contient items + *_count
+            data = await run_db(cached_overview, company=matched)   # contient items + *_count
 
             # ── normalisation des items ───────────────────────────────────────
             items = []
@@ -162,7 +180,8 @@ async def handle_query(
                 {
                     "items": docs,
                     "connected_count":    data["connected_count"],
-                    "disconnected_count": data["disconnected_count"]
+                    "disconnected_count": data["disconnected_count"],
+                    "as_of":              data.get("as_of")
                 },
                 text
             )
@@ -204,7 +223,7 @@ async def handle_query(
         # -----------------------------------------------------------------
         elif func_name == "rag_search":
             qry = func_args.get("query", "")
-            snippets = query_sensors(qry, k=3)
+            snippets = await run_db(query_sensors, qry, k=3)
             return {
                 "session_id": session_id,
                 "answer": await answerer.answer(locale, {"snippets": snippets}, text),
@@ -216,14 +235,14 @@ async def handle_query(
         # -----------------------------------------------------------------
         elif func_name == "battery_overview":
             comp_raw = func_args.get("company", "").strip()
-            comp = resolve_company(comp_raw)
+            comp = await resolve_company(comp_raw)
             if not comp:
                 return {"session_id": session_id,
                         "answer": f"Je ne reconnais pas l’entreprise « {comp_raw} »."}
 
             crit = int(func_args.get("critical_threshold", BATTERY_CRITICAL_DEFAULT))
             warn = int(func_args.get("warning_threshold", BATTERY_WARNING_DEFAULT))
-            data = battery_overview(comp, crit, warn)
+            data = await run_db(battery_overview, comp, crit, warn)
             return {
                 "session_id": session_id,
                 "answer": await answerer.answer(locale, data, text),
@@ -235,14 +254,14 @@ async def handle_query(
         # -----------------------------------------------------------------
         elif func_name == "battery_list":
             comp_raw = func_args.get("company", "").strip()
-            comp = resolve_company(comp_raw)
+            comp = await resolve_company(comp_raw)
             if not comp:
                 return {"session_id": session_id,
                         "answer": f"Je ne reconnais pas l’entreprise « {comp_raw} »."}
 
             crit = int(func_args.get("critical_threshold", BATTERY_CRITICAL_DEFAULT))
             warn = int(func_args.get("warning_threshold", BATTERY_WARNING_DEFAULT))
-            tool_result = battery_list(comp, func_args.get("category"), crit, warn)
+            tool_result = await run_db(battery_list, comp, func_args.get("category"), crit, warn)
             cat  = tool_result.get("category")
             addrs = tool_result.get("addresses", [])
             header = (
@@ -257,12 +276,44 @@ async def handle_query(
                 "duration_ms": int((time.time() - start) * 1000)
             }
 
+        # -----------------------------------------------------------------
+        # fleet_connectivity_overview / fleet_battery_overview
+        # -----------------------------------------------------------------
+        elif func_name in {"fleet_connectivity_overview", "fleet_battery_overview"}:
+            raw_ids = func_args.get("client_ids") or []
+            comps   = [await resolve_company(raw) or raw for raw in raw_ids] or None
+            top_n   = int(func_args.get("top_n", 10))
+
+            if func_name == "fleet_connectivity_overview":
+                data = await run_db(fleet_connectivity_overview, comps, top_n=top_n, heavy=True)
+                rows = [
+                    {"_company": r["company"],
+                     "connected":    r["connected_count"],
+                     "disconnected": r["disconnected_count"],
+                     "total":        r["total"]}
+                    for r in data["per_company"]
+                ]
+            else:
+                crit = int(func_args.get("critical_threshold", BATTERY_CRITICAL_DEFAULT))
+                warn = int(func_args.get("warning_threshold", BATTERY_WARNING_DEFAULT))
+                data = await run_db(fleet_battery_overview, crit, warn, comps, top_n=top_n, heavy=True)
+                rows = [{"_company": r["company"], **r["counts"]} for r in data["per_company"]]
+
+            return clean_jsonable({
+                "session_id":  session_id,
+                "answer":      await answerer.answer(locale, data, text),
+                "documents":   rows,
+                "columns":     extract_columns(rows),
+                "fleet":       data,
+                "duration_ms": int((time.time() - start) * 1000)
+            })
+
         # -----------------------------------------------------------------
         # describe_schema
         # -----------------------------------------------------------------
         elif func_name == "describe_schema":
             args = func_args
-            fields = describe_schema(
+            fields = await adescribe_schema(
                 client_id=args["client_id"],
                 collection=args["collection"]
             )
@@ -278,14 +329,14 @@ async def handle_query(
             # ───────────────────────────────────────────────────────────────
             # 1) Résolution du client
             # ───────────────────────────────────────────────────────────────
-            probe = find_company_candidates(raw_text)     # cherche un nom dans la question
+            probe = await afind_company_candidates(raw_text)   # cherche un nom dans la question
             if probe:                                     # ≥ 1 candidat trouvé
                 client_id = probe[0]
                 if client_id != args["client_id"]:
                     print(f"[ORCH] override client_id '{args['client_id']}' -> '{client_id}'",
                           flush=True)
             else:                                         # fallback : tentative de correction
-                client_id = resolve_company(args["client_id"]) or args["client_id"]
+                client_id = await resolve_company(args["client_id"]) or args["client_id"]
 
             # ───────────────────────────────────────────────────────────────
             # 2) Correction automatique du node_type selon le wording
@@ -309,21 +360,25 @@ async def handle_query(
             # ───────────────────────────────────────────────────────────────
             if args["collection"] != "network_nodes" and not args.get("projection"):
                 print(f"[ORCH] → dynamic aggregation pour {client_id}.{args['collection']}")
-                # build_dynamic_projection renvoie directement la liste de docs
-                raw_docs = await build_dynamic_projection(
+                # build_dynamic_projection renvoie la 1re page + next_cursor
+                page = await build_dynamic_projection(
                     client_id=client_id,
                     collection=args["collection"],
                     user_query=raw_text,
-                    match_filter=args.get("filter") or {}
+                    match_filter=args.get("filter") or {},
+                    page_size=DYN_PAGE_SIZE,
+                    limit=int(args["limit"]) if args.get("limit") else None
                 )
+                raw_docs, next_cursor = page["documents"], page["next_cursor"]
             else:
+                next_cursor = None
                 # fallback sur un find classique si pas de dynamic
                 # assure la projection / filter existants
                 proj = args.get("projection") or {}
                 for k in (args.get("filter") or {}):
                     if not k.startswith("$") and k not in proj:
                         proj[k] = 1
-                raw_docs = execute_db_query(
+                raw_docs = await aexecute_db_query(
                     client_id  = client_id,
                     collection = args["collection"],
                     filter     = args.get("filter"),
@@ -346,6 +401,7 @@ async def handle_query(
                 "answer":      answer_txt,
                 "documents":   docs,
                 "columns":     cols,
+                "next_cursor": next_cursor,
                 "duration_ms": int((time.time() - start) * 1000)
             }
         # -----------------------------------------------------------------
@@ -353,14 +409,17 @@ async def handle_query(
         # -----------------------------------------------------------------
         elif func_name == "network_topology":
             raw = func_args.get("company", "").strip()
-            comp = resolve_company(raw)
+            comp = await resolve_company(raw)
             if not comp:
                 return {
                     "session_id": session_id,
                     "answer": f"Je ne reconnais pas l’entreprise « {raw} »."
                 }
 
-            topo_json = get_network_topology(comp)
+            topo_json = await run_db(get_network_topology, comp, heavy=True)
+            if len(topo_json["nodes"]) > TOPO_LOD_THRESHOLD:
+                # grand réseau : capteurs regroupés par gateway / extender
+                topo_json = await run_db(get_topology_view, comp, "cluster", heavy=True)
             d3_data   = topology_to_d3(topo_json)   # format {nodes, links}
 
             return {
@@ -377,6 +436,72 @@ async def handle_query(
                 "duration_ms": int((time.time() - start) * 1000)
             }
 
+        # -----------------------------------------------------------------
+        # topology_analysis (graphe compact)
+        # -----------------------------------------------------------------
+        elif func_name == "topology_analysis":
+            raw = func_args.get("company", "").strip()
+            comp = await resolve_company(raw)
+            if not comp:
+                return {
+                    "session_id": session_id,
+                    "answer": f"Je ne reconnais pas l’entreprise « {raw} »."
+                }
+
+            try:
+                data = await run_db(
+                    analyze_topology, comp, func_args.get("query", ""),
+                    func_args.get("address"), heavy=True
+                )
+            except (KeyError, ValueError) as exc:
+                return {"session_id": session_id, "answer": f"⚠️ {exc}"}
+
+            result = data["result"]
+            rows = result if isinstance(result, list) else [result]
+            rows = [r if isinstance(r, dict) else {"address": r} for r in rows]
+            docs = serialize_docs(rows)
+
+            return {
+                "session_id": session_id,
+                "answer":     await answerer.answer(locale, data, text),
+                "company":    comp,
+                "documents":  docs,
+                "columns":    extract_columns(docs),
+                "duration_ms": int((time.time() - start) * 1000)
+            }
+
+        # -----------------------------------------------------------------
+        # topology_changes (delta du graphe)
+        # -----------------------------------------------------------------
+        elif func_name == "topology_changes":
+            raw = func_args.get("company", "").strip()
+            comp = await resolve_company(raw)
+            if not comp:
+                return {
+                    "session_id": session_id,
+                    "answer": f"Je ne reconnais pas l’entreprise « {raw} »."
+                }
+
+            hours = float(func_args.get("hours") or 24)
+            data = await run_db(topology_changes, comp, hours=hours, heavy=True)
+
+            rows = (
+                [{"change": "added", **r} for r in data["nodes_added"]]
+                + [{"change": "removed", **r} for r in data["nodes_removed"]]
+                + [{"change": "reparented", **r} for r in data["reparented"]]
+                + [{"change": "link_quality", **r} for r in data["link_quality"]]
+            )
+            docs = serialize_docs(rows)
+
+            return {
+                "session_id": session_id,
+                "answer":     await answerer.answer(locale, data, text),
+                "company":    comp,
+                "documents":  docs,
+                "columns":    extract_columns(docs),
+                "duration_ms": int((time.time() - start) * 1000)
+            }
+
         # -----------------------------------------------------------------
         # execute_cross_db_query
         # -----------------------------------------------------------------
@@ -398,10 +523,10 @@ async def handle_query(
 
             # 1) Déterminer la liste des clients à interroger
             if not raw_ids:
-                clients = list_companies()
+                clients = await alist_companies()
                 print(f"[DEBUG][orchestrator] No client_ids provided, defaulting to all companies: {clients}", flush=True)
             else:
-                clients = [resolve_company(raw) or raw for raw in raw_ids]
+                clients = [await resolve_company(raw) or raw for raw in raw_ids]
                 print(f"[DEBUG][orchestrator] Resolved client_ids to actual DB names: {clients}", flush=True)
 
             # Trier alphabétiquement
@@ -412,21 +537,26 @@ async def handle_query(
             if args["collection"] != "network_nodes" and not args.get("projection"):
                 print(f"[ORCH-MULTI] → dynamic aggregation multi-DB pour "
                       f"{args['collection']} sur {len(clients)} bases")
-                raw_docs = await build_dynamic_projection_multi(
+                page = await build_dynamic_projection_multi(
                     client_ids=clients,
                     collection=args["collection"],
                     user_query=raw_text,
-                    match_filter=args.get("filter") or {}
+                    match_filter=args.get("filter") or {},
+                    page_size=DYN_PAGE_SIZE,
+                    limit=int(args["limit"]) if args.get("limit") else None
                 )
+                raw_docs, next_cursor = page["documents"], page["next_cursor"]
+                errors = page["errors"]
 
             else:
+                errors, next_cursor = {}, None
                 # fallback : ensure projection includes filter keys
                 proj = args.get("projection") or {}
                 for k in (args.get("filter") or {}):
                     if not k.startswith("$") and k not in proj:
                         proj[k] = 1
                 print(f"[DEBUG][orchestrator] Final projection used: {proj}", flush=True)
-                raw_docs = execute_cross_db_query(
+                raw_docs = await aexecute_cross_db_query(
                     client_ids = clients,
                     collection = args["collection"],
                     filter     = args.get("filter"),
@@ -455,6 +585,8 @@ async def handle_query(
                 "answer":      answer_txt,
                 "documents":   docs,
                 "columns":     columns,
+                "errors":      errors,
+                "next_cursor": next_cursor,
                 "duration_ms": int((time.time() - start) * 1000)
             }
 
@@ -465,7 +597,7 @@ async def handle_query(
             client_id = func_args["client_id"]
             asset_id  = func_args["asset_id"]
 
-            asset_doc = get_asset_by_id(client_id, asset_id)
+            asset_doc = await aget_asset_by_id(client_id, asset_id)
             if not asset_doc:
                 return {
                     "session_id": session_id,
@@ -495,7 +627,7 @@ async def handle_query(
         elif func_name == "misconfig_overview":
             # 1) Résolution du nom de la base
             comp_raw = func_args.get("company", "").strip()
-            comp = resolve_company(comp_raw)
+            comp = await resolve_company(comp_raw)
             if not comp:
                 return {
                     "session_id": session_id,
@@ -504,7 +636,7 @@ async def handle_query(
 
             # 2) Appel du helper
             since = int(func_args.get("since_days", 30))
-            res = detect_misconfig(comp, since)
+            res = await run_db(detect_misconfig, comp, since, heavy=True)
 
             # 3) Ajout de _company aux items
             for item in res["items"]:
@@ -540,23 +672,93 @@ async def handle_query(
 
 
 
+        # -----------------------------------------------------------------
+        # top_transmitters (table matérialisée)
+        # -----------------------------------------------------------------
+        elif func_name == "top_transmitters":
+            raw = func_args.get("company", "").strip()
+            comp = await resolve_company(raw)
+            if not comp:
+                return {
+                    "session_id": session_id,
+                    "answer": f"Je ne reconnais pas l’entreprise « {raw} »."
+                }
+
+            limit = int(func_args.get("limit") or 10)
+            data  = await run_db(top_transmitters, comp, limit, heavy=True)
+            docs  = serialize_docs(data["transmitters"])
+
+            return {
+                "session_id": session_id,
+                "answer":     await answerer.answer(locale, data, text),
+                "company":    comp,
+                "documents":  docs,
+                "columns":    extract_columns(docs),
+                "duration_ms": int((time.time() - start) * 1000)
+            }
+
+        # -----------------------------------------------------------------
+        # error_rate_anomalies (vs baseline_daily, test binomial exact)
+        # -----------------------------------------------------------------
+        elif func_name == "error_rate_anomalies":
+            raw = func_args.get("company", "").strip()
+            comp = await resolve_company(raw)
+            if not comp:
+                return {
+                    "session_id": session_id,
+                    "answer": f"Je ne reconnais pas l’entreprise « {raw} »."
+                }
+
+            hours = int(func_args.get("hours") or 24)
+            limit = int(func_args.get("limit") or 10)
+            data  = await run_db(error_rate_anomalies, comp, hours, limit, heavy=True)
+            docs  = serialize_docs(data["anomalies"])
+
+            return {
+                "session_id": session_id,
+                "answer":     await answerer.answer(locale, data, text),
+                "company":    comp,
+                "documents":  docs,
+                "columns":    extract_columns(docs),
+                "duration_ms": int((time.time() - start) * 1000)
+            }
+
+        # -----------------------------------------------------------------
+        # misconfig_ml_overview (scoring One-Class SVM, pool de processus)
+        # -----------------------------------------------------------------
+        elif func_name == "misconfig_ml_overview":
+            raw_ids = func_args.get("client_ids") or await alist_companies()
+            since   = int(func_args.get("since_days") or 30)
+            limit   = int(func_args.get("limit") or 50)
+
+            comps = [await resolve_company(raw) or raw for raw in raw_ids]
+            data  = await run_db(scan_misconfig_ml, comps, since, limit, heavy=True)
+            docs  = serialize_docs(data["suspects"])
+
+            return clean_jsonable({
+                "session_id": session_id,
+                "answer":     await answerer.answer(locale, data, text),
+                "documents":  docs,
+                "columns":    extract_columns(docs),
+                "errors":     data["errors"],
+                "duration_ms": int((time.time() - start) * 1000)
+            })
+
         # -----------------------------------------------------------------
         # misconfig_multi_overview
         # -----------------------------------------------------------------
         elif func_name == "misconfig_multi_overview":
             # 1) Liste des bases à interroger
-            raw_ids = func_args.get("client_ids") or list_companies()
+            raw_ids = func_args.get("client_ids") or await alist_companies()
             since   = int(func_args.get("since_days", 30))
 
-            # 2) Agréger tous les items avec _company
-            all_items = []
-            for raw in sorted(raw_ids, key=str.lower):
-                comp = resolve_company(raw) or raw
-                res  = detect_misconfig(comp, since)
-
-                for item in res["items"]:
-                    item["_company"] = comp
-                all_items.extend(res["items"])
+            # 2) Scan parallèle, agrégats fusionnés, items marqués _company
+            comps = [await resolve_company(raw) or raw for raw in raw_ids]
+            res   = await scan_misconfig(comps, since)
+            all_items = [
+                {**{k: v for k, v in it.items() if k != "company"}, "_company": it["company"]}
+                for it in res["items"]
+            ]
 
             # 3) Sérialisation
             docs = serialize_docs(all_items)
@@ -579,6 +781,7 @@ async def handle_query(
                 "byTransmitter":  res["byTransmitter"],
                 "bySeverity":     res["bySeverity"],
                 "dailyNew":       res["dailyNew"],
+                "errors":         res["errors"],
                 "duration_ms": int((time.time() - start) * 1000)
             }
 
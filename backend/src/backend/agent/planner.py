@@ -79,6 +79,60 @@ FUNC_SCHEMAS = [
             "required": ["company", "category"]
         }
     },
+    {
+        "name": "fleet_connectivity_overview",
+        "description": (
+            "État de connexion des capteurs sur PLUSIEURS entreprises (toutes par défaut) : "
+            "connectés / hors-ligne par entreprise + totaux flotte."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "client_ids": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Entreprises à inclure ; omis ⇒ toutes"
+                },
+                "top_n": {
+                    "type": "integer",
+                    "description": "Nombre de capteurs hors-ligne renvoyés par entreprise",
+                    "default": 10
+                }
+            }
+        }
+    },
+    {
+        "name": "fleet_battery_overview",
+        "description": (
+            "État des batteries sur PLUSIEURS entreprises (toutes par défaut) : "
+            "critique / alerte / ok par entreprise + totaux flotte."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "client_ids": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Entreprises à inclure ; omis ⇒ toutes"
+                },
+                "critical_threshold": {
+                    "type": "integer",
+                    "description": "Seuil critique en mV",
+                    "default": 3200
+                },
+                "warning_threshold": {
+                    "type": "integer",
+                    "description": "Seuil d'alerte en mV",
+                    "default": 3500
+                },
+                "top_n": {
+                    "type": "integer",
+                    "description": "Nombre d'échantillons par catégorie et par entreprise",
+                    "default": 10
+                }
+            }
+        }
+    },
     {
       "name": "run_query",
       "description": "Recherche vectorielle + filtres dans network_nodes.",
@@ -168,6 +222,57 @@ FUNC_SCHEMAS = [
             "required": ["company"]
         }
     },
+    {
+        "name": "topology_analysis",
+        "description": (
+            "Analyse du graphe réseau d'une entreprise : chemin (nombre de sauts) "
+            "d'un capteur jusqu'à sa gateway, relais critiques dont la perte isole "
+            "des capteurs, capteurs orphelins, taille des sous-arbres par gateway, "
+            "impact de la panne d'un nœud donné."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "company": {
+                    "type": "string",
+                    "description": "Nom complet de l’entreprise"
+                },
+                "query": {
+                    "type": "string",
+                    "enum": ["path_to_gateway", "removal_impact", "articulation_points",
+                             "orphaned_sensors", "gateway_subtrees"],
+                    "description": "Analyse demandée"
+                },
+                "address": {
+                    "type": "string",
+                    "description": "Adresse du nœud (requis pour path_to_gateway et removal_impact)"
+                }
+            },
+            "required": ["company", "query"]
+        }
+    },
+    {
+        "name": "topology_changes",
+        "description": (
+            "Changements récents du réseau d'une entreprise : nœuds apparus ou "
+            "disparus, capteurs ayant changé de parent, liens dont la qualité a "
+            "changé, sur les dernières heures."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "company": {
+                    "type": "string",
+                    "description": "Nom complet de l’entreprise"
+                },
+                "hours": {
+                    "type": "number",
+                    "description": "Fenêtre en heures (défaut 24 ; « aujourd’hui » = 24)"
+                }
+            },
+            "required": ["company"]
+        }
+    },
     {
         "name": "query_multi_db",
         "description": "Interroge plusieurs bases Mongo pour récupérer des documents sur plusieurs clients à la volée.",
@@ -263,6 +368,86 @@ FUNC_SCHEMAS = [
           }
         }
       }
+    },
+    {
+      "name": "top_transmitters",
+      "description": (
+        "Transmetteurs ayant le plus de points de mesure (MP) rattachés "
+        "pour une entreprise donnée."
+      ),
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "company": {
+            "type": "string",
+            "description": "Nom complet de l’entreprise"
+          },
+          "limit": {
+            "type": "integer",
+            "description": "Nombre de transmetteurs à renvoyer",
+            "default": 10
+          }
+        },
+        "required": ["company"]
+      }
+    },
+    {
+      "name": "error_rate_anomalies",
+      "description": (
+        "Capteurs dont le taux d’erreur récent est anormalement élevé par "
+        "rapport à leur taux nominal (baseline p0), classés par improbabilité "
+        "(p-valeur binomiale)."
+      ),
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "company": {
+            "type": "string",
+            "description": "Nom complet de l’entreprise"
+          },
+          "hours": {
+            "type": "integer",
+            "description": "Fenêtre récente analysée, en heures",
+            "default": 24
+          },
+          "limit": {
+            "type": "integer",
+            "description": "Nombre d’assets à renvoyer (top-K)",
+            "default": 10
+          }
+        },
+        "required": ["company"]
+      }
+    },
+    {
+      "name": "misconfig_ml_overview",
+      "description": (
+        "Tasks suspectes selon le modèle ML (One-Class SVM) sur une ou "
+        "plusieurs entreprises, les plus suspectes d’abord."
+      ),
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "client_ids": {
+            "type": "array",
+            "items": { "type": "string" },
+            "description": (
+              "Liste des noms de bases Mongo (ex. ['Icare_Brussels','Cabot']); "
+              "omis ⇒ toutes"
+            )
+          },
+          "since_days": {
+            "type": "integer",
+            "description": "Période d’analyse en jours",
+            "default": 30
+          },
+          "limit": {
+            "type": "integer",
+            "description": "Nombre de tasks à renvoyer",
+            "default": 50
+          }
+        }
+      }
     }
 
 ]
@@ -288,6 +473,11 @@ def _system_prompt(locale: str) -> str:
 
     2. **Topologie réseau** (gateways, capteurs, range-extenders…)  
        Mots-clés réseau → `network_topology`.
+       Questions sur la structure (« combien de sauts », « que se passe-t-il
+       si cet extender tombe », « capteurs orphelins », « relais critiques »)
+       → `topology_analysis`.
+       « Qu’est-ce qui a changé dans le réseau (aujourd’hui, depuis X h) »
+       → `topology_changes`.
 
     3. **Statut de connexion hors-ligne**  
        « offline / hors-ligne » sans autre filtre → `connectivity_overview`.
@@ -296,6 +486,11 @@ def _system_prompt(locale: str) -> str:
        « état batterie / critical / warning / ok » → `battery_overview`.  
        Détail d’une catégorie → `battery_list`.
 
+    4 bis. **Vue flotte** (hors-ligne ou batteries sur plusieurs / toutes
+       les entreprises, « sur toute la flotte », « par client »…)
+       → `fleet_connectivity_overview` / `fleet_battery_overview`
+         (jamais `query_multi_db` pour ces comptages).
+
     5. **Filtres explicites** (`batt`, `rssi`, `last_com`, `node_type`, etc.)  
        → `query_db` **ou** `query_multi_db` selon qu’il y a un ou plusieurs
          clients dans la question.
@@ -304,6 +499,10 @@ def _system_prompt(locale: str) -> str:
        → `run_query` (toujours avec un `limit` ≤ 10 000, `k` = 100 par défaut).
 
     7. **Tasks mal configurées / misconfigured / bad task” → misconfig_overview ou misconfig_multi_overview si plusieurs bases citées.
+       « Transmetteurs avec le plus de MP » → `top_transmitters`.
+       « Taux d’erreur anormal / plus d’erreurs que d’habitude / dérive »
+       → `error_rate_anomalies`.
+       « Tasks suspectes selon le modèle / ML / IA » → `misconfig_ml_overview`.
 
     8. **Sinon** → `rag_search`.
 
@@ -2,13 +2,20 @@
 """
 create_indexes_roquette.py
 ──────────────────────────────────────────────────────────────────
-Crée l’index composite indispensable à la détection des tasks
-mal configurées dans la base MongoDB locale “roquette_local”.
+Crée les index composites utilisés par les outils du chatbot
+dans la base MongoDB locale “roquette_local” :
+  • statistics    : détection des tasks mal configurées, moteur
+                    « window » (partition asset / tri acqend) ; l’état
+                    incrémental (misconfig_state) suit l’index `_id`
+  • tasks         : appartenance asset → task (moteurs window / state)
+  • network_nodes : vue connectivité (liste hors-ligne triée / paginée)
+                    et listes batterie par catégorie, suivi `_updated`
+                    du rollup santé capteurs
 
 • Se base sur la variable MONGODB_URI déjà définie dans .env
   (→ mongodb://localhost:27017/).
 • Base par défaut : “roquette_local” (modifiable via la var. d’env DB_NAME).
-• Idempotent : si l’index existe, il ne fait rien.
+• Idempotent : un index déjà présent est ignoré.
 • Exécution en tâche de fond (background=True).
 
 Usage :
@@ -29,9 +36,27 @@ DB_NAME    = os.getenv(
     "DB_NAME",
     "test"                   # base où tu as restauré tes dumps
 )
-COLLECTION   = "statistics"
-INDEX_NAME   = "idx_task_acqend"
-INDEX_FIELDS = [("acqinfo.task", 1), ("acqend", -1)]
+# (collection, nom, champs)
+INDEXES = [
+    ("statistics",    "idx_task_acqend",
+        [("acqinfo.task", 1), ("acqend", -1)]),
+    ("network_nodes", "idx_type_lastcom_addr",
+        [("node_type", 1), ("last_com", 1), ("address", 1)]),
+    ("network_nodes", "idx_type_batt_addr",
+        [("node_type", 1), ("batt", 1), ("address", 1)]),
+    ("network_nodes", "idx_updated",
+        [("_updated", 1)]),
+    ("statistics",    "idx_acqend",
+        [("acqend", 1)]),
+    ("statistics",    "idx_asset_acqend",
+        [("asset", 1), ("acqend", -1)]),
+    ("tasks",         "idx_asset",
+        [("asset", 1)]),
+    ("misconfig_state", "idx_lastacq",
+        [("last_acq", 1)]),
+    ("assets",        "idx_updated",
+        [("_updated", 1)]),
+]
 
 # ── 2. Création “create-if-not-exists” ─────────────────────────────
 def main() -> None:
@@ -43,22 +68,24 @@ def main() -> None:
         print(f"❌ Impossible de joindre MongoDB à {MONGODB_URI} : {exc}")
         return
 
-    col = client[DB_NAME][COLLECTION]
+    db = client[DB_NAME]
+    for coll, name, fields in INDEXES:
+        col = db[coll]
 
-    # Vérifie si l’index existe déjà
-    existing = [idx["name"] for idx in col.list_indexes()]
-    if INDEX_NAME in existing:
-        print(f"✅ Index « {INDEX_NAME} » déjà présent sur {DB_NAME}.{COLLECTION}")
-        return
+        # Vérifie si l’index existe déjà
+        existing = [idx["name"] for idx in col.list_indexes()]
+        if name in existing:
+            print(f"✅ Index « {name} » déjà présent sur {DB_NAME}.{coll}")
+            continue
 
-    # Création de l’index en tâche de fond
-    print(f"➕ Création de l’index « {INDEX_NAME} » sur {DB_NAME}.{COLLECTION} …")
-    col.create_index(
-        INDEX_FIELDS,
-        name=INDEX_NAME,
-        background=True
-    )
-    print("✅ Index créé (build en arrière-plan).")
+        # Création de l’index en tâche de fond
+        print(f"➕ Création de l’index « {name} » sur {DB_NAME}.{coll} …")
+        col.create_index(
+            fields,
+            name=name,
+            background=True
+        )
+        print("✅ Index créé (build en arrière-plan).")
 
 if __name__ == "__main__":
     main()
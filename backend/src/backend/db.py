@@ -7,10 +7,13 @@ from functools import lru_cache
 from itertools import chain
 import hashlib
 from dotenv import load_dotenv
+import pymongo
 from pymongo import MongoClient, errors
 from backend.utils.slugify_company import slugify_company
 from typing import Optional, Dict, Any, List
 import difflib
+import asyncio
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Charger .env
@@ -26,6 +29,36 @@ try:
 except errors.PyMongoError as exc:
     raise RuntimeError(f"Mongo unreachable: {exc}") from exc
 
+# ---------------------------------------------------------------------------
+# Exécuteurs bornés : pymongo est synchrone, on ne l'appelle jamais
+# directement depuis la boucle asyncio.
+#   • "default" : requêtes courtes (find, count, lookup d’un asset…)
+#   • "heavy"   : agrégations lourdes (detect_misconfig, topologie…)
+# Deux pools séparés → une agrégation lente ne monopolise pas les threads
+# dont les requêtes légères ont besoin.
+# ---------------------------------------------------------------------------
+#   • "fleet"   : une agrégation lourde par entreprise lors des scans
+#                 multi-bases (afan_out), sans vider le pool "heavy"
+DB_MAX_WORKERS    = int(os.getenv("DB_MAX_WORKERS", "16"))
+DB_HEAVY_WORKERS  = int(os.getenv("DB_HEAVY_WORKERS", "4"))
+DB_FLEET_WORKERS  = int(os.getenv("DB_FLEET_WORKERS", "8"))
+
+_EXECUTORS = {
+    "default": ThreadPoolExecutor(max_workers=DB_MAX_WORKERS,   thread_name_prefix="mongo"),
+    "heavy":   ThreadPoolExecutor(max_workers=DB_HEAVY_WORKERS, thread_name_prefix="mongo-heavy"),
+    "fleet":   ThreadPoolExecutor(max_workers=DB_FLEET_WORKERS, thread_name_prefix="mongo-fleet"),
+}
+
+
+async def run_db(func, /, *args, heavy: bool = False, **kwargs):
+    """
+    Exécute `func(*args, **kwargs)` (code pymongo bloquant) dans le pool
+    borné approprié et rend la main à la boucle asyncio pendant l’attente.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _EXECUTORS["heavy" if heavy else "default"]
+    return await loop.run_in_executor(pool, partial(func, *args, **kwargs))
+
 
 
 def get_nodes_collection(company: str):
@@ -186,6 +219,33 @@ def execute_cross_db_query(
     return results
 
 
+def fan_out(
+    client_ids: list[str],
+    func,
+    max_workers: int = 10,
+) -> tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Appelle `func(db_name)` pour chaque base, en parallèle (pool borné).
+    Renvoie ({base: résultat}, {base: message d’erreur}) : une base en
+    échec n’empêche pas de renvoyer les autres.
+    """
+    results: Dict[str, Any] = {}
+    errors_: Dict[str, str] = {}
+    if not client_ids:
+        return results, errors_
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(client_ids))) as executor:
+        futures = {executor.submit(func, db): db for db in client_ids}
+        for fut in as_completed(futures):
+            db = futures[fut]
+            try:
+                results[db] = fut.result()
+            except Exception as exc:
+                logging.exception(f"fan_out: échec sur {db}")
+                errors_[db] = str(exc)
+    return results, errors_
+
+
 def describe_schema(
     client_id: str,
     collection: str,
@@ -251,4 +311,99 @@ def get_asset_by_id(client_id: str, asset_id: str) -> dict | None:
         return db["assets"].find_one({"_id": oid})
     except Exception as e:
         logging.exception(f"get_asset_by_id: erreur find_one sur {db_name}.assets pour {asset_id}")
-        return None
\ No newline at end of file
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Façade asynchrone : mêmes signatures, à `await` depuis les routes FastAPI
+# et l’orchestrateur.
+# ---------------------------------------------------------------------------
+async def alist_companies() -> list[str]:
+    return await run_db(list_companies)
+
+async def afind_company_candidates(input_name: str) -> list[str]:
+    return await run_db(find_company_candidates, input_name)
+
+async def aexecute_db_query(
+    client_id: str,
+    collection: str,
+    filter: Dict[str, Any] | None = None,
+    projection: Dict[str, int] | None = None,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    return await run_db(execute_db_query, client_id, collection, filter, projection, limit)
+
+async def aexecute_cross_db_query(
+    client_ids: list[str],
+    collection: str,
+    filter: Dict[str, Any] | None = None,
+    projection: Dict[str, int] | None = None,
+    limit: Optional[int] = None,
+    max_workers: int = 10,
+) -> List[Dict[str, Any]]:
+    # le fan-out interne garde son propre pool ; on le lance dans le pool
+    # "heavy" pour ne pas bloquer les requêtes courtes
+    return await run_db(
+        execute_cross_db_query, client_ids, collection, filter, projection, limit,
+        max_workers, heavy=True
+    )
+
+async def adescribe_schema(client_id: str, collection: str) -> List[str]:
+    return await run_db(describe_schema, client_id, collection)
+
+async def asample_fields(client_id: str, collection: str, size: int = 50) -> list[str]:
+    return await run_db(sample_fields, client_id, collection, size)
+
+async def aget_asset_by_id(client_id: str, asset_id: str) -> dict | None:
+    return await run_db(get_asset_by_id, client_id, asset_id)
+
+
+async def afan_out(
+    client_ids: list[str],
+    func,
+    /,
+    *args,
+    concurrency: int = DB_FLEET_WORKERS,
+    timeout: float | None = None,
+    **kwargs,
+):
+    """
+    Version asynchrone de `fan_out` : appelle `func(db, *args, **kwargs)` pour
+    chaque base dans le pool "fleet" (au plus `concurrency` à la fois) et
+    produit (base, résultat, erreur) dans l’ordre de complétion.
+
+    `timeout` (s) est aussi imposé côté serveur : les opérations de `func`
+    tournent sous `pymongo.timeout`, qui envoie `maxTimeMS` avec chaque
+    commande. Une base en retard est rendue en erreur ; son créneau n’est
+    libéré qu’à la fin effective du thread, pour que `concurrency` borne
+    vraiment les requêtes en cours sur le serveur.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    def call(db: str):
+        if timeout is None:
+            return func(db, *args, **kwargs)
+        with pymongo.timeout(timeout):
+            return func(db, *args, **kwargs)
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(sem.release)
+        except RuntimeError:          # boucle fermée entre-temps
+            pass
+
+    async def one(db: str):
+        await sem.acquire()
+        cfut = _EXECUTORS["fleet"].submit(call, db)
+        cfut.add_done_callback(release)
+        try:
+            return db, await asyncio.wait_for(asyncio.wrap_future(cfut), timeout), None
+        except asyncio.TimeoutError:
+            return db, None, f"timeout ({timeout:g}s)"
+        except Exception as exc:
+            logging.exception(f"afan_out: échec sur {db}")
+            return db, None, str(exc)
+
+    for done in asyncio.as_completed([one(db) for db in client_ids]):
+        yield await done
@@ -2,20 +2,38 @@ import os
 import uuid
 import json
 import time
+import asyncio
+import logging
 
-from fastapi import FastAPI, Request, HTTPException, APIRouter, Query
+from fastapi import FastAPI, Request, Response, HTTPException, APIRouter, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Extra
+from fastapi.responses import StreamingResponse
 from starlette.middleware.sessions import SessionMiddleware
-from backend.db import get_asset_by_id, list_companies
+from backend.db import aget_asset_by_id, alist_companies, run_db
 from backend.utils.serialize import _deep_clean, clean_jsonable
 from backend.tools.asset_types import ASSET_TYPE_MAP
 
 from backend.agent.orchestrator import handle_query
-from backend.tools.topology import get_network_topology, topology_to_d3
-from typing import List
-from backend.tools.misconfiguration import detect_misconfig
-from backend.utils.serialize import extract_columns
+from backend.tools.topology import topology_to_d3
+from backend.tools.topology_graph import analyze_topology
+from backend.tools.topology_engine import topology_changes
+from backend.tools.topology_lod import get_topology_view_tagged, invalidate_topology
+from backend.utils.cache import cache_stats
+from typing import List, Literal
+from backend.tools.misconfiguration import (
+    MISCONFIG_ENGINE, detect_misconfig, merge_misconfig, scan_misconfig, stream_misconfig,
+)
+from backend.tools.misconfig_cache import invalidate_misconfig_cache
+from backend.tools.misconfig_state import refresh_state
+from backend.tools.schema_profile import refresh_stale_profiles
+from backend.tools.dynamic_projection import next_dynamic_page
+from backend.tools.transmitter_totals import top_transmitters
+from backend.tools.misconfiguration_ml import scan_misconfig_ml, shutdown_pool as shutdown_ml_pool
+from backend.tools.misconfig_vector import shutdown_pool as shutdown_scorer_pool
+from backend.tools.sensor_tools import connectivity_overview
+from backend.tools.sensor_rollup import refresh_rollup
+from backend.utils.serialize import extract_columns, serialize_docs
 
 app = FastAPI(title="I-CARE Chatbot RAG", version="0.2.0")
 api = APIRouter(prefix="/api")
@@ -36,6 +54,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ── 2 bis. Tâches de fond ─────────────────────────────────────────────
+# Intervalle (s) de rafraîchissement incrémental du rollup santé capteurs ;
+# 0 = désactivé. Un seul écrivain à la fois (bail Mongo) : les autres workers,
+# ou tous pendant un `sensor_rollup --watch`, passent leur tour.
+SENSOR_ROLLUP_INTERVAL = int(os.getenv("SENSOR_ROLLUP_INTERVAL", "60"))
+
+async def _sensor_rollup_loop():
+    while True:
+        for comp in await alist_companies():
+            try:
+                await run_db(refresh_rollup, comp, heavy=True)
+            except Exception:
+                logging.exception(f"sensor_rollup: échec du rafraîchissement pour {comp}")
+        await asyncio.sleep(SENSOR_ROLLUP_INTERVAL)
+
+# Idem pour l’état incrémental des tasks mal configurées (si MISCONFIG_ENGINE=state).
+MISCONFIG_STATE_INTERVAL = int(os.getenv("MISCONFIG_STATE_INTERVAL", "300"))
+
+async def _misconfig_state_loop():
+    while True:
+        for comp in await alist_companies():
+            try:
+                await run_db(refresh_state, comp, heavy=True)
+            except Exception:
+                logging.exception(f"misconfig_state: échec du rafraîchissement pour {comp}")
+        await asyncio.sleep(MISCONFIG_STATE_INTERVAL)
+
+# Reconstruction des profils de schéma périmés (projection dynamique) ; 0 = désactivé.
+SCHEMA_PROFILE_INTERVAL = int(os.getenv("SCHEMA_PROFILE_INTERVAL", "3600"))
+
+async def _schema_profile_loop():
+    while True:
+        await asyncio.sleep(SCHEMA_PROFILE_INTERVAL)
+        try:
+            await run_db(refresh_stale_profiles, heavy=True)
+        except Exception:
+            logging.exception("schema_profile: échec du rafraîchissement")
+
+@app.on_event("startup")
+async def _start_background_jobs():
+    if SENSOR_ROLLUP_INTERVAL > 0:
+        asyncio.create_task(_sensor_rollup_loop())
+    if MISCONFIG_ENGINE == "state" and MISCONFIG_STATE_INTERVAL > 0:
+        asyncio.create_task(_misconfig_state_loop())
+    if SCHEMA_PROFILE_INTERVAL > 0:
+        asyncio.create_task(_schema_profile_loop())
+
+@app.on_event("shutdown")
+async def _stop_pools():
+    # processus de scoring ML / numpy (spawn) : pas d’orphelins au redémarrage
+    shutdown_ml_pool()
+    shutdown_scorer_pool()
+
 # ── 3. Schemas Pydantic ───────────────────────────────────────────────
 class ChatReq(BaseModel):
     message: str
@@ -72,17 +143,131 @@ async def chat(request: Request, payload: ChatReq):
 
 # ── 5. Route /topology ────────────────────────────────────────────────
 @api.get("/topology/{company}")
-async def topology(company: str):
+async def topology(
+    company: str,
+    request: Request,
+    response: Response,
+    lod: Literal["full", "cluster"] = "full",
+    expand: List[str] | None = Query(None),
+    partition: str | None = None,
+    root: str | None = None
+):
+    """
+    `lod=cluster` : infrastructure + capteurs regroupés par gateway / extender ;
+    `expand` déplie des clusters, `partition` / `root` restreignent la vue.
+    Renvoie un ETag (hash du contenu) ; `If-None-Match` identique → 304.
+    """
+    try:
+        etag, topo, version = await run_db(
+            get_topology_view_tagged, company, lod, expand or (), partition, root, heavy=True
+        )
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Topology-Version": version}
+    known = request.headers.get("if-none-match", "")
+    if etag in (t.strip().removeprefix("W/") for t in known.split(",")):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    graph = topology_to_d3(topo)
+    return {
+        "topology": topo,
+        "graph": graph
+    }
+
+@api.get("/topology/{company}/diff")
+async def topology_diff(company: str, since: str = Query(...)):
+    """
+    Changements depuis le jeton `since` (en-tête X-Topology-Version,
+    « epoch.version ») : nœuds ajoutés / retirés, re-parentages, qualité de
+    lien. `full=true` → jeton d'un autre worker / d'avant un redémarrage ou
+    historique insuffisant, relire /api/topology.
+    """
     try:
-        topo = get_network_topology(company)
-        graph = topology_to_d3(topo)
-        return {
-            "topology": topo,
-            "graph": graph
-        }
+        return clean_jsonable(await run_db(topology_changes, company, since, heavy=True))
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
+@api.delete("/topology/{company}/cache")
+async def topology_invalidate(company: str):
+    """Invalidation explicite (vues en cache + graphe en mémoire de ce worker)."""
+    return {"company": company, "invalidated": invalidate_topology(company)}
+
+@api.get("/cache/stats")
+async def caches():
+    """Hits / misses / évictions des caches instrumentés de ce worker."""
+    return cache_stats()
+
+# ── 5 ter. Analyses de graphe sur la topologie ───────────────────────
+TopologyQuery = Literal[
+    "path_to_gateway", "removal_impact", "articulation_points",
+    "orphaned_sensors", "gateway_subtrees",
+]
+
+@api.get("/topology/{company}/analysis/{query}")
+async def topology_analysis(
+    company: str,
+    query: TopologyQuery,
+    address: str | None = None,
+    include_neighbors: bool = False
+):
+    """
+    Requêtes sur le graphe compact : chemin vers la gateway, relais
+    critiques, capteurs orphelins, tailles de sous-arbres, impact d’une panne.
+    """
+    try:
+        return clean_jsonable(await run_db(
+            analyze_topology, company, query, address, include_neighbors, heavy=True
+        ))
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+# ── 5 bis. Route /connectivity (liste hors-ligne paginée) ─────────────
+@api.get("/connectivity/{company}")
+async def connectivity(
+    company: str,
+    page_size: int = Query(500, ge=1, le=10_000),
+    cursor: str | None = None
+):
+    """
+    Compteurs connectés / hors-ligne (première page, ou rollup) + une page
+    de capteurs hors-ligne.
+    Repasser `next_cursor` dans `cursor` pour la page suivante.
+    """
+    try:
+        res = await run_db(connectivity_overview, company, page_size=page_size, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return clean_jsonable(res)
+
+# ── 5 ter. Pages suivantes d’une requête dynamique ───────────────────
+@api.get("/dynamic/next")
+async def dynamic_next(cursor: str):
+    """
+    Page suivante d’une requête `query_db` / `query_multi_db` dynamique :
+    repasser le `next_cursor` reçu (jeton signé, contient collection,
+    filtre, projection et position par base ; une base en erreur garde sa
+    position et est réessayée, au plus DYN_PROJ_TENANT_MAX_FAILS fois de
+    suite, puis abandonnée et signalée dans `errors`).
+    """
+    try:
+        page = await next_dynamic_page(cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except RuntimeError as exc:                     # CURSOR_SECRET absent
+        raise HTTPException(status_code=503, detail=str(exc))
+    docs = serialize_docs(page["documents"])
+    return clean_jsonable({
+        "documents":   docs,
+        "columns":     extract_columns(docs),
+        "next_cursor": page["next_cursor"],
+        "errors":      page["errors"],
+    })
+
 # ── 6. Route /assets ──────────────────────────────────────────────────
 @api.get("/assets/{client_id}/{asset_id}")
 async def asset_detail(client_id: str, asset_id: str):
@@ -90,7 +275,7 @@ async def asset_detail(client_id: str, asset_id: str):
     Retourne le document complet (nettoyé) de la collection assets
     pour l’ObjectId donné, ou 404 s’il n’existe pas.
     """
-    asset = get_asset_by_id(client_id, asset_id)
+    asset = await aget_asset_by_id(client_id, asset_id)
     if not asset:
         raise HTTPException(404, f"Asset {asset_id} introuvable dans la DB {client_id}")
 
@@ -113,6 +298,74 @@ async def asset_detail(client_id: str, asset_id: str):
     return cleaned
 
 # ── Mono-DB ─────────────────────────────────────────────────────────
+# ── Transmetteurs (table matérialisée) ─────────────────────────────
+@api.get("/transmitters/{company}")
+async def transmitters(company: str, limit: int = Query(10, ge=1, le=1_000)):
+    """Transmetteurs ayant le plus de MP rattachés."""
+    return clean_jsonable(await run_db(top_transmitters, company, limit, heavy=True))
+
+# ── Scoring ML (One-Class SVM) ─────────────────────────────────────
+@api.get("/misconfig/ml")
+async def misconfig_ml(
+    client_ids: List[str] = Query(
+        None,
+        description="Bases à scorer (omit = toutes)"
+    ),
+    since_days: int = 30,
+    limit: int = Query(50, ge=1, le=10_000)
+):
+    """Tasks suspectes selon le modèle, une base par processus du pool."""
+    bases = client_ids or await alist_companies()
+    try:
+        res = await run_db(scan_misconfig_ml, bases, since_days, limit, heavy=True)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    docs = serialize_docs(res["suspects"])
+    return clean_jsonable({
+        "companies": res["companies"],
+        "documents": docs,
+        "columns":   extract_columns(docs),
+        "errors":    res["errors"],
+    })
+
+# ── Multi-DB en flux (NDJSON) ───────────────────────────────────────
+@api.get("/misconfig/stream")
+async def misconfig_stream(
+    client_ids: List[str] = Query(
+        None,
+        description="Bases à interroger (omit = toutes)"
+    ),
+    since_days: int = 30
+):
+    """
+    Une ligne JSON par base dès qu’elle est terminée
+    ({company, counts, documents, …} ou {company, error}), puis une
+    dernière ligne {fleet: true, …} avec les agrégats de toute la flotte.
+    """
+    bases = client_ids or await alist_companies()
+
+    async def lines():
+        done, errors = {}, {}
+        async for comp, res, err in stream_misconfig(bases, since_days):
+            if err is not None:
+                errors[comp] = err
+                yield json.dumps({"company": comp, "error": err}) + "\n"
+                continue
+            done[comp] = res
+            yield json.dumps(clean_jsonable({
+                "company":       comp,
+                "counts":        res["counts"],
+                "documents":     [{**it, "company": comp} for it in res["items"]],
+                "byTransmitter": res["byTransmitter"],
+                "bySeverity":    res["bySeverity"],
+                "dailyNew":      res["dailyNew"],
+            })) + "\n"
+        fleet = merge_misconfig(done)
+        fleet.pop("items")
+        yield json.dumps(clean_jsonable({"fleet": True, **fleet, "errors": errors})) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @api.get("/misconfig/{company}")
 async def misconfig(
     company: str,
@@ -121,8 +374,8 @@ async def misconfig(
     """
     Tasks mal configurées pour une seule base.
     """
-    # Appel du helper
-    res  = detect_misconfig(company, since_days)
+    # Appel du helper (pool "heavy" : ne bloque pas la boucle)
+    res  = await run_db(detect_misconfig, company, since_days, heavy=True)
     docs = res["items"]            # déjà aplatis
     for d in docs:
         d["company"] = company
@@ -148,6 +401,11 @@ async def misconfig(
         "dailyNew":      res["dailyNew"],
     })
 
+@api.delete("/misconfig/{company}/cache")
+async def misconfig_invalidate(company: str):
+    """Invalidation explicite des résultats detect_misconfig en cache (tous les workers)."""
+    return {"company": company, "invalidated": invalidate_misconfig_cache(company)}
+
 # ── Multi-DB ────────────────────────────────────────────────────────
 @api.get("/misconfig")
 async def misconfig_multi(
@@ -160,14 +418,11 @@ async def misconfig_multi(
     """
     Tasks mal configurées sur plusieurs bases.
     """
-    bases = client_ids or list_companies()
+    bases = client_ids or await alist_companies()
 
-    all_items: list[dict] = []
-    for comp in sorted(bases, key=str.lower):
-        res = detect_misconfig(comp, since_days)
-        for item in res["items"]:
-            item["company"] = comp
-        all_items.extend(res["items"])
+    # scan parallèle borné (pool "fleet"), délai max par base
+    res = await scan_misconfig(bases, since_days)
+    all_items = res["items"]
 
     # Réordonner les colonnes pour misconfig multi
     cols = [
@@ -185,11 +440,13 @@ async def misconfig_multi(
     ]
 
     return clean_jsonable({
-        "documents": all_items,
-        "columns":   cols,
+        "counts":        res["counts"],
+        "documents":     all_items,
+        "columns":       cols,
         "byTransmitter": res["byTransmitter"],
         "bySeverity":    res["bySeverity"],
-        "dailyNew":      res["dailyNew"]
+        "dailyNew":      res["dailyNew"],
+        "errors":        res["errors"],
     })
 
 app.include_router(api)
@@ -5,29 +5,70 @@ Calcule, pour chaque capteur (asset),
 le taux d’erreur nominal p₀ = erreurs / exécutions sur les X derniers jours,
 et stocke le résultat dans la collection 'baseline_error_rate'.
 
+Deux modes :
+  • full        : agrège toute la fenêtre de `statistics` en comptes
+                  journaliers (n, k) par asset → `baseline_daily`, puis
+                  reconstruit baseline_error_rate depuis ces comptes ;
+  • incremental : ne ré-agrège que les jours depuis le dernier passage
+                  (le jour courant, partiel, est recompté à chaque fois)
+                  dans `baseline_daily`, purge les jours sortis de la
+                  fenêtre, puis recalcule depuis `baseline_daily` le
+                  baseline des seuls assets touchés ($group / $merge).
+                  Rejouable sans double comptage. Coût : ~1 jour de
+                  statistics.
+
+Les deux modes réécrivent `baseline_daily` : un seul passage à la fois par
+entreprise (bail `_id = "lease"` dans baseline_meta, BASELINE_LEASE_TTL s) ;
+un passage qui trouve le bail tenu ne fait rien.
+
+La fenêtre est alignée sur les jours UTC : le jour courant et les
+`days - 1` jours précédents. Une statistique arrivée après que son jour a
+été clos n’est vue qu’au prochain passage « full ».
+
 Usage CLI :
-    python app/tools/baseline.py --company MA_COMPAGNIE --days 30
+    python app/tools/baseline.py --company MA_COMPAGNIE --days 30 [--mode full]
+    python app/tools/baseline.py --all --workers 4
 """
 
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from backend.db import client
+from typing import Dict, List
+
+from pymongo import errors
+
+from backend.db import client, list_companies
 
 # ── Valeurs par défaut ───────────────────────────────────────
-BASELINE_DAYS = 30
+BASELINE_DAYS    = 30
+BASELINE_WORKERS = int(os.getenv("BASELINE_WORKERS", "4"))     # bases traitées en parallèle
+DAILY_COLL       = "baseline_daily"
+META_COLL        = "baseline_meta"
+META_ID          = "meta"
+LEASE_ID         = "lease"
+BASELINE_LEASE_TTL = int(os.getenv("BASELINE_LEASE_TTL", "1800"))   # s, > durée d’un passage complet
+BATCH_SIZE       = 1_000
 
-def compute_baseline(company: str, days: int = BASELINE_DAYS) -> None:
-    db = client[company]
-    cutoff = datetime.utcnow() - timedelta(days=days)
 
-    pipeline = [
+def _day(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _daily_stages(since: datetime) -> list[dict]:
+    """statistics ≥ since → {_id: {asset, day}, asset, day, n, k}."""
+    return [
         # 1) on ne garde que les stats récentes ET avec un asset défini
         {"$match": {
             "asset":    {"$exists": True, "$ne": None},
-            "acqend":   {"$gte": cutoff}
+            "acqend":   {"$gte": since}
         }},
-        # 2) agrégation par asset
+        # 2) agrégation par asset et par jour
         {"$group": {
-            "_id": "$asset",
+            "_id": {
+                "asset": "$asset",
+                "day":   {"$dateTrunc": {"date": "$acqend", "unit": "day"}},
+            },
             "n":   {"$sum": 1},
             "k":   {"$sum": {
                 "$cond": [
@@ -37,19 +78,27 @@ def compute_baseline(company: str, days: int = BASELINE_DAYS) -> None:
                 ]
             }}
         }},
-        # 3) calcul du taux p0
+        {"$addFields": {"asset": "$_id.asset", "day": "$_id.day"}},
+    ]
+
+
+def _p0_expr() -> dict:
+    return {"$cond": [{"$gt": ["$n", 0]}, {"$divide": ["$k", "$n"]}, 0]}
+
+
+def _baseline_stages(updated: datetime) -> list[dict]:
+    """baseline_daily (déjà filtrée) → baseline_error_rate, par asset."""
+    return [
+        {"$group": {"_id": "$asset", "n": {"$sum": "$n"}, "k": {"$sum": "$k"}}},
+        # calcul du taux p0
         {"$project": {
             "_id":      1,
-            "p0":       {"$cond": [
-                            {"$gt": ["$n", 0]},
-                            {"$divide": ["$k", "$n"]},
-                            0
-                        ]},
+            "p0":       _p0_expr(),
             "n":        1,
             "k":        1,
-            "updated":  datetime.utcnow()
+            "updated":  updated
         }},
-        # 4) upsert dans baseline_error_rate
+        # upsert dans baseline_error_rate
         {"$merge": {
             "into":            "baseline_error_rate",
             "on":              "_id",
@@ -58,10 +107,163 @@ def compute_baseline(company: str, days: int = BASELINE_DAYS) -> None:
         }}
     ]
 
-    db["statistics"].aggregate(pipeline, allowDiskUse=True)
+
+def _assets(coll, match: dict) -> set:
+    """Assets distincts de `match` (agrégation : pas de limite 16 Mo de distinct)."""
+    return {d["_id"] for d in coll.aggregate(
+        [{"$match": match}, {"$group": {"_id": "$asset"}}], allowDiskUse=True
+    )}
+
+
+# ---------------------------------------------------------------------------
+# Bail écrivain (même protocole que sensor_rollup)
+# ---------------------------------------------------------------------------
+def _acquire_lease(company: str, owner: str, ttl: int = BASELINE_LEASE_TTL) -> bool:
+    """Prend le bail ; False s’il est tenu par un autre passage."""
+    now = datetime.utcnow()
+    try:
+        client[company][META_COLL].update_one(
+            {"_id": LEASE_ID, "$or": [{"owner": owner}, {"expires": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+    except errors.DuplicateKeyError:
+        return False            # bail vivant d’un autre passage
+    return True
+
+
+def _release_lease(company: str, owner: str) -> None:
+    client[company][META_COLL].delete_one({"_id": LEASE_ID, "owner": owner})
+
+
+def _leased(company: str, fn, *args):
+    """fn(company, *args) sous le bail ; None (rien fait) s’il est tenu ailleurs."""
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(company, owner):
+        print(f"[{company}] baseline : passage déjà en cours ailleurs, ignoré")
+        return None
+    try:
+        return fn(company, *args)
+    finally:
+        _release_lease(company, owner)
+
+
+# ---------------------------------------------------------------------------
+# Mode complet
+# ---------------------------------------------------------------------------
+def compute_baseline(company: str, days: int = BASELINE_DAYS) -> None:
+    """Recalcule baseline_daily et baseline_error_rate sur toute la fenêtre."""
+    _leased(company, _compute, days)
+
+
+def _compute(company: str, days: int) -> None:
+    db = client[company]
+    started = datetime.utcnow()
+    window_start = _day(started) - timedelta(days=days - 1)
+
+    # comptes journaliers de toute la fenêtre (remplacement atomique)
+    db["statistics"].aggregate(
+        [*_daily_stages(window_start), {"$out": DAILY_COLL}], allowDiskUse=True
+    )
+    db[DAILY_COLL].create_index([("day", 1)], name="idx_day")
+    db[DAILY_COLL].create_index([("asset", 1), ("day", 1)], name="idx_asset_day")
+
+    # baseline = somme des jours (quelques dizaines de docs par asset)
+    db[DAILY_COLL].aggregate(_baseline_stages(datetime.utcnow()), allowDiskUse=True)
+    # assets sans statistique dans la fenêtre : plus de baseline
+    db["baseline_error_rate"].delete_many({"updated": {"$lt": started}})
+
+    db[META_COLL].replace_one(
+        {"_id": META_ID},
+        {"days": days, "window_start": window_start,
+         "last_day": _day(started), "full_at": started},
+        upsert=True,
+    )
     print(f"[{company}] baseline_error_rate mis à jour pour les {days} derniers jours")
 
 
+# ---------------------------------------------------------------------------
+# Mode incrémental
+# ---------------------------------------------------------------------------
+def update_baseline(company: str, days: int = BASELINE_DAYS) -> int:
+    """
+    Roule la fenêtre : recompte les jours ≥ dernier jour traité dans
+    baseline_daily, purge les jours expirés, puis recalcule le baseline des
+    assets touchés depuis baseline_daily (pas de delta : rejouable sans
+    double comptage). Passe en mode complet si aucun état n’existe (ou si
+    `days` a changé). Renvoie le nombre d’assets recalculés (-1 après un
+    passage complet, 0 si un autre passage tient le bail).
+    """
+    return _leased(company, _update, days) or 0
+
+
+def _update(company: str, days: int) -> int:
+    db = client[company]
+    meta = db[META_COLL].find_one({"_id": META_ID})
+    if not meta or meta.get("days") != days:
+        _compute(company, days)
+        return -1
+
+    now = datetime.utcnow()
+    today = _day(now)
+    window_start = today - timedelta(days=days - 1)
+    since = max(meta["last_day"], window_start)
+    daily = db[DAILY_COLL]
+
+    # 1) assets concernés : jours recomptés (avant / après) + jours expirés
+    touched = _assets(daily, {"$or": [{"day": {"$gte": since}}, {"day": {"$lt": window_start}}]})
+
+    # 2) baseline_daily d’abord : jours recomptés remplacés, jours disparus / expirés purgés
+    db["statistics"].aggregate([
+        *_daily_stages(since),
+        {"$addFields": {"counted_at": now}},
+        {"$merge": {"into": DAILY_COLL, "on": "_id",
+                    "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ], allowDiskUse=True)
+    daily.delete_many({"$or": [{"day": {"$gte": since}, "counted_at": {"$ne": now}},
+                               {"day": {"$lt": window_start}}]})
+    touched |= _assets(daily, {"day": {"$gte": since}})
+
+    # 3) baseline des assets touchés = somme de leurs jours dans la fenêtre
+    assets = list(touched)
+    for lo in range(0, len(assets), BATCH_SIZE):
+        chunk = assets[lo:lo + BATCH_SIZE]
+        daily.aggregate([
+            {"$match": {"asset": {"$in": chunk}, "day": {"$gte": window_start}}},
+            *_baseline_stages(now),
+        ], allowDiskUse=True)
+        # plus aucun jour dans la fenêtre : plus de baseline
+        db["baseline_error_rate"].delete_many({"_id": {"$in": chunk}, "updated": {"$lt": now}})
+
+    db[META_COLL].update_one(
+        {"_id": META_ID},
+        {"$set": {"window_start": window_start, "last_day": today, "refreshed_at": now}},
+    )
+    print(f"[{company}] baseline_error_rate : {len(assets)} assets recalculés (incrémental)")
+    return len(assets)
+
+
+# ---------------------------------------------------------------------------
+# Plusieurs compagnies
+# ---------------------------------------------------------------------------
+def refresh_baselines(companies: List[str] | None = None, days: int = BASELINE_DAYS,
+                      mode: str = "incremental",
+                      workers: int = BASELINE_WORKERS) -> Dict[str, str | None]:
+    """Met à jour plusieurs bases en parallèle → {company: erreur ou None}."""
+    run = compute_baseline if mode == "full" else update_baseline
+    companies = companies or list_companies()
+    errors: Dict[str, str | None] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="baseline") as pool:
+        futures = {pool.submit(run, comp, days): comp for comp in companies}
+        for fut in as_completed(futures):
+            comp = futures[fut]
+            exc = fut.exception()
+            errors[comp] = None if exc is None else str(exc)
+            if exc is not None:
+                print(f"[{comp}] échec du baseline : {exc}")
+    return errors
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(
@@ -69,8 +271,13 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--company", "-c",
-        default="ACME",
-        help="Nom de la DB Mongo / compagnie (défaut: ACME)"
+        action="append",
+        help="Nom de la DB Mongo / compagnie, répétable (défaut: ACME)"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Toutes les compagnies (bases contenant network_nodes)"
     )
     parser.add_argument(
         "--days", "-d",
@@ -78,5 +285,18 @@ if __name__ == "__main__":
         default=BASELINE_DAYS,
         help=f"Période en jours pour le calcul du baseline (défaut: {BASELINE_DAYS})"
     )
+    parser.add_argument(
+        "--mode", "-m",
+        choices=("full", "incremental"),
+        default="incremental",
+        help="full : toute la fenêtre ; incremental : nouveaux jours seulement (défaut)"
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=BASELINE_WORKERS,
+        help=f"Compagnies traitées en parallèle (défaut: {BASELINE_WORKERS})"
+    )
     args = parser.parse_args()
-    compute_baseline(args.company, days=args.days)
+    companies = None if args.all else (args.company or ["ACME"])
+    refresh_baselines(companies, days=args.days, mode=args.mode, workers=args.workers)
@@ -1,29 +1,52 @@
 """
 Projection dynamique ZÉRO champ codé en dur
-• Profil d’échantillon basé sur utils.serialize.flatten_doc
+• Profil de schéma stable par (company, collection), voir tools/schema_profile.py
 • Logs : prompt, profil (5 premiers), réponse brute, projection finale
 """
 
 from __future__ import annotations
-import os, json, hashlib, asyncio, datetime, re, pprint
+import os, json, hashlib, asyncio, datetime, re, pprint, unicodedata
 from typing import List, Dict, Any
 from time import perf_counter
 from concurrent.futures import ThreadPoolExecutor
 
-from cachetools import TTLCache
+import diskcache
 from openai import AsyncOpenAI
 from bson import ObjectId
 
-from backend.db import client
-from backend.utils.serialize import flatten_doc   # ← ré-utilise ton helper
+from backend.db import DB_FLEET_WORKERS, afan_out, client, run_db
+from backend.tools.schema_profile import get_profile, fingerprint
+from backend.utils.cache import ByteBudgetCache
+from backend.utils.cursor import encode_signed_cursor, decode_signed_cursor, signing_enabled
 
 # ---------------------------------------------------------------------------
 # Paramètres
 # ---------------------------------------------------------------------------
 _LLM     = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-_CACHE   = TTLCache(maxsize=10_000, ttl=24 * 3600)
 
-N_SAMPLE = int(os.getenv("DYN_PROJ_SAMPLE_SIZE", "50"))
+# Deux niveaux :
+#   • projections choisies par le LLM, par intention normalisée → disque
+#     (partagé entre workers, conservé au redémarrage) ;
+#   • documents résultants, TTL court → mémoire du worker, budget en octets.
+PROJ_DIR   = os.getenv("DYN_PROJ_CACHE_DIR", "/tmp/dyn_projections")
+PROJ_TTL   = int(os.getenv("DYN_PROJ_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_TTL = int(os.getenv("DYN_PROJ_RESULT_TTL", "120"))
+RESULT_BYTES = int(os.getenv("DYN_PROJ_RESULT_BYTES", str(64 * 1024 * 1024)))
+_PROJ      = diskcache.Cache(PROJ_DIR)
+_RESULTS   = ByteBudgetCache("dynamic_results", maxsize=RESULT_BYTES, ttl=RESULT_TTL)
+
+# Multi-bases : bases traitées en parallèle et délai max par base et par étape (s)
+TENANT_CONCURRENCY = int(os.getenv("DYN_PROJ_CONCURRENCY", str(DB_FLEET_WORKERS)))
+TENANT_TIMEOUT     = float(os.getenv("DYN_PROJ_TENANT_TIMEOUT", "30"))
+
+# Pagination (keyset sur _id, plus récents d’abord) : documents par page et
+# par base ; une base en échec est réessayée à la page suivante, au plus
+# TENANT_MAX_FAILS fois de suite, puis abandonnée (signalée dans `errors`)
+PAGE_SIZE = int(os.getenv("DYN_PROJ_PAGE_SIZE", "500"))
+TENANT_MAX_FAILS = int(os.getenv("DYN_PROJ_TENANT_MAX_FAILS", "3"))
+if not signing_enabled():
+    print("[DYN] CURSOR_SECRET absent : requêtes dynamiques limitées à la première page")
+
 MAX_FLD  = int(os.getenv("DYN_PROJ_MAX_FIELDS", "60"))
 MAX_RETN = int(os.getenv("DYN_PROJ_MAX_RETURN", "12"))
 FALLBACK = int(os.getenv("DYN_PROJ_FALLBACK",    "15"))
@@ -34,74 +57,31 @@ FALLBACK = int(os.getenv("DYN_PROJ_FALLBACK",    "15"))
 def _hash(txt: str) -> str:
     return hashlib.sha1(txt.encode()).hexdigest()
 
-def _dtype(val: Any) -> str:
-    if isinstance(val, (int, float)):           return "number"
-    if isinstance(val, datetime.datetime):      return "date"
-    if isinstance(val, str):
-        return "date" if re.match(r"\d{4}-\d{2}-\d{2}", val) else "string"
-    if isinstance(val, list):                   return "array"
-    if isinstance(val, ObjectId):               return "id"
-    return "object"
-
-_digit_re = re.compile(r"^\d+$")
-
-def _normalize_sentence_path(path: str) -> str:
-    """
-    Supprime les segments numériques intermédiaires :
-      analyses.0.description.1.sentence  ->  analyses.description.sentence
-    """
-    parts = [p for p in path.split(".") if not _digit_re.match(p)]
-    return ".".join(parts)
-
-def _collect_sentence_paths(obj, prefix="", out=None):
-    """
-    Parcourt récursivement `obj` (dict ou list) et enregistre tous les
-    chemins qui se terminent par '.sentence', sans indices numériques.
-    """
-    if out is None:
-        out = set()
-
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            new_pref = f"{prefix}.{k}" if prefix else k
-            if k == "sentence":
-                out.add(_normalize_sentence_path(new_pref))       
-            else:
-                _collect_sentence_paths(v, new_pref, out)
-
-    elif isinstance(obj, list):
-        for item in obj:
-            _collect_sentence_paths(item, prefix, out)
-
-    return out
-
-
-
-# ---------------------------------------------------------------------------
-# Profilage d’une collection
-# ---------------------------------------------------------------------------
-def _sample_profile(db: str, coll: str) -> List[Dict[str, Any]]:
-    docs   = list(client[db][coll].aggregate([{"$sample": {"size": N_SAMPLE}}]))
-    total  = len(docs) or 1
-    stats: Dict[str, list[Any]] = {}
-
-    for raw in docs:
-        flat = flatten_doc(raw, sep=".")           # ← SEP = "."
-        for k, v in flat.items():
-            stats.setdefault(k, []).append(v)
-
-        for path in _collect_sentence_paths(raw):
-            stats.setdefault(path, []).append("•")
-
-    prof = [{
-        "name":   k,
-        "type":   _dtype(vals[0]),
-        "freq":   round(len(vals) * 100 / total),
-        "sample": str(vals[0])[:60]
-    } for k, vals in stats.items()]
+_STOPWORDS = {
+    # fr
+    "le", "la", "les", "l", "un", "une", "des", "de", "du", "d", "et", "ou",
+    "pour", "sur", "dans", "avec", "chez", "par", "au", "aux", "a", "en",
+    "moi", "me", "nous", "je", "tu", "il", "est", "sont", "quels", "quelles",
+    "quel", "quelle", "tous", "toutes", "tout", "leur", "leurs", "ce", "ces",
+    "stp", "svp", "merci",
+    # en
+    "the", "a", "an", "of", "for", "on", "in", "with", "at", "by", "to",
+    "and", "or", "me", "us", "all", "please", "what", "which", "are", "is",
+    "from",
+}
 
-    prof.sort(key=lambda d: (-d["freq"], d["name"]))
-    return prof[:MAX_FLD]
+_SYNONYMS = {
+    "montre": "show", "montrer": "show", "affiche": "show", "afficher": "show",
+    "donne": "show", "liste": "show", "lister": "show", "list": "show",
+    "display": "show", "get": "show", "voir": "show",
+    "analysis": "analyses", "analyse": "analyses",
+    "recommandation": "recommendations", "recommandations": "recommendations",
+    "recommendation": "recommendations",
+    "capteur": "sensor", "capteurs": "sensors",
+    "alarme": "alarm", "alarmes": "alarms", "defaut": "fault", "defauts": "faults",
+    "derniers": "last", "dernieres": "last", "dernier": "last", "derniere": "last",
+    "latest": "last", "recent": "last", "recents": "last",
+}
 
 def _merge_profiles(all_prof: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
     freq, typ, samp = {}, {}, {}
@@ -206,17 +186,27 @@ JSON_SCHEMA = {
 # ---------------------------------------------------------------------------
 # Build aggregation pipeline from projection dict
 # ---------------------------------------------------------------------------
-def build_agg_pipeline(match_filter: dict, proj: Dict[str,int]) -> List[dict]:
+def build_agg_pipeline(match_filter: dict, proj: Dict[str,int],
+                       page_size: int | None = None, after: Any = None) -> List[dict]:
     """
     Transforme le dict de projection plat en pipeline d’agrégation
     - garde tous les champs scalaires
     - pour chaque clé en dot-notation finissant par '.sentence',
       génère un array de toutes les phrases (quel que soit le niveau d’imbrication)
     - s’assure que 'asset' est toujours projeté
+    - avec `page_size` : tri stable sur _id décroissant (plus récents
+      d’abord), documents avant `after`, page_size + 1 lignes (la dernière
+      indique qu’il reste une page)
     """
     pipeline: List[dict] = []
+    if after is not None:
+        after_match = {"_id": {"$lt": after}}
+        match_filter = {"$and": [match_filter, after_match]} if match_filter else after_match
     if match_filter:
         pipeline.append({"$match": match_filter})
+    if page_size:
+        pipeline.append({"$sort": {"_id": -1}})
+        pipeline.append({"$limit": page_size + 1})
 
     # 1) On force la présence du champ asset
     proj.setdefault("asset", 1)
@@ -236,6 +226,19 @@ def build_agg_pipeline(match_filter: dict, proj: Dict[str,int]) -> List[dict]:
     return pipeline
 
 
+def _page_len(page_size: int, pos: Dict[str, Any]) -> int:
+    """Documents à lire pour une base : page_size, borné par son reliquat `left`."""
+    return page_size if pos.get("left") is None else min(page_size, pos["left"])
+
+
+def _run_page(db: str, coll: str, match_filter: dict, proj: Dict[str, int],
+              page_size: int, pos: Dict[str, Dict[str, Any]]) -> List[dict]:
+    """Une page pour `db` (avant son dernier _id dans `pos`) ; bloquant."""
+    pipeline = build_agg_pipeline(match_filter, dict(proj),
+                                  _page_len(page_size, pos[db]), pos[db]["id"])
+    return list(client[db][coll].aggregate(pipeline))
+
+
 # ---------------------------------------------------------------------------
 # Appel LLM
 # ---------------------------------------------------------------------------
@@ -330,27 +333,45 @@ async def _ask_llm(profile: list[dict], question: str) -> Dict[str, int]:
     return {k:1 for k,v in raw.items() if v==1}
 
 # ---------------------------------------------------------------------------
-# Mono-DB
+# Projection : cache par intention normalisée (diskcache, partagé)
 # ---------------------------------------------------------------------------
-async def build_dynamic_projection(
-    client_id: str,
-    collection: str,
-    user_query: str,
-    match_filter: dict = None
-) -> List[dict]:
+def _deaccent(txt: str) -> str:
+    txt = unicodedata.normalize("NFKD", txt.lower())
+    return "".join(c for c in txt if not unicodedata.combining(c))
+
+def normalize_intent(question: str, companies: List[str]) -> str:
     """
-    Retourne la liste de documents projetés via aggregation,
-    avec extraction des champs .sentence en tableaux de phrases.
+    Forme canonique d’une question : minuscules sans accents, noms
+    d’entreprise et mots vides retirés, synonymes FR → EN, pluriels
+    simples ramenés au singulier, tokens triés.
+      "Montre les analyses de Cabot" / "show Cabot analyses" → "analyse show"
     """
-    t0      = perf_counter()
-    profile = _sample_profile(client_id, collection)
-    cache_k = _hash(user_query + _hash(json.dumps(profile, sort_keys=True)))
-
-    if cache_k in _CACHE:
-        print(f"[DYN] cache-hit {cache_k[:8]}")
-        return _CACHE[cache_k]
-
-    proj = await _ask_llm(profile, user_query)
+    drop = set(_STOPWORDS)
+    for comp in companies:
+        drop.update(t for t in re.split(r"[\s_\-]+", _deaccent(comp)) if t)
+    out = set()
+    for tok in re.findall(r"[a-z0-9_.]+", _deaccent(question)):
+        if tok in drop:
+            continue
+        tok = _SYNONYMS.get(tok, tok)
+        if len(tok) > 3 and tok.endswith("s") and "." not in tok:
+            tok = tok[:-1]
+        out.add(tok)
+    return " ".join(sorted(out))
+
+
+async def _projection(profile: list[dict], fp: str, collection: str,
+                      question: str, companies: List[str]) -> Dict[str, int]:
+    """Projection en cache pour (intention, collection, empreinte) ; LLM sinon."""
+    intent = normalize_intent(question, companies)
+    key    = _hash(f"{collection}|{fp}|{intent}")
+    cached = _PROJ.get(key)
+    if cached is not None:
+        print(f"[DYN] projection cache-hit {key[:8]} « {intent} »")
+        return dict(cached)
+
+    proj = await _ask_llm(profile, question)
+    from_llm = bool(proj)
     if not proj:
         proj = {d["name"]:1 for d in profile[:FALLBACK]}
         print(f"[DYN] fallback ({len(proj)} champs)")
@@ -361,64 +382,160 @@ async def build_dynamic_projection(
         if fld.endswith(".sentence"):
             proj.setdefault(fld, 1)
 
-    pipeline = build_agg_pipeline(match_filter or {}, proj)
-    docs     = list(client[client_id][collection].aggregate(pipeline))
+    if from_llm:                                  # on ne fige pas un repli
+        _PROJ.set(key, proj, expire=PROJ_TTL)
+    return dict(proj)
 
-    dur = int((perf_counter() - t0)*1000)
-    print(f"[DYN] agg_pipeline {pipeline}")
-    print(f"[DYN] result {len(docs)} docs in {dur}ms")
 
-    _CACHE[cache_k] = docs
-    return docs
+def _start(ids: List[str], limit: int | None) -> Dict[str, Dict[str, Any]]:
+    """Position initiale par base : aucun _id lu, `limit` documents au plus."""
+    return {cid: {"id": None, "left": limit, "fails": 0} for cid in ids}
+
+
+async def _fetch_page(collection: str, proj: Dict[str, int], match_filter: dict,
+                      page_size: int, pos: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Une page par base de `pos` ({base: {id: dernier _id lu ou None, left:
+    documents restants ou None, fails: échecs consécutifs}}), en parallèle
+    (pool "fleet", DYN_PROJ_TENANT_TIMEOUT s par base) →
+    {documents marqués `_company`, next_cursor signé ou None, errors}.
+    Une base en erreur garde sa position dans next_cursor (réessayée) jusqu’à
+    TENANT_MAX_FAILS échecs consécutifs, puis en sort.
+    """
+    res_k = _hash(json.dumps([collection, proj, match_filter, page_size, pos],
+                             sort_keys=True, default=str))
+    cached = _RESULTS.lookup(res_k)
+    if cached is not None:
+        print(f"[DYN] result cache-hit {res_k[:8]}")
+        return {**cached, "documents": list(cached["documents"])}
+
+    per_db: Dict[str, List[dict]] = {}
+    errors: Dict[str, str] = {}
+    async for cid, docs, err in afan_out(list(pos), _run_page, collection, match_filter,
+                                         proj, page_size, pos,
+                                         concurrency=TENANT_CONCURRENCY,
+                                         timeout=TENANT_TIMEOUT):
+        if err is None:
+            per_db[cid] = docs
+        else:
+            errors[cid] = err
+
+    all_docs: List[dict] = []
+    nxt: Dict[str, Any] = {}
+    for cid, p in pos.items():                        # ordre des bases demandé
+        if cid in errors:
+            fails = p["fails"] + 1
+            if fails < TENANT_MAX_FAILS:              # même position : réessayée à la page suivante
+                nxt[cid] = {**p, "fails": fails}
+            else:
+                errors[cid] += f" (abandonnée après {fails} échecs)"
+            continue
+        docs = per_db.get(cid, [])
+        n = _page_len(page_size, p)
+        left = None if p["left"] is None else p["left"] - min(len(docs), n)
+        if len(docs) > n:
+            docs = docs[:n]
+            if left is None or left > 0:
+                nxt[cid] = {"id": docs[-1]["_id"], "left": left, "fails": 0}
+        for d in docs:
+            d["_company"] = cid
+        all_docs.extend(docs)
+
+    out = {
+        "documents":   all_docs,
+        # sans CURSOR_SECRET : première page seulement, pas de jeton forgeable
+        "next_cursor": encode_signed_cursor({
+            "c": collection, "p": proj, "f": match_filter, "n": page_size, "s": nxt,
+        }) if nxt and signing_enabled() else None,
+        "errors":      errors,
+    }
+    if not errors:                                    # jamais de résultat partiel
+        _RESULTS.store(res_k, out)
+    return {**out, "documents": list(all_docs)}
 
 # ---------------------------------------------------------------------------
-# Cross-DB (similaire au mono-DB, on merge profils puis pipeline)
+# Mono-DB
+# ---------------------------------------------------------------------------
+async def build_dynamic_projection(
+    client_id: str,
+    collection: str,
+    user_query: str,
+    match_filter: dict = None,
+    page_size: int = PAGE_SIZE,
+    limit: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Première page (`page_size` documents, plus récents d’abord) projetée via
+    aggregation, avec extraction des champs .sentence en tableaux de
+    phrases → {documents, next_cursor} ; voir next_dynamic_page().
+    `limit` borne le total servi, toutes pages confondues (None = tout).
+    """
+    t0      = perf_counter()
+    profile, fp = await run_db(get_profile, client_id, collection)
+    proj    = await _projection(profile, fp, collection, user_query, [client_id])
+    page    = await _fetch_page(collection, proj, match_filter or {}, page_size,
+                                _start([client_id], limit))
+    if page["errors"]:
+        raise RuntimeError(f"{client_id}.{collection} : {page['errors'][client_id]}")
+
+    dur = int((perf_counter() - t0)*1000)
+    print(f"[DYN] projection {proj}")
+    print(f"[DYN] result {len(page['documents'])} docs in {dur}ms")
+    return page
+
+# ---------------------------------------------------------------------------
+# Cross-DB : profils puis agrégations en parallèle (pool "fleet"), bornés
 # ---------------------------------------------------------------------------
 async def build_dynamic_projection_multi(
     client_ids: List[str],
     collection: str,
     user_query: str,
-    match_filter: dict = None
-) -> List[dict]:
+    match_filter: dict = None,
+    page_size: int = PAGE_SIZE,
+    limit: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Comme build_dynamic_projection sur plusieurs bases (`page_size`
+    documents par page et `limit` au total par base) → {documents marqués `_company`, next_cursor,
+    errors}. Chaque base a DYN_PROJ_TENANT_TIMEOUT s par étape ; une base
+    lente ou en échec est écartée et le reste est renvoyé (résultat
+    partiel, jamais mis en cache).
+    """
     t0 = perf_counter()                         # ← pour le chrono
-    
-    # 1) Profil fusionné
-    profile = _merge_profiles([
-        _sample_profile(db, collection) for db in client_ids
-    ])
-    cache_k = _hash(user_query + _hash(json.dumps(profile, sort_keys=True)))
-
-    # -- A) Early-cache (comme en mono-DB) -------------------------------
-    if cache_k in _CACHE:
-        print(f"[DYN-M] cache-hit {cache_k[:8]}")
-        return _CACHE[cache_k]
-    # -------------------------------------------------------------------
-
-    # 2) Projection choisie par le LLM
-    proj = await _ask_llm(profile, user_query)
-    if not proj:
-        proj = {d["name"]: 1 for d in profile[:FALLBACK]}
-        print(f"[DYN-M] fallback ({len(proj)} champs)")
-
-    # -- B) Injection de TOUTES les clés *.sentence ----------------------
-    for fld in (d["name"] for d in profile):
-        if fld.endswith(".sentence"):
-            proj.setdefault(fld, 1)
-    # -------------------------------------------------------------------
+    errors: Dict[str, str] = {}
+
+    # 1) Profils en parallèle, fusionnés dans l’ordre de client_ids
+    profiles: Dict[str, list] = {}
+    async for cid, res, err in afan_out(client_ids, get_profile, collection,
+                                        concurrency=TENANT_CONCURRENCY,
+                                        timeout=TENANT_TIMEOUT):
+        if err is None:
+            profiles[cid] = res[0]
+        else:
+            errors[cid] = err
+    ok_ids  = [cid for cid in client_ids if cid in profiles]
+    if not ok_ids:
+        return {"documents": [], "next_cursor": None, "errors": errors}
+    profile = _merge_profiles([profiles[cid] for cid in ok_ids])
 
-    # 3) Exécution parallèle sur chaque base
-    all_docs: List[dict] = []
-    for cid in client_ids:
-        pipeline = build_agg_pipeline(match_filter or {}, proj)
-        docs = list(client[cid][collection].aggregate(pipeline))
-        for d in docs:
-            d["_company"] = cid
-        all_docs.extend(docs)
+    # 2) Projection (cache par intention, LLM sinon)
+    proj = await _projection(profile, fingerprint(profile), collection,
+                             user_query, client_ids)
 
-    # 4) Cache + retour
-    _CACHE[cache_k] = all_docs
+    # 3) Première page de chaque base, en parallèle
+    page = await _fetch_page(collection, proj, match_filter or {}, page_size,
+                             _start(ok_ids, limit))
+    page["errors"] = {**errors, **page["errors"]}
 
     dur = int((perf_counter() - t0) * 1000)      # ← petit log optionnel
-    print(f"[DYN-M] result {len(all_docs)} docs in {dur}ms")
+    print(f"[DYN-M] result {len(page['documents'])} docs in {dur}ms"
+          + (f", {len(page['errors'])} base(s) en échec" if page["errors"] else ""))
+    return page
 
-    return all_docs
+# ---------------------------------------------------------------------------
+# Pages suivantes
+# ---------------------------------------------------------------------------
+async def next_dynamic_page(cursor: str) -> Dict[str, Any]:
+    """Page suivante d’une requête dynamique (ValueError si jeton invalide)."""
+    st = decode_signed_cursor(cursor)
+    return await _fetch_page(st["c"], st["p"], st["f"], st["n"], st["s"])
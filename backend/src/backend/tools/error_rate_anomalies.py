@@ -0,0 +1,132 @@
+# app/tools/error_rate_anomalies.py
+"""
+Assets dont le taux d’erreur récent s’écarte le plus de leur taux nominal
+p₀, calculé depuis `baseline_daily` (voir tools/baseline.py) sur les jours
+ANTÉRIEURS à la fenêtre testée : p₀ n’absorbe pas l’anomalie elle-même.
+
+Pour chaque asset ayant des statistiques dans les `hours` dernières heures :
+    n = exécutions, k = exécutions en erreur
+    p-valeur exacte : P(X ≥ k), X ~ Binomiale(n, p₀)
+p₀ est lissé ((k₀ + 1) / (n₀ + 2)) pour qu’un asset sans erreur historique
+ait une variance non nulle. Un seul parcours indexé de `statistics`
+(idx_acqend), jointure sur `baseline_daily` (idx_asset_day) ; MongoDB ne
+garde que les candidats (k > n·p₀), la queue binomiale est sommée en
+Python (n termes au plus par asset) et le classement se fait sur elle —
+le z de l’approximation normale, trompeur quand n·p₀ est petit, n’est
+plus qu’indicatif.
+
+Usage CLI :
+    python -m backend.tools.error_rate_anomalies --company MA_COMPAGNIE --hours 24
+"""
+
+import math
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+from backend.db import client
+from backend.tools.baseline import DAILY_COLL
+
+# ── Valeurs par défaut ───────────────────────────────────────
+ANOMALY_HOURS    = 24
+ANOMALY_LIMIT    = 10
+ANOMALY_MIN_RUNS = 5          # exécutions minimales dans la fenêtre récente
+ANOMALY_MAX_P    = 0.0015     # ≈ z ≥ 3 (unilatéral)
+
+
+def build_anomaly_pipeline(since: datetime, min_runs: int) -> list[dict]:
+    """Candidats (k > n·p₀) avec leurs comptes récents et de référence."""
+    # jours entiers de baseline_daily strictement avant la fenêtre testée
+    cut = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        {"$match": {"acqend": {"$gte": since}, "asset": {"$exists": True, "$ne": None}}},
+        {"$group": {
+            "_id": "$asset",
+            "n":   {"$sum": 1},
+            "k":   {"$sum": {"$cond": [{"$gt": ["$log.errcode", 0]}, 1, 0]}},
+        }},
+        {"$match": {"n": {"$gte": min_runs}, "k": {"$gt": 0}}},
+
+        {"$lookup": {"from": DAILY_COLL, "localField": "_id", "foreignField": "asset",
+                     "pipeline": [
+                         {"$match": {"day": {"$lt": cut}}},
+                         {"$group": {"_id": None, "n": {"$sum": "$n"}, "k": {"$sum": "$k"}}},
+                     ],
+                     "as": "b"}},
+        {"$unwind": "$b"},
+        {"$addFields": {
+            "p0":  {"$divide": [{"$add": ["$b.k", 1]}, {"$add": ["$b.n", 2]}]},
+            "rate": {"$divide": ["$k", "$n"]},
+        }},
+        {"$match": {"$expr": {"$gt": ["$rate", "$p0"]}}},
+        {"$project": {
+            "_id": 0,
+            "asset_id":   "$_id",
+            "runs":       "$n",
+            "errors":     "$k",
+            "rate":       1,
+            "p0":         1,
+            "expected":   {"$multiply": ["$n", "$p0"]},
+            "baseline_n": "$b.n",
+        }},
+    ]
+
+
+def binom_sf(k: int, n: int, p: float) -> float:
+    """P(X ≥ k) pour X ~ Binomiale(n, p), sommée en log (0 < p < 1)."""
+    if k <= 0:
+        return 1.0
+    if k > n:
+        return 0.0
+    lp, lq = math.log(p), math.log1p(-p)
+    lc = math.lgamma(n + 1)
+    terms = [lc - math.lgamma(j + 1) - math.lgamma(n - j + 1) + j * lp + (n - j) * lq
+             for j in range(k, n + 1)]
+    top = max(terms)
+    return min(1.0, math.exp(top) * sum(math.exp(t - top) for t in terms))
+
+
+def error_rate_anomalies(
+    company: str,
+    hours: int = ANOMALY_HOURS,
+    limit: int = ANOMALY_LIMIT,
+    min_runs: int = ANOMALY_MIN_RUNS,
+    max_p: float = ANOMALY_MAX_P,
+) -> Dict[str, Any]:
+    """Top-`limit` des assets au taux d’erreur récent le plus improbable sous p₀."""
+    db = client[company]
+    since = datetime.utcnow() - timedelta(hours=hours)
+    rows = []
+    for r in db["statistics"].aggregate(build_anomaly_pipeline(since, min_runs), allowDiskUse=True):
+        r["p_value"] = binom_sf(r["errors"], r["runs"], r["p0"])
+        if r["p_value"] <= max_p:
+            r["z"] = (r["errors"] - r["expected"]) / math.sqrt(r["expected"] * (1 - r["p0"]))
+            rows.append(r)
+    rows.sort(key=lambda r: (r["p_value"], -r["z"], str(r["asset_id"])))
+    rows = rows[:limit]
+
+    names = {a["_id"]: a.get("name") for a in
+             db["assets"].find({"_id": {"$in": [r["asset_id"] for r in rows]}}, {"name": 1})}
+    for r in rows:
+        r["name"] = names.get(r["asset_id"])
+    return {
+        "company":   company,
+        "hours":     hours,
+        "anomalies": rows,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Assets au taux d’erreur anormal (vs baseline_daily)"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    parser.add_argument("--hours", type=int, default=ANOMALY_HOURS,
+                        help=f"Fenêtre récente en heures (défaut: {ANOMALY_HOURS})")
+    parser.add_argument("--limit", "-k", type=int, default=ANOMALY_LIMIT)
+    args = parser.parse_args()
+    res = error_rate_anomalies(args.company, hours=args.hours, limit=args.limit)
+    for r in res["anomalies"]:
+        print(f"{r['asset_id']}  {r['name']}  {r['errors']}/{r['runs']}  "
+              f"p0={r['p0']:.3f}  p={r['p_value']:.1e}")
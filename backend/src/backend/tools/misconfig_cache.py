@@ -0,0 +1,201 @@
+# app/tools/misconfig_cache.py
+"""
+Cache des résultats de detect_misconfig.
+
+Clé : (company, since_days, last_n, freq_threshold, engine). Chaque entrée
+garde le filigrane des données au moment du calcul (plus grand
+`statistics.acqend`, lu via l’index idx_acqend) :
+
+• filigrane identique et entrée de moins de MISCONFIG_CACHE_FRESH s
+  → servie telle quelle ;
+• nouvelles statistiques, ou entrée plus ancienne (la fenêtre glisse)
+  → servie quand même (stale-while-revalidate) et recalculée en
+  arrière-plan, un seul recalcul par clé à la fois ;
+• aucune entrée → calcul synchrone.
+
+Niveau 1 : ByteBudgetCache (MISCONFIG_CACHE_BYTES octets, par worker).
+Niveau 2 (optionnel, MISCONFIG_CACHE_DIR) : diskcache partagé entre workers
+et conservé au redémarrage.
+
+Coordination entre workers, dans le diskcache partagé s’il est configuré,
+sinon dans `misconfig_cache_meta` (base de la compagnie) :
+• génération par compagnie : chaque entrée retient celle de son calcul ;
+  `invalidate_misconfig_cache()` l’incrémente, et toute entrée d’une
+  génération antérieure (y compris dans le niveau 1 des autres workers)
+  est ignorée ;
+• bail de recalcul par clé (MISCONFIG_CACHE_LEASE s) : un seul
+  stale-while-revalidate à la fois sur l’ensemble des workers.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Tuple
+
+import diskcache
+from pymongo import DESCENDING, errors
+
+from backend.db import client, list_companies
+from backend.utils.cache import ByteBudgetCache
+
+# ── Paramètres ───────────────────────────────────────────────
+MISCONFIG_CACHE_BYTES = int(os.getenv("MISCONFIG_CACHE_BYTES", str(64 * 2**20)))   # octets / worker
+MISCONFIG_CACHE_TTL   = int(os.getenv("MISCONFIG_CACHE_TTL", "86400"))     # s, durée de vie max
+MISCONFIG_CACHE_FRESH = int(os.getenv("MISCONFIG_CACHE_FRESH", "300"))     # s avant revalidation
+MISCONFIG_CACHE_DIR   = os.getenv("MISCONFIG_CACHE_DIR", "")               # vide = pas de disque
+MISCONFIG_CACHE_DISK_BYTES = int(os.getenv("MISCONFIG_CACHE_DISK_BYTES", str(512 * 2**20)))
+MISCONFIG_CACHE_LEASE = int(os.getenv("MISCONFIG_CACHE_LEASE", "600"))     # s, bail de recalcul
+META_COLL = "misconfig_cache_meta"
+
+Key = Tuple[str, int, int, int, str]
+
+_MEM = ByteBudgetCache("misconfig_results", maxsize=MISCONFIG_CACHE_BYTES, ttl=MISCONFIG_CACHE_TTL)
+_DISK = (diskcache.Cache(MISCONFIG_CACHE_DIR, size_limit=MISCONFIG_CACHE_DISK_BYTES)
+         if MISCONFIG_CACHE_DIR else None)
+
+_REFRESH  = ThreadPoolExecutor(max_workers=2, thread_name_prefix="misconfig-swr")
+_INFLIGHT: set = set()
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def watermark(company: str) -> Any:
+    """Plus grand `statistics.acqend` (None si aucune statistique)."""
+    last = client[company]["statistics"].find_one(
+        {}, {"acqend": 1, "_id": 0}, sort=[("acqend", DESCENDING)]
+    )
+    return (last or {}).get("acqend")
+
+
+def _copy(res: Dict[str, Any]) -> Dict[str, Any]:
+    """Les appelants annotent `items` (company, _company…) : copie superficielle."""
+    return {**res, "items": [dict(it) for it in res["items"]]}
+
+
+# ---------------------------------------------------------------------------
+# Génération / bail partagés (diskcache, sinon MongoDB)
+# ---------------------------------------------------------------------------
+def _generation(company: str) -> int:
+    if _DISK is not None:
+        return _DISK.get(("__gen__", company), 0)
+    doc = client[company][META_COLL].find_one({"_id": "gen"}, {"gen": 1})
+    return (doc or {}).get("gen", 0)
+
+
+def _bump_generation(company: str) -> None:
+    if _DISK is not None:
+        _DISK.incr(("__gen__", company), default=0)        # atomique entre processus
+    else:
+        client[company][META_COLL].update_one({"_id": "gen"}, {"$inc": {"gen": 1}}, upsert=True)
+
+
+def _lease_id(key: Key) -> str:
+    return "lease:" + ":".join(map(str, key[1:]))
+
+
+def _acquire_lease(key: Key, owner: str) -> bool:
+    """Bail de recalcul de `key` ; False s’il est tenu par un autre worker."""
+    if _DISK is not None:
+        return _DISK.add(("__lease__", key), owner, expire=MISCONFIG_CACHE_LEASE)
+    now = datetime.utcnow()
+    try:
+        client[key[0]][META_COLL].update_one(
+            {"_id": _lease_id(key), "expires": {"$lt": now}},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=MISCONFIG_CACHE_LEASE)}},
+            upsert=True,
+        )
+    except errors.DuplicateKeyError:
+        return False            # bail vivant d’un autre worker
+    return True
+
+
+def _release_lease(key: Key, owner: str) -> None:
+    if _DISK is not None:
+        if _DISK.get(("__lease__", key)) == owner:
+            _DISK.delete(("__lease__", key))
+    else:
+        client[key[0]][META_COLL].delete_one({"_id": _lease_id(key), "owner": owner})
+
+
+# ---------------------------------------------------------------------------
+# Lecture / écriture
+# ---------------------------------------------------------------------------
+def _load(key: Key, gen: int) -> Dict[str, Any] | None:
+    entry = _MEM.lookup(key)
+    if entry is None and _DISK is not None:
+        entry = _DISK.get(key)
+        if entry is not None:
+            _MEM.store(key, entry)
+    if entry is not None and entry.get("gen") != gen:
+        return None             # invalidée (peut-être par un autre worker)
+    return entry
+
+
+def _save(key: Key, entry: Dict[str, Any]) -> None:
+    _MEM.store(key, entry)
+    if _DISK is not None:
+        _DISK.set(key, entry, expire=MISCONFIG_CACHE_TTL)
+
+
+def _compute(key: Key, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    # génération et filigrane lus avant le calcul : une invalidation pendant
+    # le calcul rend l’entrée caduque, au pire un recalcul de trop
+    gen = _generation(key[0])
+    wm = watermark(key[0])
+    entry = {"watermark": wm, "gen": gen, "computed_at": time.time(), "result": compute()}
+    _save(key, entry)
+    return entry
+
+
+def _revalidate(key: Key, compute: Callable[[], Dict[str, Any]]) -> None:
+    with _INFLIGHT_LOCK:
+        if key in _INFLIGHT:
+            return
+        _INFLIGHT.add(key)
+
+    def job():
+        owner = uuid.uuid4().hex
+        try:
+            if not _acquire_lease(key, owner):
+                return              # déjà recalculée par un autre worker
+            try:
+                _compute(key, compute)
+            finally:
+                _release_lease(key, owner)
+        except Exception:
+            logging.exception(f"misconfig_cache: échec du recalcul pour {key}")
+        finally:
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.discard(key)
+
+    _REFRESH.submit(job)
+
+
+def cached_misconfig(key: Key, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Résultat en cache pour `key`, `compute()` si absent (voir docstring du module)."""
+    entry = _load(key, _generation(key[0]))
+    if entry is None:
+        return _copy(_compute(key, compute)["result"])
+
+    fresh = time.time() - entry["computed_at"] < MISCONFIG_CACHE_FRESH
+    if not fresh or entry["watermark"] != watermark(key[0]):
+        _revalidate(key, compute)
+    return _copy(entry["result"])
+
+
+def invalidate_misconfig_cache(company: str | None = None) -> int:
+    """
+    Invalide les entrées d’une compagnie (ou toutes) pour tous les workers
+    (génération incrémentée) ; renvoie le nb d’entrées mémoire de ce worker.
+    """
+    for comp in ([company] if company is not None else list_companies()):
+        _bump_generation(comp)
+    n = _MEM.invalidate(lambda k: company is None or k[0] == company)
+    if _DISK is not None:
+        for k in list(_DISK.iterkeys()):
+            if len(k) == 5 and (company is None or k[0] == company):
+                _DISK.delete(k)
+    return n
@@ -0,0 +1,379 @@
+# app/tools/misconfig_state.py
+"""
+État de configuration par asset, maintenu incrémentalement
+(`misconfig_state`, un document par asset, _id = asset) :
+
+    last            : [{acqend, errcode}, …]  STATE_KEEP dernières stats, récentes d’abord
+    last_acq        : acqend le plus récent
+    consec          : erreurs consécutives depuis la dernière stat
+    misconfigured   : drapeau avec les paramètres par défaut (last_n=10, seuil 3)
+    has_task        : l’asset a au moins une task (même périmètre que le pipeline)
+    asset_found     : l’asset existe dans `assets`
+    transmitter / transmitterName
+
+`misconfig_state_meta` (_id = "meta") garde `hwm_id` (plus grand `_id` de
+`statistics` intégré), `horizon` (plus ancien acqend couvert), `refreshed_at`
+et `full_at`.
+
+Les `statistics` insérées depuis le dernier passage (`_id` ≥ hwm_id, moins
+STATE_ID_SLACK s pour les ObjectId générés par des horloges décalées) sont
+fusionnées dans l’état des assets concernés, quel que soit leur `acqend` :
+une statistique remontée en retard par une gateway est intégrée au passage
+suivant. `detect_misconfig(engine="state")` devient une lecture indexée de
+`misconfig_state` suivie des mêmes règles / facets que le pipeline
+« lookup ». Filet de sécurité : reconstruction complète toutes les
+STATE_FULL_EVERY s.
+
+Un seul écrivain par entreprise : bail (`_id = "lease"` dans
+misconfig_state_meta, STATE_LEASE_TTL s, renouvelé à chaque lot du rebuild)
+pris par refresh_state et rebuild_state ; les autres workers passent leur tour.
+
+Usage CLI :
+    python -m backend.tools.misconfig_state --company MA_COMPAGNIE [--full]
+"""
+
+import os
+import uuid
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List
+
+from bson import ObjectId
+from pymongo import UpdateOne, errors
+
+from backend.db import client
+
+# ── Paramètres ───────────────────────────────────────────────
+STATE_COLL      = "misconfig_state"
+META_COLL       = "misconfig_state_meta"
+META_ID         = "meta"
+LEASE_ID        = "lease"
+STATE_KEEP      = int(os.getenv("MISCONFIG_STATE_KEEP", "50"))       # stats gardées / asset
+STATE_DAYS      = int(os.getenv("MISCONFIG_STATE_DAYS", "90"))       # profondeur du rebuild
+STATE_MAX_AGE   = int(os.getenv("MISCONFIG_STATE_MAX_AGE", "900"))   # s, au-delà → pipeline lookup
+STATE_FULL_EVERY = int(os.getenv("MISCONFIG_STATE_FULL_EVERY", str(6 * 3600)))  # s entre deux rebuilds
+STATE_ID_SLACK  = int(os.getenv("MISCONFIG_STATE_ID_SLACK", "300"))   # s relus avant hwm_id
+STATE_LEASE_TTL = int(os.getenv("MISCONFIG_STATE_LEASE_TTL", "120"))  # s, durée du bail écrivain
+DEFAULT_LAST_N, DEFAULT_FREQ = 10, 3
+BATCH_SIZE      = 1_000
+
+
+# ---------------------------------------------------------------------------
+# Règles (mêmes définitions que misconfiguration._rule_stages)
+# ---------------------------------------------------------------------------
+def _rules(errcodes: List[int], freq_threshold: int) -> Dict[str, Any]:
+    """errcodes (récents d’abord) → freq_err, last_errcode, consec, misconfigured."""
+    consec = 0
+    for e in errcodes:
+        if e == 0:
+            break
+        consec += 1
+    last = errcodes[0] if errcodes else 0
+    consec_errs = len(errcodes) >= 2 and errcodes[0] > 0 and errcodes[1] > 0
+    return {
+        "freq_err":      sum(1 for e in errcodes if e > 0),
+        "last_errcode":  last,
+        "consec":        consec,
+        "misconfigured": _severity(last) == "Critical" or consec_errs or consec >= freq_threshold,
+    }
+
+
+def _severity(code: int) -> str:
+    from backend.tools.misconfiguration import ERR_META   # import local (cycle)
+    return ERR_META.get(code, {}).get("severity", "Unknown")
+
+
+# ---------------------------------------------------------------------------
+# Enrichissement asset / transmitter (par lot)
+# ---------------------------------------------------------------------------
+def _as_object_id(raw: Any) -> ObjectId | None:
+    if isinstance(raw, ObjectId):
+        return raw
+    if isinstance(raw, str) and ObjectId.is_valid(raw):
+        return ObjectId(raw)
+    return None
+
+
+def enrich_assets(db, asset_ids: List[Any]) -> Dict[Any, Dict[str, Any]]:
+    """has_task, asset_found, transmitter, transmitterName pour un lot d’assets."""
+    with_task = set(db["tasks"].distinct("asset", {"asset": {"$in": asset_ids}}))
+    assets = {a["_id"]: a for a in db["assets"].find(
+        {"_id": {"$in": asset_ids}}, {"optionals.transmitter": 1})}
+    tx_ids = {_as_object_id((a.get("optionals") or {}).get("transmitter")) for a in assets.values()}
+    tx_ids.discard(None)
+    tx_names = {t["_id"]: t.get("name") for t in db["assets"].find(
+        {"_id": {"$in": list(tx_ids)}}, {"name": 1})}
+
+    out = {}
+    for _id in asset_ids:
+        a = assets.get(_id)
+        tx = _as_object_id(((a or {}).get("optionals") or {}).get("transmitter"))
+        out[_id] = {
+            "has_task":        _id in with_task,
+            "asset_found":     a is not None,
+            "transmitter":     tx,
+            "transmitterName": tx_names.get(tx),
+        }
+    return out
+
+
+def _state_doc(last: List[Dict[str, Any]], extra: Dict[str, Any]) -> Dict[str, Any]:
+    r = _rules([s["errcode"] for s in last[:DEFAULT_LAST_N]], DEFAULT_FREQ)
+    return {
+        "last":          last,
+        "last_acq":      last[0]["acqend"] if last else None,
+        "consec":        r["consec"],
+        "misconfigured": r["misconfigured"],
+        "updated_at":    datetime.utcnow(),
+        **extra,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Bail écrivain (même protocole que sensor_rollup)
+# ---------------------------------------------------------------------------
+def _acquire_lease(company: str, owner: str, ttl: int = STATE_LEASE_TTL) -> bool:
+    """Prend (ou prolonge) le bail ; False s’il est tenu par un autre écrivain."""
+    now = datetime.utcnow()
+    try:
+        client[company][META_COLL].update_one(
+            {"_id": LEASE_ID, "$or": [{"owner": owner}, {"expires": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+    except errors.DuplicateKeyError:
+        return False            # bail vivant d’un autre écrivain
+    return True
+
+
+def _release_lease(company: str, owner: str) -> None:
+    client[company][META_COLL].delete_one({"_id": LEASE_ID, "owner": owner})
+
+
+def _leased(company: str, fn, *args) -> int:
+    """Exécute fn(company, owner, *args) sous le bail ; 0 s’il est tenu ailleurs."""
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(company, owner):
+        logging.info(f"misconfig_state({company}) : bail tenu par un autre écrivain, passage ignoré")
+        return 0
+    try:
+        return fn(company, owner, *args)
+    finally:
+        _release_lease(company, owner)
+
+
+# ---------------------------------------------------------------------------
+# Application d’un lot de statistiques
+# ---------------------------------------------------------------------------
+def apply_stats(company: str, stats: Iterable[Dict[str, Any]]) -> int:
+    """
+    Fusionne des statistiques {_id, asset, acqend, log.errcode} dans l’état.
+    Idempotent : une stat déjà intégrée (même asset, même acqend) est ignorée.
+    Renvoie le nombre d’assets mis à jour.
+    """
+    db = client[company]
+    by_asset: Dict[Any, Dict[datetime, int]] = defaultdict(dict)
+    hwm_id = None
+    for st in stats:
+        if st.get("_id") is not None and (hwm_id is None or st["_id"] > hwm_id):
+            hwm_id = st["_id"]
+        acq = st.get("acqend")
+        if st.get("asset") is None or not isinstance(acq, datetime):
+            continue
+        by_asset[st["asset"]][acq] = (st.get("log") or {}).get("errcode") or 0
+    if not by_asset:
+        return 0
+
+    ids = list(by_asset)
+    old = {d["_id"]: d.get("last", []) for d in db[STATE_COLL].find(
+        {"_id": {"$in": ids}}, {"last": 1})}
+    extra = enrich_assets(db, ids)
+
+    ops = []
+    for _id, fresh in by_asset.items():
+        merged = {s["acqend"]: s["errcode"] for s in old.get(_id, [])}
+        merged.update(fresh)
+        last = [{"acqend": a, "errcode": merged[a]}
+                for a in sorted(merged, reverse=True)[:STATE_KEEP]]
+        ops.append(UpdateOne({"_id": _id}, {"$set": _state_doc(last, extra[_id])}, upsert=True))
+    db[STATE_COLL].bulk_write(ops, ordered=False)
+
+    update: Dict[str, Any] = {"$set": {"refreshed_at": datetime.utcnow()}}
+    if hwm_id is not None:
+        update["$max"] = {"hwm_id": hwm_id}
+    db[META_COLL].update_one({"_id": META_ID}, update, upsert=True)
+    return len(ops)
+
+
+# ---------------------------------------------------------------------------
+# Reconstruction complète / rafraîchissement incrémental
+# ---------------------------------------------------------------------------
+STAT_PROJ = {"_id": 1, "asset": 1, "acqend": 1, "log.errcode": 1}
+
+
+def rebuild_state(company: str, days: int = STATE_DAYS) -> int:
+    """
+    Recalcule l’état de tous les assets sur les `days` derniers jours.
+    Renvoie le nombre d’assets, 0 si un autre écrivain tient le bail.
+    """
+    return _leased(company, _rebuild, days)
+
+
+def _rebuild(company: str, owner: str, days: int) -> int:
+    db = client[company]
+    horizon = datetime.utcnow() - timedelta(days=days)
+    # lu avant le parcours : ce qui arrive pendant sera relu par l’incrémental
+    last = db["statistics"].find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    hwm_id = (last or {}).get("_id")
+    # construit à côté puis renommé : les lecteurs ne voient jamais un état vide
+    tmp = db[f"{STATE_COLL}_rebuild"]
+    tmp.drop()
+
+    cur = db["statistics"].aggregate([
+        {"$match": {"acqend": {"$gte": horizon}}},
+        {"$group": {
+            "_id": "$asset",
+            "last": {"$topN": {
+                "n": STATE_KEEP,
+                "sortBy": {"acqend": -1},
+                "output": {"acqend": "$acqend", "errcode": {"$ifNull": ["$log.errcode", 0]}},
+            }},
+        }},
+    ], allowDiskUse=True, batchSize=BATCH_SIZE)
+
+    n, batch = 0, []
+
+    def flush():
+        # bail perdu → un autre écrivain peut vider `tmp` : on abandonne
+        if not _acquire_lease(company, owner):
+            raise RuntimeError(f"misconfig_state({company}) : bail perdu pendant le rebuild")
+        extra = enrich_assets(db, [d["_id"] for d in batch])
+        tmp.insert_many(
+            [{"_id": d["_id"], **_state_doc(d["last"], extra[d["_id"]])} for d in batch],
+            ordered=False,
+        )
+
+    for d in cur:
+        if d["_id"] is None:
+            continue
+        batch.append(d)
+        if len(batch) >= BATCH_SIZE:
+            flush()
+            n += len(batch)
+            batch = []
+    if batch:
+        flush()
+        n += len(batch)
+
+    if n:
+        if not _acquire_lease(company, owner):
+            raise RuntimeError(f"misconfig_state({company}) : bail perdu pendant le rebuild")
+        tmp.create_index([("last_acq", 1)], name="idx_lastacq")
+        tmp.rename(STATE_COLL, dropTarget=True)
+    else:
+        db[STATE_COLL].drop()
+    now = datetime.utcnow()
+    db[META_COLL].replace_one(
+        {"_id": META_ID},
+        {"hwm_id": hwm_id, "horizon": horizon, "refreshed_at": now, "full_at": now},
+        upsert=True,
+    )
+    print(f"[{company}] misconfig_state reconstruit ({n} assets)")
+    return n
+
+
+def _needs_rebuild(meta: Dict[str, Any] | None) -> bool:
+    if not meta or meta.get("hwm_id") is None or meta.get("full_at") is None:
+        return True
+    return (datetime.utcnow() - meta["full_at"].replace(tzinfo=None)).total_seconds() > STATE_FULL_EVERY
+
+
+def _since_filter(hwm_id: Any) -> Dict[str, Any]:
+    """`_id` ≥ hwm_id, élargi de STATE_ID_SLACK s pour les ObjectId."""
+    if isinstance(hwm_id, ObjectId):
+        hwm_id = ObjectId.from_datetime(hwm_id.generation_time - timedelta(seconds=STATE_ID_SLACK))
+    return {"_id": {"$gte": hwm_id}}
+
+
+def refresh_state(company: str, full: bool = False) -> int:
+    """
+    Intègre les statistiques insérées depuis le dernier passage (rebuild si
+    l’état n’existe pas encore, si `full` ou s’il date de plus de
+    STATE_FULL_EVERY s). Renvoie le nombre d’assets mis à jour, 0 si un
+    autre écrivain tient le bail.
+    """
+    return _leased(company, _refresh, full)
+
+
+def _refresh(company: str, owner: str, full: bool) -> int:
+    db = client[company]
+    meta = db[META_COLL].find_one({"_id": META_ID})
+    if full or _needs_rebuild(meta):
+        return _rebuild(company, owner, STATE_DAYS)
+
+    cur = (db["statistics"].find(_since_filter(meta["hwm_id"]), STAT_PROJ)
+                           .batch_size(BATCH_SIZE))
+    n, batch = 0, []
+    for st in cur:
+        batch.append(st)
+        if len(batch) >= BATCH_SIZE:
+            n += apply_stats(company, batch)
+            batch = []
+    n += apply_stats(company, batch)
+    if not n:
+        db[META_COLL].update_one({"_id": META_ID}, {"$set": {"refreshed_at": datetime.utcnow()}})
+    return n
+
+
+# ---------------------------------------------------------------------------
+# Lecture
+# ---------------------------------------------------------------------------
+def state_ready(company: str, cutoff: datetime, last_n: int,
+                max_age: int = STATE_MAX_AGE) -> bool:
+    """
+    L’état couvre-t-il la requête (fenêtre et last_n) et date-t-il de moins
+    de `max_age` s ? False → pipeline lookup. Jamais de rafraîchissement
+    ici : c’est le rôle de la tâche de fond (main.py) ou du CLI.
+    """
+    meta = client[company][META_COLL].find_one({"_id": META_ID})
+    if not meta or meta.get("horizon") is None or last_n > STATE_KEEP:
+        return False
+    if cutoff < meta["horizon"]:
+        return False
+    age = (datetime.utcnow() - meta["refreshed_at"]).total_seconds()
+    return age <= max_age
+
+
+def state_head_stages(cutoff: datetime, last_n: int) -> list[dict]:
+    """Tête « state » : misconfig_state → `lastStats` (même forme que le $lookup)."""
+    return [
+        {"$match": {"last_acq": {"$gte": cutoff}, "has_task": True, "asset_found": True}},
+        {"$addFields": {
+            "asset": "$_id",
+            "lastStats": {"$map": {
+                "input": {"$slice": [
+                    {"$filter": {"input": "$last", "as": "s",
+                                 "cond": {"$gte": ["$$s.acqend", cutoff]}}},
+                    last_n,
+                ]},
+                "as": "s",
+                "in": {"acqend": "$$s.acqend", "log": {"errcode": "$$s.errcode"}},
+            }},
+        }},
+        {"$project": {"last": 0}},
+    ]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Met à jour misconfig_state pour une compagnie donnée"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    parser.add_argument("--full", action="store_true",
+                        help="Reconstruction complète au lieu de l’incrémental")
+    args = parser.parse_args()
+    n = refresh_state(args.company, full=args.full)
+    print(f"[{args.company}] {n} assets mis à jour")
@@ -0,0 +1,278 @@
+# app/tools/misconfig_vector.py
+"""
+Moteur « numpy » de detect_misconfig : MongoDB ne fait que lire.
+
+• `statistics` est lue en flux (acqend ≥ cutoff) par un find() projeté
+  sur (asset, acqend, log.errcode), trié selon l’index idx_asset_acqend et
+  en gros batchs : aucun $group côté serveur ;
+• les colonnes sont construites côté client dans trois tableaux NumPy
+  (asset internée en entier, acqend en datetime64[ms], errcode) ;
+• `score_arrays` évalue les règles avec des opérations groupées
+  vectorisées : rang par asset, freq_err, erreurs consécutives, dernier
+  errcode et sévérité via une table de correspondance construite depuis
+  `load_err_meta()`.
+
+Au-delà de MISCONFIG_SCORER_MIN_ROWS lignes, le scoring peut être découpé
+en MISCONFIG_SCORER_PROCS tranches d’assets contiguës, scorées en parallèle
+dans un pool de processus (spawn, arrêté par `shutdown_pool`) puis recollées. Les assets retenus sont ensuite
+enrichis par lots (task, asset, transmitter) et mis en forme comme les
+facets du pipeline.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List
+
+import numpy as np
+
+from backend.db import client
+from backend.utils.error_meta import load_err_meta
+
+# ── Paramètres ───────────────────────────────────────────────
+STREAM_BATCH      = int(os.getenv("MISCONFIG_STREAM_BATCH", "50000"))
+SCORER_PROCS      = int(os.getenv("MISCONFIG_SCORER_PROCS", "0"))          # 0 = en-process
+SCORER_MIN_ROWS   = int(os.getenv("MISCONFIG_SCORER_MIN_ROWS", "1000000"))
+ENRICH_BATCH      = 5_000
+
+
+# ── Table de sévérité : errcode → indice dans SEVERITIES ───────────────
+ERR_META   = load_err_meta()
+SEVERITIES = sorted({m.get("severity", "Unknown") for m in ERR_META.values()} | {"Unknown"})
+UNKNOWN    = SEVERITIES.index("Unknown")
+CRITICAL   = SEVERITIES.index("Critical") if "Critical" in SEVERITIES else -1
+SEVERITY_LUT = np.full(max(ERR_META, default=0) + 1, UNKNOWN, dtype=np.int8)
+for _code, _meta in ERR_META.items():
+    if _code >= 0:
+        SEVERITY_LUT[_code] = SEVERITIES.index(_meta.get("severity", "Unknown"))
+
+_POOL: ProcessPoolExecutor | None = None
+
+
+def _severity_idx(codes: np.ndarray) -> np.ndarray:
+    """errcodes → indices de sévérité (Unknown hors table)."""
+    out = np.full(codes.shape, UNKNOWN, dtype=np.int8)
+    ok = (codes >= 0) & (codes < len(SEVERITY_LUT))
+    out[ok] = SEVERITY_LUT[codes[ok]]
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Lecture en flux
+# ---------------------------------------------------------------------------
+def load_arrays(company: str, cutoff: datetime):
+    """
+    (assets, asset_idx, acqend, errcode) pour les stats ≥ cutoff. Lignes
+    triées par asset (`asset_idx` croissant) puis acqend décroissant, dans
+    l’ordre de l’index idx_asset_acqend.
+    """
+    cur = (client[company]["statistics"]
+           .find({"acqend": {"$gte": cutoff, "$type": "date"}, "asset": {"$ne": None}},
+                 {"_id": 0, "asset": 1, "acqend": 1, "log.errcode": 1})
+           .sort([("asset", 1), ("acqend", -1)])
+           .batch_size(STREAM_BATCH))
+
+    assets: List[Any] = []
+    idx: List[int] = []
+    ts: List[datetime] = []
+    es: List[int] = []
+    prev = object()
+    for d in cur:
+        if d["asset"] != prev:                     # nouvel asset : interné
+            prev = d["asset"]
+            assets.append(prev)
+        idx.append(len(assets) - 1)
+        ts.append(d["acqend"])
+        es.append((d.get("log") or {}).get("errcode") or 0)
+
+    return (
+        assets,
+        np.array(idx, dtype=np.int64),
+        np.array(ts, dtype="datetime64[ms]"),
+        np.array(es, dtype=np.int64),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Scoring vectorisé
+# ---------------------------------------------------------------------------
+def score_arrays(asset_idx: np.ndarray, acqend: np.ndarray, errcode: np.ndarray,
+                 n_assets: int, last_n: int, freq_threshold: int) -> Dict[str, np.ndarray]:
+    """
+    Règles de detect_misconfig sur des tableaux (fonction pure, picklable) :
+    renvoie, par asset, has_stats, freq_err, consec, last_errcode, last_acq,
+    severity, misconfigured, plus `rows` / `starts` (stats retenues triées
+    par asset puis acqend décroissant) pour reconstruire les errcodes.
+    """
+    order = np.lexsort((-acqend.astype(np.int64), asset_idx))
+    a, t, e = asset_idx[order], acqend[order], errcode[order]
+
+    # rang dans l'asset (0 = plus récente) → on garde les last_n premières
+    n = len(a)
+    first = np.ones(n, dtype=bool)
+    first[1:] = a[1:] != a[:-1]
+    starts = np.flatnonzero(first)
+    group_start = np.repeat(starts, np.diff(np.append(starts, n)))
+    keep = (np.arange(n) - group_start) < last_n
+    a, t, e, first = a[keep], t[keep], e[keep], first[keep]
+    starts = np.flatnonzero(first)
+
+    # stats sans erreur vues depuis la plus récente (incluse), par asset
+    zero = (e == 0).astype(np.int64)
+    csum = np.cumsum(zero)
+    base = np.repeat(csum[starts] - zero[starts], np.diff(np.append(starts, len(a))))
+    zeros_seen = csum - base
+
+    freq_err = np.bincount(a, weights=(e > 0), minlength=n_assets).astype(np.int64)
+    consec   = np.bincount(a, weights=(zeros_seen == 0), minlength=n_assets).astype(np.int64)
+
+    has_stats = np.zeros(n_assets, dtype=bool)
+    has_stats[a[starts]] = True
+    last_errcode = np.zeros(n_assets, dtype=np.int64)
+    last_errcode[a[starts]] = e[starts]
+    last_acq = np.full(n_assets, np.datetime64("NaT"), dtype="datetime64[ms]")
+    last_acq[a[starts]] = t[starts]
+
+    severity = _severity_idx(last_errcode)
+    # R1′ : Critical ou 2 erreurs consécutives (⇔ consec ≥ 2) ; R2 : consec ≥ seuil
+    misconfigured = has_stats & ((severity == CRITICAL) | (consec >= 2) | (consec >= freq_threshold))
+
+    return {
+        "has_stats": has_stats, "freq_err": freq_err, "consec": consec,
+        "last_errcode": last_errcode, "last_acq": last_acq,
+        "severity": severity, "misconfigured": misconfigured,
+        "rows": e, "row_asset": a, "starts": starts,
+    }
+
+
+def _merge(parts: List[Dict[str, np.ndarray]], bounds: np.ndarray) -> Dict[str, np.ndarray]:
+    """Recolle les scores de tranches d’assets contiguës (voir `_score`)."""
+    per_asset = ("has_stats", "freq_err", "consec", "last_errcode", "last_acq",
+                 "severity", "misconfigured")
+    out = {k: np.concatenate([p[k] for p in parts]) for k in per_asset}
+    offsets = np.cumsum([0] + [len(p["rows"]) for p in parts[:-1]])
+    out["rows"] = np.concatenate([p["rows"] for p in parts])
+    out["row_asset"] = np.concatenate([p["row_asset"] + a0 for p, a0 in zip(parts, bounds)])
+    out["starts"] = np.concatenate([p["starts"] + off for p, off in zip(parts, offsets)])
+    return out
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawn : pas de fork d’un MongoClient déjà connecté
+        _POOL = ProcessPoolExecutor(max_workers=SCORER_PROCS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def shutdown_pool(wait: bool = True) -> None:
+    """Arrête le pool de scoring (arrêt de l’API) ; recréé au prochain appel."""
+    global _POOL
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _score(asset_idx, acqend, errcode, n_assets, last_n, freq_threshold):
+    """
+    score_arrays en-process, ou découpé en SCORER_PROCS tranches d’assets
+    contiguës (≈ même nombre de lignes) scorées en parallèle. Suppose
+    `asset_idx` croissant (load_arrays).
+    """
+    n = len(asset_idx)
+    if SCORER_PROCS <= 0 or n < SCORER_MIN_ROWS:
+        return score_arrays(asset_idx, acqend, errcode, n_assets, last_n, freq_threshold)
+
+    cuts = asset_idx[(np.arange(1, SCORER_PROCS) * n) // SCORER_PROCS]
+    bounds = np.unique(np.concatenate(([0], cuts, [n_assets])))       # tranches d’assets
+    rows = np.searchsorted(asset_idx, bounds)                         # tranches de lignes
+    pool = _pool()
+    futures = [
+        pool.submit(score_arrays, asset_idx[r0:r1] - a0, acqend[r0:r1], errcode[r0:r1],
+                     int(a1 - a0), last_n, freq_threshold)
+        for a0, a1, r0, r1 in zip(bounds[:-1], bounds[1:], rows[:-1], rows[1:])
+    ]
+    return _merge([f.result() for f in futures], bounds[:-1])
+
+
+# ---------------------------------------------------------------------------
+# Point d'entrée (même sortie $facet que le pipeline)
+# ---------------------------------------------------------------------------
+def _err_meta(code: int) -> Dict[str, Any]:
+    m = ERR_META.get(code)
+    if m is None:
+        return {"name": f"ERR_{code}", "severity": "Unknown", "cause": "unknown"}
+    return {f: m.get(f) for f in ("name", "severity", "cause")}
+
+
+def _count_rows(counter: Dict[Any, int], reverse: bool = False) -> List[Dict[str, Any]]:
+    keys = sorted(counter, key=lambda k: (k is not None, str(k)), reverse=reverse)
+    return [{"_id": k, "count": counter[k]} for k in keys]
+
+
+def vector_facets(company: str, cutoff: datetime, last_n: int, freq_threshold: int) -> Dict[str, Any]:
+    """Document équivalent au $facet de build_misconfig_pipeline."""
+    from backend.tools.misconfig_state import enrich_assets   # import local (cycle)
+
+    db = client[company]
+    assets, asset_idx, acqend, errcode = load_arrays(company, cutoff)
+    if not assets:
+        return {"mis": [], "bySeverity": [], "severityAll": [],
+                "byTransmitterFaulty": [], "dailyNew": [], "total": []}
+    s = _score(asset_idx, acqend, errcode, len(assets), last_n, freq_threshold)
+
+    # même périmètre que le pipeline : asset existant et ayant une task
+    candidates = np.flatnonzero(s["has_stats"])
+    info: Dict[int, Dict[str, Any]] = {}
+    for lo in range(0, len(candidates), ENRICH_BATCH):
+        chunk = candidates[lo:lo + ENRICH_BATCH]
+        extra = enrich_assets(db, [assets[i] for i in chunk])
+        for i in chunk:
+            x = extra[assets[i]]
+            if x["has_task"] and x["asset_found"]:
+                info[int(i)] = x
+
+    pos = {int(s["row_asset"][st]): k for k, st in enumerate(s["starts"])}
+    ends = np.append(s["starts"][1:], len(s["rows"]))
+
+    sev_all: Dict[Any, int] = {}
+    by_sev: Dict[Any, int] = {}
+    by_tx: Dict[Any, int] = {}
+    daily: Dict[Any, int] = {}
+    mis = []
+    for i, x in info.items():
+        meta = _err_meta(int(s["last_errcode"][i]))
+        sev_all[meta["severity"]] = sev_all.get(meta["severity"], 0) + 1
+        if not s["misconfigured"][i]:
+            continue
+        k = pos[i]
+        last_acq = s["last_acq"][i].item()
+        mis.append({
+            "_id":             assets[i],
+            "asset_id":        assets[i],
+            "last_acq":        last_acq,
+            "freq_err":        int(s["freq_err"][i]),
+            "errcodes":        s["rows"][s["starts"][k]:ends[k]].tolist(),
+            "err_name":        meta["name"],
+            "severity":        meta["severity"],
+            "cause":           meta["cause"],
+            "transmitter":     x["transmitter"],
+            "transmitterName": x["transmitterName"],
+        })
+        by_sev[meta["severity"]] = by_sev.get(meta["severity"], 0) + 1
+        by_tx[x["transmitter"]] = by_tx.get(x["transmitter"], 0) + 1
+        day = last_acq.strftime("%Y-%m-%d")
+        daily[day] = daily.get(day, 0) + 1
+
+    mis.sort(key=lambda d: ((d["transmitter"] is not None, str(d["transmitter"])),
+                            (d["err_name"] is not None, str(d["err_name"]))))
+    return {
+        "mis":                 mis,
+        "bySeverity":          _count_rows(by_sev, reverse=True),
+        "severityAll":         _count_rows(sev_all),
+        "byTransmitterFaulty": [{"_id": tx, "faultyMP": c} for tx, c in by_tx.items()],
+        "dailyNew":            _count_rows(daily),
+        "total":               [{"total_assets": len(info)}] if info else [],
+    }
@@ -1,71 +1,51 @@
 # app/tools/misconfiguration.py
+import os
 from datetime import datetime, timedelta
 from typing import Any
 
-from backend.db import client
+from backend.db import client, afan_out
+from backend.tools.misconfig_cache import cached_misconfig
+from backend.tools.transmitter_totals import get_transmitter_totals
 from backend.utils.serialize import flatten_doc
 from backend.utils.error_meta import load_err_meta
 
 # ── Métadonnées erreurs ──────────────────────────────────────
 ERR_META     = load_err_meta()                         # clé décimale → dict
-ERR_META_STR = {str(k): v for k, v in ERR_META.items()}
 
+# Moteur par défaut : "lookup" ($lookup tasks → statistics à chaque appel),
+# "window" ($setWindowFields sur statistics), "numpy" (règles vectorisées
+# côté Python) ou "state" (lecture de misconfig_state, voir
+# tools/misconfig_state.py)
+MISCONFIG_ENGINE = os.getenv("MISCONFIG_ENGINE", "lookup")
 
-def detect_misconfig(
-    company: str,
-    since_days: int = 30,
-    last_n: int = 10,
-    freq_threshold: int = 3,
-) -> dict[str, Any]:
-    """
-    Pour chaque asset (capteur) :
-     - Récupère les `last_n` statistiques récentes (acqend >= cutoff)
-     - Calcule freq_err, last_errcode, consec_errs, is_immediate selon severity
-     - Détermine misconfiguration si :
-         * R1′ : sévérité Critical (immediate) ou 2 erreurs consécutives
-         * R2  : freq_err >= freq_threshold
-    Retourne counts, liste d’assets KO avec détails et agrégats par transmitter.
-    """
-    db     = client[company]
-    cutoff = datetime.utcnow() - timedelta(days=since_days)
-
-    assets = client[company]["assets"]
-    # ── Comptage de TOUS les MP par transmitter ───────────────────────────
-    raw_totals = list(assets.aggregate([
-        {"$match": {"optionals.transmitter": {"$exists": True}}},
+# Scan multi-bases : délai max par entreprise (s)
+MISCONFIG_COMPANY_TIMEOUT = float(os.getenv("MISCONFIG_COMPANY_TIMEOUT", "120"))
 
-        # a) 2 représentations de l’id : objet + chaîne
-        {"$addFields": {
-            # tentative de conversion → ObjectId ; null si impossible
-            "txObj": {
-                "$convert": {
-                    "input": "$optionals.transmitter",
-                    "to": "objectId",
-                    "onError": "optionals.transmitter",
-                    "onNull":  None
-                }
-            },
-            # représentation texte uniforme pour le regroupement
-            "txKey": {
-                "$cond": [
-                    { "$eq": [{ "$type": "$optionals.transmitter" }, "objectId"] },
-                    { "$toString": "$optionals.transmitter" },
-                    "$optionals.transmitter"
-                ]
-            }
-        }},
 
-        # b) groupement sur la clé texte → on ne rate jamais un asset
-        {"$group": {
-            "_id":      "$txKey",
-            "totalMP":  { "$sum": 1 }
-        }}
-    ]))
-    # → map: { "63bb…07e": 5, … }
-    total_map = { d["_id"]: d["totalMP"] for d in raw_totals }
+def err_meta_expr(code: Any = "$last_errcode") -> dict:
+    """
+    Expression native {name, severity, cause} pour un errcode : `$switch`
+    compilé depuis config/err_meta.yml (remplace les `$function` JS, qui
+    recevaient toute la table en argument à chaque appel).
+    Code inconnu → name « ERR_<code> », severity « Unknown », cause « unknown ».
+    """
+    return {"$switch": {
+        "branches": [
+            {"case": {"$eq": [code, c]},
+             "then": {"$literal": {f: m.get(f) for f in ("name", "severity", "cause")}}}
+            for c, m in sorted(ERR_META.items())
+        ],
+        "default": {
+            "name":     {"$concat": ["ERR_", {"$toString": code}]},
+            "severity": "Unknown",
+            "cause":    "unknown",
+        },
+    }}
 
 
-    pipeline = [
+def _lookup_stages(cutoff: datetime, last_n: int) -> list[dict]:
+    """Tête « lookup » : tasks → `lastStats` (last_n stats récentes par asset)."""
+    return [
         # 1) lookup des last_n stats PAR asset
         {
             "$lookup": {
@@ -84,7 +64,17 @@ def detect_misconfig(
         },
         # 2) ne garder que les assets avec au moins 1 stat
         {"$match": {"lastStats.0": {"$exists": True}}},
+    ]
+
+
+def _rule_stages(freq_threshold: int) -> list[dict]:
+    """`lastStats` → errcodes, err, misconfigured (règles R1′ + R2)."""
+    return [*_derive_stages(), *_verdict_stages(freq_threshold)]
 
+
+def _derive_stages() -> list[dict]:
+    """`lastStats` → errcodes, freq_err, last_errcode, last_acq, consec_count."""
+    return [
         # 3) extraire errcodes et freq_err + last_errcode
         {"$addFields": {
             "errcodes": {
@@ -97,7 +87,8 @@ def detect_misconfig(
         }},
         {"$addFields": {
             "freq_err":   {"$size": {"$filter": {"input": "$errcodes", "as": "e", "cond": {"$gt": ["$$e", 0]}}}},
-            "last_errcode": {"$arrayElemAt": ["$errcodes", 0]}
+            "last_errcode": {"$arrayElemAt": ["$errcodes", 0]},
+            "last_acq":     {"$max": "$lastStats.acqend"}
         }},
 
         # 4) séquence d’erreurs consécutives
@@ -119,19 +110,18 @@ def detect_misconfig(
                 }
             }
         }},
+    ]
+
 
-        # 5) règles R1′ + R2
+def _verdict_stages(freq_threshold: int) -> list[dict]:
+    """errcodes / last_errcode / consec_count → err, misconfigured."""
+    return [
+        # 5) métadonnées du dernier errcode (lookup natif, une fois par asset)
+        {"$addFields": {"err": err_meta_expr("$last_errcode")}},
+
+        # 5 bis) règles R1′ + R2
         {"$addFields": {
-            "is_immediate": {
-                "$eq": [
-                    {"$function": {
-                        "lang": "js",
-                        "args": ["$last_errcode", ERR_META_STR],
-                        "body": "function(c,m){return m[String(c)]?m[String(c)].severity:'Unknown';}"
-                    }},
-                    "Critical"
-                ]
-            },
+            "is_immediate": {"$eq": ["$err.severity", "Critical"]},
             "consec_errs": {
                 "$and": [
                     {"$gt": [{"$arrayElemAt": ["$errcodes", 0]}, 0]},
@@ -148,7 +138,12 @@ def detect_misconfig(
                 ]
             }
         }},
+    ]
+
 
+def _enrich_stages() -> list[dict]:
+    """Asset + transmitter (id, nom) par $lookup sur `assets`, un doc par asset."""
+    return [
         # 6) ENRICHISSEMENT COMMUN À TOUTES LES FACETS
         {"$lookup": {
             "from": "assets",
@@ -196,129 +191,150 @@ def detect_misconfig(
         }
         },
         { "$replaceRoot": { "newRoot": "$doc" } },
+    ]
 
 
-
-        # 7) FACET pour générer 4 sous-pipelines en une seule passe
-        {"$facet": {
-            # a) tous les MP mal configurés, dédupliqués et ordonnés
-            "mis": [
-                {"$match": {"misconfigured": True}},
-                {"$addFields": {
-                    "err_name": {
-                        "$function": {
-                            "lang": "js",
-                            "args": ["$last_errcode", ERR_META_STR],
-                            "body": "function(c,m){return m[String(c)]?m[String(c)].name:'ERR_'+c;}"
-                        }
-                    },
-                    "severity": {
-                        "$function": {
-                            "lang": "js",
-                            "args": ["$last_errcode", ERR_META_STR],
-                            "body": "function(c,m){return m[String(c)]?m[String(c)].severity:'Unknown';}"
-                        }
-                    },
-                    "cause": {
-                        "$function": {
-                            "lang": "js",
-                            "args": ["$last_errcode", ERR_META_STR],
-                            "body": "function(c,m){return m[String(c)]?m[String(c)].cause:'unknown';}"
-                        }
-                    }
-                }},
-                {"$project": {
-                    "_id":      0,
-                    "asset_id": "$asset",
-                    "last_acq": {"$max": "$lastStats.acqend"},
-                    "freq_err": 1,
-                    "errcodes": 1,
-                    "err_name": 1,
-                    "severity": 1,
-                    "cause":    1,
-                    "transmitter":     1,
-                    "transmitterName": 1
-                }},
-                {"$group": {
-                    "_id":              "$asset_id",
-                    "asset_id":         {"$first": "$asset_id"},
-                    "last_acq":         {"$first": "$last_acq"},
-                    "freq_err":         {"$first": "$freq_err"},
-                    "errcodes":         {"$first": "$errcodes"},
-                    "err_name":         {"$first": "$err_name"},
-                    "severity":         {"$first": "$severity"},
-                    "cause":            {"$first": "$cause"},
-                    "transmitter":      {"$first": "$transmitter"},
-                    "transmitterName":  {"$first": "$transmitterName"}
-                }},
-                {"$sort": {"transmitter": 1, "err_name": 1}}
-            ],
-
-            "bySeverity": [
-                {"$match": {"misconfigured": True}},
-                {"$addFields": {
-                    "severity": {
-                        "$function": {
-                            "lang": "js",
-                            "args": ["$last_errcode", ERR_META_STR],
-                            "body": "function(c,m){return m[String(c)]?m[String(c)].severity:'Unknown';}"
-                        }
-                    }
-                }
-                },
-                {"$group": {
-                    "_id":   "$severity",
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"_id": -1}}
-            ],
-
-            # 1) Répartition par sévérité de **tous** les assets ayant au moins 1 stat
-            "severityAll": [
-                # on se base sur lastStats pour prendre la dernière sévérité
-                { "$addFields": {
-                    "last_severity": {
-                    "$function": {
-                        "lang": "js",
-                        "args": ["$last_errcode", ERR_META_STR],
-                        "body": "function(c,m){return m[String(c)]?m[String(c)].severity:'Unknown';}"
-                    }
-                    }
-                }
+def _facet_stage() -> dict:
+    """7) FACET pour générer les sous-résultats en une seule passe."""
+    return {"$facet": {
+        # a) tous les MP mal configurés, dédupliqués et ordonnés
+        "mis": [
+            {"$match": {"misconfigured": True}},
+            {"$addFields": {
+                "err_name": "$err.name",
+                "severity": "$err.severity",
+                "cause":    "$err.cause"
+            }},
+            {"$project": {
+                "_id":      0,
+                "asset_id": "$asset",
+                "last_acq": 1,
+                "freq_err": 1,
+                "errcodes": 1,
+                "err_name": 1,
+                "severity": 1,
+                "cause":    1,
+                "transmitter":     1,
+                "transmitterName": 1
+            }},
+            {"$group": {
+                "_id":              "$asset_id",
+                "asset_id":         {"$first": "$asset_id"},
+                "last_acq":         {"$first": "$last_acq"},
+                "freq_err":         {"$first": "$freq_err"},
+                "errcodes":         {"$first": "$errcodes"},
+                "err_name":         {"$first": "$err_name"},
+                "severity":         {"$first": "$severity"},
+                "cause":            {"$first": "$cause"},
+                "transmitter":      {"$first": "$transmitter"},
+                "transmitterName":  {"$first": "$transmitterName"}
+            }},
+            {"$sort": {"transmitter": 1, "err_name": 1}}
+        ],
+
+        "bySeverity": [
+            {"$match": {"misconfigured": True}},
+            {"$group": {
+                "_id":   "$err.severity",
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id": -1}}
+        ],
+
+        # 1) Répartition par sévérité de **tous** les assets ayant au moins 1 stat
+        "severityAll": [
+            # sévérité du dernier errcode (lastStats)
+            { "$group": { "_id": "$err.severity", "count": { "$sum": 1 } } },
+            { "$sort": { "_id": 1 } }
+        ],
+
+        
+
+        # c) total de MP FAUTIFS PAR transmitter
+        "byTransmitterFaulty": [
+            {"$match": {"misconfigured": True}},
+            {"$group": {
+                "_id":       "$transmitter",
+                "faultyMP":  {"$sum": 1}
+            }}
+        ],
+
+        "dailyNew": [
+            {"$match": {"misconfigured": True}},
+            {"$group": {
+                "_id":   {"$dateToString": {"format": "%Y-%m-%d", "date": "$last_acq"}},
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id": 1}}
+        ],
+
+
+        # d) comptage global
+        "total": [
+            {"$count": "total_assets"}
+        ]
+    }}
+
+
+def _window_stages(cutoff: datetime, last_n: int) -> list[dict]:
+    """
+    Tête « window » : un seul parcours de `statistics` (index asset/acqend),
+    rang par asset via $setWindowFields puis un $group qui produit
+    directement errcodes, freq_err, last_errcode, last_acq et consec_count.
+    """
+    return [
+        {"$match": {"acqend": {"$gte": cutoff}}},
+        {"$project": {"_id": 0, "asset": 1, "acqend": 1,
+                      "errcode": {"$ifNull": ["$log.errcode", 0]}}},
+        {"$setWindowFields": {
+            "partitionBy": "$asset",
+            "sortBy": {"acqend": -1},
+            "output": {
+                "rank": {"$documentNumber": {}},
+                # nb de stats sans erreur vues depuis la plus récente (incluse)
+                "zeros_seen": {
+                    "$sum": {"$cond": [{"$eq": ["$errcode", 0]}, 1, 0]},
+                    "window": {"documents": ["unbounded", "current"]},
                 },
-                { "$group": { "_id": "$last_severity", "count": { "$sum": 1 } } },
-                { "$sort": { "_id": 1 } }
-            ],
-
-            
-
-            # c) total de MP FAUTIFS PAR transmitter
-            "byTransmitterFaulty": [
-                {"$match": {"misconfigured": True}},
-                {"$group": {
-                    "_id":       "$transmitter",
-                    "faultyMP":  {"$sum": 1}
-                }}
-            ],
-
-            "dailyNew": [
-                {"$match": {"misconfigured": True}},
-                {"$group": {
-                    "_id":   {"$dateToString": {"format": "%Y-%m-%d", "date": "$last_acq"}},
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"_id": 1}}
-            ],
-
-
-            # d) comptage global
-            "total": [
-                {"$count": "total_assets"}
-            ]
-        }}
+            },
+        }},
+        {"$match": {"rank": {"$lte": last_n}}},
+        {"$sort": {"asset": 1, "rank": 1}},
+        {"$group": {
+            "_id":          "$asset",
+            "errcodes":     {"$push": "$errcode"},
+            "freq_err":     {"$sum": {"$cond": [{"$gt": ["$errcode", 0]}, 1, 0]}},
+            "last_errcode": {"$first": "$errcode"},
+            "last_acq":     {"$max": "$acqend"},
+            # erreurs consécutives = stats avant le premier 0
+            "consec":       {"$sum": {"$cond": [{"$eq": ["$zeros_seen", 0]}, 1, 0]}},
+        }},
+        {"$addFields": {"asset": "$_id", "consec_count": {"count": "$consec"}}},
+
+        # même périmètre que le pipeline « lookup » : assets ayant une task
+        {"$lookup": {
+            "from": "tasks",
+            "localField": "asset",
+            "foreignField": "asset",
+            "pipeline": [{"$limit": 1}, {"$project": {"_id": 1}}],
+            "as": "task",
+        }},
+        {"$match": {"task.0": {"$exists": True}}},
+    ]
+
+
+def build_misconfig_pipeline(cutoff: datetime, last_n: int, freq_threshold: int) -> list[dict]:
+    """Pipeline `tasks` → un document {mis, bySeverity, severityAll, …} ($facet)."""
+    return [
+        *_lookup_stages(cutoff, last_n),
+        *_rule_stages(freq_threshold),
+        *_enrich_stages(),
+        _facet_stage(),
     ]
 
-    raw   = list(db["tasks"].aggregate(pipeline, allowDiskUse=True))[0]
+
+def shape_misconfig(raw: dict[str, Any], total_map: dict[str, int]) -> dict[str, Any]:
+    """Document $facet + totaux par transmitter → réponse de detect_misconfig."""
     by_sev_mis   = raw.get("bySeverity", [])
     sev_all = raw.get("severityAll", [])
     daily_new = raw.get("dailyNew", [])
@@ -360,3 +376,127 @@ def detect_misconfig(
         "severityAll":   sev_all,
         "dailyNew":      daily_new
     }
+
+
+def detect_misconfig(
+    company: str,
+    since_days: int = 30,
+    last_n: int = 10,
+    freq_threshold: int = 3,
+    engine: str | None = None,
+    cache: bool = True,
+) -> dict[str, Any]:
+    """
+    Pour chaque asset (capteur) :
+     - Récupère les `last_n` statistiques récentes (acqend >= cutoff)
+     - Calcule freq_err, last_errcode, consec_errs, is_immediate selon severity
+     - Détermine misconfiguration si :
+         * R1′ : sévérité Critical (immediate) ou 2 erreurs consécutives
+         * R2  : freq_err >= freq_threshold
+    Retourne counts, liste d’assets KO avec détails et agrégats par transmitter.
+
+    `engine` : "lookup" (pipeline complet sur `tasks`), "window" (un parcours
+    de `statistics` avec $setWindowFields), "numpy" (stats lues en flux,
+    règles vectorisées côté Python, voir tools/misconfig_vector.py) ou
+    "state" (lecture indexée de `misconfig_state`, repli sur "lookup" si
+    l’état ne couvre pas la fenêtre demandée) ; défaut MISCONFIG_ENGINE.
+
+    `cache` : résultat servi depuis tools/misconfig_cache.py tant qu’aucune
+    nouvelle statistique n’est arrivée (recalcul en arrière-plan sinon).
+    """
+    engine = engine or MISCONFIG_ENGINE
+    if not cache:
+        return _detect_misconfig(company, since_days, last_n, freq_threshold, engine)
+    return cached_misconfig(
+        (company, since_days, last_n, freq_threshold, engine),
+        lambda: _detect_misconfig(company, since_days, last_n, freq_threshold, engine),
+    )
+
+
+def _detect_misconfig(company: str, since_days: int, last_n: int,
+                      freq_threshold: int, engine: str) -> dict[str, Any]:
+    from backend.tools.misconfig_state import (    # import local (cycle)
+        STATE_COLL, state_head_stages, state_ready,
+    )
+
+    db     = client[company]
+    cutoff = datetime.utcnow() - timedelta(days=since_days)
+
+    total_map = get_transmitter_totals(company)     # table matérialisée
+    if engine == "numpy":
+        from backend.tools.misconfig_vector import vector_facets
+        return shape_misconfig(vector_facets(company, cutoff, last_n, freq_threshold), total_map)
+    if engine == "state" and state_ready(company, cutoff, last_n):
+        # état déjà enrichi (transmitter, nom) : pas de $lookup
+        coll = db[STATE_COLL]
+        pipeline = [*state_head_stages(cutoff, last_n), *_rule_stages(freq_threshold), _facet_stage()]
+    elif engine == "window":
+        coll = db["statistics"]
+        pipeline = [*_window_stages(cutoff, last_n), *_verdict_stages(freq_threshold),
+                    *_enrich_stages(), _facet_stage()]
+    elif engine in ("lookup", "state"):
+        coll = db["tasks"]
+        pipeline = build_misconfig_pipeline(cutoff, last_n, freq_threshold)
+    else:
+        raise ValueError(f"engine inconnu : {engine}")
+    raw = list(coll.aggregate(pipeline, allowDiskUse=True))[0]
+    return shape_misconfig(raw, total_map)
+
+
+# ---------------------------------------------------------------------------
+# Multi-bases
+# ---------------------------------------------------------------------------
+def _merge_counts(lists: list[list[dict]], reverse: bool = False) -> list[dict]:
+    """Somme des [{_id, count}] de plusieurs bases, même tri que les facets."""
+    acc: dict[Any, int] = {}
+    for rows in lists:
+        for r in rows:
+            acc[r["_id"]] = acc.get(r["_id"], 0) + r["count"]
+    keys = sorted(acc, key=lambda k: (k is not None, str(k)), reverse=reverse)
+    return [{"_id": k, "count": acc[k]} for k in keys]
+
+
+def merge_misconfig(per_company: dict[str, dict[str, Any]]) -> dict[str, Any]:
+    """
+    Fusionne les résultats de detect_misconfig de plusieurs bases : comptes
+    additionnés, items et lignes par transmitter marqués de leur `company`,
+    répartitions (sévérité, jour) sommées sur toute la flotte.
+    """
+    counts = {"total_assets": 0, "misconfigured": 0, "healthy": 0}
+    items: list[dict] = []
+    by_tx: list[dict] = []
+    for comp in sorted(per_company, key=str.lower):
+        res = per_company[comp]
+        for k in counts:
+            counts[k] += res["counts"][k]
+        items.extend({**it, "company": comp} for it in res["items"])
+        by_tx.extend({**row, "company": comp} for row in res["byTransmitter"])
+
+    results = list(per_company.values())
+    return {
+        "counts":        counts,
+        "items":         items,
+        "byTransmitter": by_tx,
+        "bySeverity":    _merge_counts([r["bySeverity"] for r in results], reverse=True),
+        "severityAll":   _merge_counts([r["severityAll"] for r in results]),
+        "dailyNew":      _merge_counts([r["dailyNew"] for r in results]),
+    }
+
+
+async def stream_misconfig(companies: list[str], since_days: int = 30,
+                           timeout: float = MISCONFIG_COMPANY_TIMEOUT):
+    """(company, résultat, erreur) pour chaque base, dans l’ordre de complétion."""
+    async for item in afan_out(companies, detect_misconfig, since_days, timeout=timeout):
+        yield item
+
+
+async def scan_misconfig(companies: list[str], since_days: int = 30,
+                         timeout: float = MISCONFIG_COMPANY_TIMEOUT) -> dict[str, Any]:
+    """Scan parallèle de plusieurs bases → résultat fusionné + {company: erreur}."""
+    results, errors = {}, {}
+    async for comp, res, err in stream_misconfig(companies, since_days, timeout):
+        if err is None:
+            results[comp] = res
+        else:
+            errors[comp] = err
+    return {**merge_misconfig(results), "errors": errors}
@@ -1,46 +1,225 @@
 # app/tools/misconfiguration_ml.py
-"""Scoring avec le modèle One-Class SVM pour détecter les tasks suspectes."""
+"""
+Scoring avec le modèle One-Class SVM pour détecter les tasks suspectes.
 
+• Features calculées en mémoire depuis un curseur `statistics` trié par
+  (acqinfo.task, acqend décroissant) – index idx_task_acqend – sans fichier
+  intermédiaire :
+    err_freq_20runs         erreurs parmi les 20 dernières exécutions
+    minutes_since_last_err  minutes depuis la dernière erreur (fenêtre entière)
+    max_consec_errors       plus longue série d’erreurs dans les 20 dernières
+• Modèle chargé à la première utilisation, une fois par processus
+  (MISCONFIG_ML_MODEL, défaut misconfig_ocsvm.pkl à côté de ce fichier).
+• Plusieurs compagnies : une compagnie par processus du pool
+  (MISCONFIG_ML_PROCS), chaque processus gardant son modèle chargé. Un
+  pool cassé (processus tué, OOM) est recréé et les compagnies touchées
+  relancées une fois ; `shutdown_pool()` est appelé à l’arrêt de l’API.
+
+Usage CLI :
+    python -m backend.tools.misconfiguration_ml --company MA_COMPAGNIE [--company AUTRE]
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-import joblib, pandas as pd, numpy as np
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
 from backend.db import client
-from datetime import datetime, timedelta
 
-MODEL_PATH = Path(__file__).with_suffix(".pkl").with_name("misconfig_ocsvm.pkl")
-PACK       = joblib.load(MODEL_PATH)
+# ── Paramètres ───────────────────────────────────────────────
+MODEL_PATH = Path(os.getenv(
+    "MISCONFIG_ML_MODEL", Path(__file__).with_name("misconfig_ocsvm.pkl")
+))
+ML_PROCS     = int(os.getenv("MISCONFIG_ML_PROCS", "4"))
+STREAM_BATCH = int(os.getenv("MISCONFIG_STREAM_BATCH", "50000"))
+RUNS         = 20
+MAX_MINUTES  = 10080                              # une semaine (borne du modèle)
+
+STAT_PROJ = {"_id": 0, "acqinfo.task": 1, "asset": 1, "acqend": 1, "log.errcode": 1}
+
+_POOL: ProcessPoolExecutor | None = None
+
+
+@lru_cache(maxsize=1)
+def _model() -> Dict[str, Any]:
+    """Pack {features, scaler, model}, chargé une fois par processus."""
+    import joblib   # import local : inutile tant qu’on ne score pas
+    if not MODEL_PATH.exists():
+        raise FileNotFoundError(f"modèle introuvable : {MODEL_PATH}")
+    return joblib.load(MODEL_PATH)
 
-FEATURES = PACK["features"]
-SCALE    = PACK["scaler"].transform
-MODEL    = PACK["model"].decision_function
 
 # ──────────────────────────────────────────────────────────────────────────────
+def _task_row(task: Any, asset: Any, runs: List[int], last_err: datetime | None,
+              now: datetime) -> Dict[str, Any]:
+    consec = best = 0
+    for e in runs:
+        consec = consec + 1 if e > 0 else 0
+        best = max(best, consec)
+    minutes = (now - last_err).total_seconds() / 60 if last_err else MAX_MINUTES
+    return {
+        "task":                   task,
+        "asset":                  asset,
+        "err_freq_20runs":        sum(1 for e in runs if e > 0),
+        "minutes_since_last_err": min(minutes, MAX_MINUTES),
+        "max_consec_errors":      best,
+    }
+
+
+def build_features(company: str, since_days: int = 30) -> pd.DataFrame:
+    """Une ligne de features par task, lue en flux depuis `statistics`."""
+    now = datetime.utcnow()
+    cur = (client[company]["statistics"]
+           .find({"acqend": {"$gte": now - timedelta(days=since_days)},
+                  "acqinfo.task": {"$exists": True}}, STAT_PROJ)
+           .sort([("acqinfo.task", 1), ("acqend", -1)])
+           .batch_size(STREAM_BATCH))
+
+    rows: List[Dict[str, Any]] = []
+    task = asset = last_err = None
+    runs: List[int] = []
+    for st in cur:
+        t = (st.get("acqinfo") or {}).get("task")
+        if t != task:
+            if task is not None:
+                rows.append(_task_row(task, asset, runs, last_err, now))
+            task, asset, last_err, runs = t, st.get("asset"), None, []
+        err = (st.get("log") or {}).get("errcode") or 0
+        if len(runs) < RUNS:
+            runs.append(err)
+        if err > 0 and last_err is None:
+            last_err = st.get("acqend")
+    if task is not None:
+        rows.append(_task_row(task, asset, runs, last_err, now))
+    return pd.DataFrame(rows, columns=["task", "asset", "err_freq_20runs",
+                                       "minutes_since_last_err", "max_consec_errors"])
+
+
 def _compute_features(stats_df: pd.DataFrame) -> pd.DataFrame:
     """Reconstruit localement les mêmes features que lors de l’entraînement."""
     df = stats_df.copy()
-    df["err_rate"]    = df["err_freq_20runs"] / 20
-    df["log_minutes"] = np.log1p(df["minutes_since_last_err"].clip(upper=10080))
+    df["err_rate"]    = df["err_freq_20runs"] / RUNS
+    df["log_minutes"] = np.log1p(df["minutes_since_last_err"].clip(upper=MAX_MINUTES))
     df["err_after_reset_rate"] = (
         df["max_consec_errors"] / df["err_freq_20runs"].replace(0, np.nan)
     ).fillna(0)
-    return df[FEATURES]
+    return df[_model()["features"]]
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 def detect_misconfig_ml(company: str, since_days: int = 30) -> pd.DataFrame:
     """
     Retourne un DataFrame des tasks triées par score d’anomalie.
     """
-    from backend.extract import build_features  # import local
-
-    TMP_PARQUET = f"/tmp/{company}_feat.parquet"
-    build_features(
-        mongo_uri="mongodb://localhost:27017",
-        dbname=company,
-        since_days=since_days,
-        out_parquet=TMP_PARQUET
-    )
-    raw = pd.read_parquet(TMP_PARQUET)
-    X   = _compute_features(raw)
-    scores = MODEL(SCALE(X))
+    raw = build_features(company, since_days)
+    if raw.empty:
+        return raw.assign(anomaly_score=pd.Series(dtype=float),
+                          is_anomaly=pd.Series(dtype=bool))
+    pack = _model()
+    scores = pack["model"].decision_function(pack["scaler"].transform(_compute_features(raw)))
     raw["anomaly_score"] = scores
     raw["is_anomaly"]    = scores < 0
     return raw.sort_values("anomaly_score")    # plus négatif = plus suspect
+
+
+def ml_overview(company: str, since_days: int = 30, limit: int = 50) -> Dict[str, Any]:
+    """Résumé sérialisable : nb de tasks scorées / suspectes + `limit` plus suspectes."""
+    df = detect_misconfig_ml(company, since_days)
+    return {
+        "company":   company,
+        "scored":    len(df),
+        "anomalies": int(df["is_anomaly"].sum()),
+        "suspects":  df[df["is_anomaly"]].head(limit).to_dict("records"),
+    }
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawn : pas de fork d’un MongoClient déjà connecté
+        _POOL = ProcessPoolExecutor(max_workers=ML_PROCS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def shutdown_pool(wait: bool = True) -> None:
+    """Arrête le pool (arrêt de l’API, ou pool cassé) ; recréé au prochain appel."""
+    global _POOL
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _score_companies(companies: List[str], since_days: int, limit: int):
+    """{company: résultat}, {company: erreur}, compagnies perdues sur pool cassé."""
+    results, errors, broken = {}, {}, []
+    try:
+        futures = {_pool().submit(ml_overview, comp, since_days, limit): comp for comp in companies}
+    except (BrokenProcessPool, RuntimeError):      # cassé, ou arrêté par un autre appel
+        return results, errors, list(companies)
+    for fut in as_completed(futures):
+        comp = futures[fut]
+        try:
+            results[comp] = fut.result()
+        except (BrokenProcessPool, CancelledError):
+            broken.append(comp)
+        except Exception as exc:
+            errors[comp] = str(exc)
+    return results, errors, broken
+
+
+def scan_misconfig_ml(companies: List[str], since_days: int = 30,
+                      limit: int = 50) -> Dict[str, Any]:
+    """
+    Score plusieurs compagnies en parallèle (une par processus) →
+    suspects de toutes les bases (marqués `company`, plus suspects d’abord),
+    totaux par compagnie et {company: erreur}.
+    """
+    if not MODEL_PATH.exists():
+        raise FileNotFoundError(f"modèle introuvable : {MODEL_PATH}")
+    results, errors, broken = _score_companies(companies, since_days, limit)
+    if broken:
+        # pool cassé : on le recrée et on relance une seule fois
+        shutdown_pool(wait=False)
+        retry, retry_errors, still = _score_companies(broken, since_days, limit)
+        results.update(retry)
+        errors.update(retry_errors)
+        errors.update({comp: "pool de processus cassé" for comp in still})
+        if still:
+            shutdown_pool(wait=False)
+    per_company, suspects = {}, []
+    for comp, res in results.items():
+        per_company[comp] = {"scored": res["scored"], "anomalies": res["anomalies"]}
+        suspects.extend({**s, "company": comp} for s in res["suspects"])
+    suspects.sort(key=lambda s: s["anomaly_score"])
+    return {
+        "companies": per_company,
+        "suspects":  suspects[:limit],
+        "errors":    errors,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Scoring One-Class SVM des tasks pour une ou plusieurs compagnies"
+    )
+    parser.add_argument("--company", "-c", action="append",
+                        help="Nom de la DB Mongo / compagnie, répétable (défaut: ACME)")
+    parser.add_argument("--days", "-d", type=int, default=30)
+    parser.add_argument("--limit", "-k", type=int, default=20)
+    args = parser.parse_args()
+    res = scan_misconfig_ml(args.company or ["ACME"], args.days, args.limit)
+    for comp, c in sorted(res["companies"].items()):
+        print(f"[{comp}] {c['anomalies']} / {c['scored']} tasks suspectes")
+    for comp, err in res["errors"].items():
+        print(f"[{comp}] échec : {err}")
+    for s in res["suspects"]:
+        print(f"{s['company']}  {s['task']}  score={s['anomaly_score']:.3f}")
@@ -0,0 +1,220 @@
+# app/tools/schema_profile.py
+"""
+Profils de schéma par (company, collection) pour la projection dynamique.
+
+Le profil (champs aplatis : nom, type, fréquence, exemple) est construit sur
+un échantillon DÉTERMINISTE — les PROFILE_SIZE/2 plus anciens et plus récents
+documents par `_id` — et non plus via `$sample`, pour que deux appels
+successifs donnent le même profil. Son empreinte (`fingerprint`, sha1 des
+couples nom/type) sert de composante stable des clés de cache.
+
+Stockage : diskcache (SCHEMA_PROFILE_DIR, partagé entre workers et conservé
+au redémarrage) + cache mémoire relu au plus toutes les SCHEMA_PROFILE_CHECK s.
+Un profil est reconstruit en arrière-plan (l’ancien reste servi) quand il
+date de plus de SCHEMA_PROFILE_TTL s ou que le nombre de documents a dérivé
+de plus de SCHEMA_PROFILE_DRIFT ; `refresh_stale_profiles()` fait la même
+chose pour tous les profils connus (tâche de fond de main.py).
+
+Usage CLI :
+    python -m backend.tools.schema_profile --company MA_COMPAGNIE --collection analyses
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import diskcache
+from bson import ObjectId
+
+from backend.db import client
+from backend.utils.cache import MeteredTTLCache
+from backend.utils.serialize import flatten_doc
+
+# ── Paramètres ───────────────────────────────────────────────
+PROFILE_SIZE  = int(os.getenv("DYN_PROJ_SAMPLE_SIZE", "500"))
+MAX_FLD       = int(os.getenv("DYN_PROJ_MAX_FIELDS", "60"))
+PROFILE_DIR   = os.getenv("SCHEMA_PROFILE_DIR", "/tmp/schema_profiles")
+PROFILE_TTL   = int(os.getenv("SCHEMA_PROFILE_TTL", str(6 * 3600)))    # s avant reconstruction
+PROFILE_CHECK = int(os.getenv("SCHEMA_PROFILE_CHECK", "60"))           # s entre deux relectures
+PROFILE_DRIFT = float(os.getenv("SCHEMA_PROFILE_DRIFT", "0.1"))        # dérive relative du count
+
+_MEM  = MeteredTTLCache("schema_profiles", maxsize=1_024, ttl=PROFILE_CHECK)
+_DISK = diskcache.Cache(PROFILE_DIR)
+
+_REFRESH  = ThreadPoolExecutor(max_workers=2, thread_name_prefix="schema-profile")
+_INFLIGHT: set = set()
+_INFLIGHT_LOCK = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# Helpers simples
+# ---------------------------------------------------------------------------
+def _dtype(val: Any) -> str:
+    if isinstance(val, (int, float)):           return "number"
+    if isinstance(val, datetime.datetime):      return "date"
+    if isinstance(val, str):
+        return "date" if re.match(r"\d{4}-\d{2}-\d{2}", val) else "string"
+    if isinstance(val, list):                   return "array"
+    if isinstance(val, ObjectId):               return "id"
+    return "object"
+
+_digit_re = re.compile(r"^\d+$")
+
+def _normalize_sentence_path(path: str) -> str:
+    """
+    Supprime les segments numériques intermédiaires :
+      analyses.0.description.1.sentence  ->  analyses.description.sentence
+    """
+    parts = [p for p in path.split(".") if not _digit_re.match(p)]
+    return ".".join(parts)
+
+def _collect_sentence_paths(obj, prefix="", out=None):
+    """
+    Parcourt récursivement `obj` (dict ou list) et enregistre tous les
+    chemins qui se terminent par '.sentence', sans indices numériques.
+    """
+    if out is None:
+        out = set()
+
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            new_pref = f"{prefix}.{k}" if prefix else k
+            if k == "sentence":
+                out.add(_normalize_sentence_path(new_pref))
+            else:
+                _collect_sentence_paths(v, new_pref, out)
+
+    elif isinstance(obj, list):
+        for item in obj:
+            _collect_sentence_paths(item, prefix, out)
+
+    return out
+
+
+def fingerprint(profile: List[Dict[str, Any]]) -> str:
+    """Empreinte des couples (nom, type) : insensible aux fréquences / exemples."""
+    pairs = sorted((d["name"], d["type"]) for d in profile)
+    return hashlib.sha1(json.dumps(pairs).encode()).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Construction
+# ---------------------------------------------------------------------------
+def build_profile(db: str, coll: str) -> List[Dict[str, Any]]:
+    """Profil sur les plus anciens + plus récents documents (échantillon stable)."""
+    col  = client[db][coll]
+    half = max(PROFILE_SIZE // 2, 1)
+    docs = {d["_id"]: d for d in col.find().sort("_id", 1).limit(half)}
+    docs.update((d["_id"], d) for d in col.find().sort("_id", -1).limit(half))
+    total = len(docs) or 1
+    stats: Dict[str, list[Any]] = {}
+
+    for _id in sorted(docs, key=str):
+        raw  = docs[_id]
+        flat = flatten_doc(raw, sep=".")           # ← SEP = "."
+        for k, v in flat.items():
+            stats.setdefault(k, []).append(v)
+
+        for path in _collect_sentence_paths(raw):
+            stats.setdefault(path, []).append("•")
+
+    prof = [{
+        "name":   k,
+        "type":   _dtype(vals[0]),
+        "freq":   round(len(vals) * 100 / total),
+        "sample": str(vals[0])[:60]
+    } for k, vals in stats.items()]
+
+    prof.sort(key=lambda d: (-d["freq"], d["name"]))
+    return prof[:MAX_FLD]
+
+
+def refresh_profile(db: str, coll: str) -> Dict[str, Any]:
+    """Reconstruit et enregistre le profil de (db, coll)."""
+    profile = build_profile(db, coll)
+    entry = {
+        "profile":     profile,
+        "fingerprint": fingerprint(profile),
+        "count":       client[db][coll].estimated_document_count(),
+        "built_at":    time.time(),
+    }
+    _DISK.set((db, coll), entry)
+    _MEM.store((db, coll), entry)
+    return entry
+
+
+def _refresh_later(db: str, coll: str) -> None:
+    key = (db, coll)
+    with _INFLIGHT_LOCK:
+        if key in _INFLIGHT:
+            return
+        _INFLIGHT.add(key)
+
+    def job():
+        try:
+            refresh_profile(db, coll)
+        except Exception:
+            logging.exception(f"schema_profile: échec de la reconstruction pour {key}")
+        finally:
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.discard(key)
+
+    _REFRESH.submit(job)
+
+
+def _is_stale(db: str, coll: str, entry: Dict[str, Any]) -> bool:
+    if time.time() - entry["built_at"] > PROFILE_TTL:
+        return True
+    count = client[db][coll].estimated_document_count()
+    return abs(count - entry["count"]) > PROFILE_DRIFT * max(entry["count"], 1)
+
+
+# ---------------------------------------------------------------------------
+# Lecture
+# ---------------------------------------------------------------------------
+def get_profile(db: str, coll: str) -> Tuple[List[Dict[str, Any]], str]:
+    """(profil, empreinte) de (db, coll) ; construit au premier appel seulement."""
+    entry = _MEM.lookup((db, coll))
+    if entry is not None:
+        return entry["profile"], entry["fingerprint"]
+
+    entry = _DISK.get((db, coll))
+    if entry is None:
+        entry = refresh_profile(db, coll)
+    else:
+        if _is_stale(db, coll, entry):
+            _refresh_later(db, coll)
+        _MEM.store((db, coll), entry)
+    return entry["profile"], entry["fingerprint"]
+
+
+def refresh_stale_profiles() -> int:
+    """Reconstruit les profils connus périmés ou dérivés ; renvoie leur nombre."""
+    n = 0
+    for db, coll in list(_DISK.iterkeys()):
+        entry = _DISK.get((db, coll))
+        if entry is not None and _is_stale(db, coll, entry):
+            refresh_profile(db, coll)
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Reconstruit le profil de schéma d’une collection"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    parser.add_argument("--collection", default="analyses")
+    args = parser.parse_args()
+    e = refresh_profile(args.company, args.collection)
+    print(f"[{args.company}.{args.collection}] {len(e['profile'])} champs, "
+          f"empreinte {e['fingerprint'][:12]}")
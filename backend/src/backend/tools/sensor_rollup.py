@@ -0,0 +1,392 @@
+# app/tools/sensor_rollup.py
+"""
+Rollup de santé capteurs, un document par entreprise
+(`sensor_health_rollup`, _id = "rollup") :
+
+    by_node_type   : {"1": n, "2": n, "3": n, …}        tous les nœuds
+    battery_bins   : {"32": n, …}  capteurs par tranche de BATT_BIN mV
+    last_com_days  : {"2025-07-01": n, …}  capteurs par jour (UTC) de last_com
+    rssi_bands     : {"good": n, "medium": n, "poor": n, "unknown": n}
+    hwm            : plus grand `_updated` intégré
+    refreshed_at   : date de la dernière mise à jour
+
+Les histogrammes (tranches batterie, jour de last_com) permettent de
+recalculer les compteurs pour des seuils alignés (seuils batterie multiples
+de BATT_BIN, seuil hors-ligne à minuit) sans relire `network_nodes`.
+
+Mise à jour incrémentale : l’état de chaque nœud est gardé dans
+`sensor_health_nodes` ; un nœud modifié (`_updated` ≥ hwm, ou événement de
+change stream) retire son ancienne contribution et ajoute la nouvelle.
+Le polling sur `_updated` ne voit pas les suppressions : reconstruction
+complète toutes les ROLLUP_FULL_EVERY s, ou dès que le total du rollup
+s’écarte du nombre de documents de `network_nodes`.
+
+Un seul écrivain par entreprise : bail (`_id = "lease"` dans
+sensor_health_rollup, ROLLUP_LEASE_TTL s, prolongé à chaque lot d’une
+reconstruction) pris par refresh_rollup et watch_rollup ; les autres
+workers (ou la boucle de main.py pendant un `--watch`) passent leur tour.
+
+Usage CLI :
+    python -m backend.tools.sensor_rollup --company MA_COMPAGNIE [--full]
+    python -m backend.tools.sensor_rollup --company MA_COMPAGNIE --watch
+"""
+
+import os
+import math
+import uuid
+import time
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable
+
+from pymongo import UpdateOne, DeleteOne, errors
+
+from backend.db import client, get_nodes_collection
+from backend.tools.topology import _classify_quality
+
+# ── Paramètres ───────────────────────────────────────────────
+ROLLUP_COLL   = "sensor_health_rollup"
+STATE_COLL    = "sensor_health_nodes"
+ROLLUP_ID     = "rollup"
+LEASE_ID      = "lease"
+BATT_BIN      = int(os.getenv("ROLLUP_BATT_BIN", "100"))          # mV
+ROLLUP_MAX_AGE = int(os.getenv("ROLLUP_MAX_AGE", "300"))          # secondes
+ROLLUP_FULL_EVERY = int(os.getenv("ROLLUP_FULL_EVERY", str(6 * 3600)))   # s entre deux reconstructions
+ROLLUP_LEASE_TTL  = int(os.getenv("ROLLUP_LEASE_TTL", "120"))            # s, durée du bail écrivain
+BATCH_SIZE    = 1_000
+
+NODE_PROJ = {"_id": 1, "node_type": 1, "batt": 1, "last_com": 1, "rssi": 1, "_updated": 1}
+
+
+# ---------------------------------------------------------------------------
+# Contribution d’un nœud
+# ---------------------------------------------------------------------------
+def _node_state(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Classe un document `network_nodes` dans les histogrammes du rollup."""
+    state: Dict[str, Any] = {"node_type": str(doc.get("node_type"))}
+    if doc.get("node_type") != 2:
+        return state
+
+    batt = doc.get("batt")
+    if isinstance(batt, (int, float)) and not isinstance(batt, bool) and math.isfinite(batt):
+        state["batt_bin"] = str(math.floor(batt / BATT_BIN))
+
+    last = doc.get("last_com")
+    if isinstance(last, datetime):
+        if last.tzinfo is not None:
+            last = last.astimezone(timezone.utc)
+        state["day"] = last.strftime("%Y-%m-%d")
+
+    rssi = doc.get("rssi")
+    state["rssi_band"] = _classify_quality({"rssi": rssi} if isinstance(rssi, (int, float)) else {})
+    return state
+
+
+def _contrib(state: Dict[str, Any] | None) -> Counter:
+    """Clés « champ.valeur » incrémentées par un état de nœud."""
+    c: Counter = Counter()
+    if not state:
+        return c
+    c[f"by_node_type.{state['node_type']}"] += 1
+    if "batt_bin" in state:
+        c[f"battery_bins.{state['batt_bin']}"] += 1
+    if "day" in state:
+        c[f"last_com_days.{state['day']}"] += 1
+    if "rssi_band" in state:
+        c[f"rssi_bands.{state['rssi_band']}"] += 1
+    return c
+
+
+# ---------------------------------------------------------------------------
+# Bail écrivain
+# ---------------------------------------------------------------------------
+def _acquire_lease(company: str, owner: str, ttl: int = ROLLUP_LEASE_TTL) -> bool:
+    """Prend (ou prolonge) le bail ; False s’il est tenu par un autre écrivain."""
+    now = datetime.utcnow()
+    try:
+        client[company][ROLLUP_COLL].update_one(
+            {"_id": LEASE_ID, "$or": [{"owner": owner}, {"expires": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+    except errors.DuplicateKeyError:
+        return False            # bail vivant d’un autre écrivain
+    return True
+
+
+def _release_lease(company: str, owner: str) -> None:
+    client[company][ROLLUP_COLL].delete_one({"_id": LEASE_ID, "owner": owner})
+
+
+def _keep_lease(company: str, owner: str) -> None:
+    """Prolonge le bail pendant une reconstruction ; RuntimeError s’il est perdu."""
+    if not _acquire_lease(company, owner):
+        raise RuntimeError(f"sensor_rollup({company}) : bail perdu pendant la reconstruction")
+
+
+# ---------------------------------------------------------------------------
+# Application d’un lot de changements
+# ---------------------------------------------------------------------------
+def apply_changes(
+    company: str,
+    docs: Iterable[Dict[str, Any]],
+    deleted_ids: Iterable[Any] = (),
+) -> int:
+    """
+    Intègre des documents modifiés / insérés et des suppressions.
+    Idempotent : réappliquer un document inchangé produit un delta nul.
+    Renvoie le nombre de nœuds traités.
+    """
+    db    = client[company]
+    docs  = list(docs)
+    dels  = list(deleted_ids)
+    ids   = [d["_id"] for d in docs] + dels
+    if not ids:
+        return 0
+
+    old = {s["_id"]: s for s in db[STATE_COLL].find({"_id": {"$in": ids}})}
+
+    delta: Counter = Counter()
+    ops = []
+    hwm = None
+    for d in docs:
+        new = _node_state(d)
+        prev = old.get(d["_id"])
+        if prev is not None:
+            prev = {k: v for k, v in prev.items() if k != "_id"}
+        delta.update(_contrib(new))
+        delta.subtract(_contrib(prev))
+        update = {"$set": new}
+        unset = {k: "" for k in ("batt_bin", "day", "rssi_band") if k not in new}
+        if unset:
+            update["$unset"] = unset
+        ops.append(UpdateOne({"_id": d["_id"]}, update, upsert=True))
+        upd = d.get("_updated")
+        if isinstance(upd, datetime) and (hwm is None or upd > hwm):
+            hwm = upd
+
+    for _id in dels:
+        prev = old.get(_id)
+        if prev is None:
+            continue
+        delta.subtract(_contrib({k: v for k, v in prev.items() if k != "_id"}))
+        ops.append(DeleteOne({"_id": _id}))
+
+    if ops:
+        db[STATE_COLL].bulk_write(ops, ordered=False)
+
+    update: Dict[str, Any] = {"$set": {"refreshed_at": datetime.utcnow()}}
+    inc = {k: v for k, v in delta.items() if v}
+    if inc:
+        update["$inc"] = inc
+    if hwm is not None:
+        update["$max"] = {"hwm": hwm}
+    db[ROLLUP_COLL].update_one({"_id": ROLLUP_ID}, update, upsert=True)
+    return len(ids)
+
+
+# ---------------------------------------------------------------------------
+# Reconstruction complète / rafraîchissement incrémental
+# ---------------------------------------------------------------------------
+def rebuild_rollup(company: str, owner: str) -> Dict[str, Any]:
+    """
+    Recalcule tout le rollup (premier passage, ou après suppressions non
+    suivies). L’appelant tient le bail `owner` : il est prolongé avant chaque
+    lot et la reconstruction s’arrête s’il est perdu (un autre écrivain a pu
+    vider la collection temporaire).
+    """
+    db    = client[company]
+    nodes = get_nodes_collection(company)
+
+    # construit à côté puis renommé : l’état n’est jamais vide pour les lecteurs
+    tmp = db[f"{STATE_COLL}_rebuild"]
+    tmp.drop()
+    total: Counter = Counter()
+    hwm = None
+    states = []
+    for d in nodes.find({}, NODE_PROJ).batch_size(BATCH_SIZE):
+        st = _node_state(d)
+        total.update(_contrib(st))
+        states.append({"_id": d["_id"], **st})
+        upd = d.get("_updated")
+        if isinstance(upd, datetime) and (hwm is None or upd > hwm):
+            hwm = upd
+        if len(states) >= BATCH_SIZE:
+            _keep_lease(company, owner)
+            tmp.insert_many(states, ordered=False)
+            states = []
+    _keep_lease(company, owner)
+    if states:
+        tmp.insert_many(states, ordered=False)
+    if total:
+        tmp.rename(STATE_COLL, dropTarget=True)
+    else:
+        db[STATE_COLL].drop()
+
+    doc: Dict[str, Any] = {
+        "by_node_type": {}, "battery_bins": {}, "last_com_days": {}, "rssi_bands": {},
+        "hwm": hwm, "refreshed_at": datetime.utcnow(), "full_at": datetime.utcnow(),
+    }
+    for key, n in total.items():
+        field, val = key.split(".", 1)
+        doc[field][val] = n
+    db[ROLLUP_COLL].replace_one({"_id": ROLLUP_ID}, doc, upsert=True)
+    print(f"[{company}] sensor_health_rollup reconstruit ({sum(doc['by_node_type'].values())} nœuds)")
+    return doc
+
+
+def _needs_rebuild(company: str, current: Dict[str, Any] | None) -> bool:
+    if not current or current.get("hwm") is None:
+        return True
+    full_at = current.get("full_at")
+    if full_at is None or (datetime.utcnow() - full_at.replace(tzinfo=None)).total_seconds() > ROLLUP_FULL_EVERY:
+        return True
+    # suppressions non vues par le polling : le total dérive
+    tracked = sum(current.get("by_node_type", {}).values())
+    return tracked != get_nodes_collection(company).estimated_document_count()
+
+
+def _refresh(company: str, owner: str, full: bool) -> int:
+    db = client[company]
+    current = db[ROLLUP_COLL].find_one(
+        {"_id": ROLLUP_ID}, {"hwm": 1, "full_at": 1, "by_node_type": 1}
+    )
+    if full or _needs_rebuild(company, current):
+        doc = rebuild_rollup(company, owner)
+        return sum(doc["by_node_type"].values())
+
+    nodes = get_nodes_collection(company)
+    cur = (nodes.find({"_updated": {"$gte": current["hwm"]}}, NODE_PROJ)
+                .sort("_updated", 1)
+                .batch_size(BATCH_SIZE))
+
+    seen, batch = 0, []
+    for d in cur:
+        batch.append(d)
+        if len(batch) >= BATCH_SIZE:
+            seen += apply_changes(company, batch)
+            batch = []
+    seen += apply_changes(company, batch)
+    if not seen:
+        db[ROLLUP_COLL].update_one({"_id": ROLLUP_ID}, {"$set": {"refreshed_at": datetime.utcnow()}})
+    return seen
+
+
+def refresh_rollup(company: str, full: bool = False) -> int:
+    """
+    Intègre les nœuds dont `_updated` ≥ hwm (reconstruction complète si le
+    rollup n’existe pas encore, si `full`, s’il date de plus de
+    ROLLUP_FULL_EVERY s ou si son total a dérivé). Renvoie le nombre de
+    nœuds lus, 0 si un autre écrivain tient le bail.
+    """
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(company, owner):
+        logging.info(f"sensor_rollup({company}) : bail tenu par un autre écrivain, passage ignoré")
+        return 0
+    try:
+        return _refresh(company, owner, full)
+    finally:
+        _release_lease(company, owner)
+
+
+def watch_rollup(company: str, stop=None) -> None:
+    """
+    Suit les change streams de `network_nodes` (replica set requis) et
+    applique chaque événement ; le resume token est stocké dans le rollup.
+    Tient le bail écrivain tant qu’il tourne (renouvelé au tiers de
+    ROLLUP_LEASE_TTL) ; s’arrête s’il le perd.
+    `stop` : threading.Event optionnel pour interrompre la boucle.
+    """
+    db = client[company]
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(company, owner):
+        raise RuntimeError(f"watch_rollup({company}) : bail tenu par un autre écrivain")
+    renew_at = time.monotonic() + ROLLUP_LEASE_TTL / 3
+    try:
+        _refresh(company, owner, full=False)
+        token = (db[ROLLUP_COLL].find_one({"_id": ROLLUP_ID}, {"resume_token": 1}) or {}).get("resume_token")
+        with get_nodes_collection(company).watch(
+            full_document="updateLookup", resume_after=token, max_await_time_ms=1_000
+        ) as stream:
+            while stream.alive and not (stop and stop.is_set()):
+                if time.monotonic() >= renew_at:
+                    if not _acquire_lease(company, owner):
+                        logging.error(f"watch_rollup({company}) : bail perdu, arrêt")
+                        return
+                    renew_at = time.monotonic() + ROLLUP_LEASE_TTL / 3
+                    # pas d’événement ≠ rollup périmé : read_rollup reste servi
+                    db[ROLLUP_COLL].update_one({"_id": ROLLUP_ID},
+                                               {"$set": {"refreshed_at": datetime.utcnow()}})
+                ev = stream.try_next()
+                if ev is None:
+                    continue
+                op = ev["operationType"]
+                if op in ("insert", "update", "replace") and ev.get("fullDocument"):
+                    apply_changes(company, [ev["fullDocument"]])
+                elif op == "delete":
+                    apply_changes(company, [], [ev["documentKey"]["_id"]])
+                db[ROLLUP_COLL].update_one({"_id": ROLLUP_ID}, {"$set": {"resume_token": stream.resume_token}})
+    except errors.OperationFailure as exc:
+        logging.error(f"watch_rollup({company}) : change streams indisponibles – {exc}")
+        raise
+    finally:
+        _release_lease(company, owner)
+
+
+# ---------------------------------------------------------------------------
+# Lecture
+# ---------------------------------------------------------------------------
+def read_rollup(company: str, max_age: int = ROLLUP_MAX_AGE) -> Dict[str, Any] | None:
+    """Le document de rollup s’il a été rafraîchi il y a moins de `max_age` s, sinon None."""
+    if max_age <= 0:
+        return None
+    doc = client[company][ROLLUP_COLL].find_one({"_id": ROLLUP_ID}, {"resume_token": 0})
+    if not doc or not doc.get("refreshed_at"):
+        return None
+    age = (datetime.utcnow() - doc["refreshed_at"].replace(tzinfo=None)).total_seconds()
+    return doc if age <= max_age else None
+
+
+def rollup_connectivity(rollup: Dict[str, Any], seuil: datetime) -> Dict[str, int] | None:
+    """connected / disconnected pour un seuil à minuit UTC (sinon None)."""
+    if (seuil.hour, seuil.minute, seuil.second, seuil.microsecond) != (0, 0, 0, 0):
+        return None
+    cut = seuil.strftime("%Y-%m-%d")
+    days = rollup.get("last_com_days", {})
+    connected    = sum(n for d, n in days.items() if d >= cut)
+    disconnected = sum(n for d, n in days.items() if d < cut)
+    return {"connected": connected, "disconnected": disconnected}
+
+
+def rollup_battery(rollup: Dict[str, Any], critical_threshold: int,
+                   warning_threshold: int) -> Dict[str, int] | None:
+    """Compteurs batterie si les seuils tombent sur des bornes de tranche (sinon None)."""
+    if critical_threshold % BATT_BIN or warning_threshold % BATT_BIN:
+        return None
+    crit_bin, warn_bin = critical_threshold // BATT_BIN, warning_threshold // BATT_BIN
+    counts = {"critical": 0, "warning": 0, "ok": 0}
+    for b, n in rollup.get("battery_bins", {}).items():
+        b = int(b)
+        key = "critical" if b < crit_bin else "warning" if b < warn_bin else "ok"
+        counts[key] += n
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Met à jour sensor_health_rollup pour une compagnie donnée"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    parser.add_argument("--full", action="store_true",
+                        help="Reconstruction complète au lieu de l’incrémental")
+    parser.add_argument("--watch", action="store_true",
+                        help="Suit les change streams (replica set requis)")
+    args = parser.parse_args()
+    if args.watch:
+        watch_rollup(args.company)
+    else:
+        n = refresh_rollup(args.company, full=args.full)
+        print(f"[{args.company}] {n} nœuds intégrés")
@@ -1,6 +1,9 @@
+import os
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Any
-from backend.db import get_nodes_collection
+from backend.db import get_nodes_collection, list_companies, fan_out
+from backend.utils.cursor import encode_cursor, decode_cursor, after_key_filter
+from backend.tools.sensor_rollup import read_rollup, rollup_connectivity, rollup_battery
 
 # seuil hors-ligne configurable (jours)
 OFFLINE_DAYS = 2
@@ -23,57 +26,174 @@ def _offline_threshold() -> datetime:
     return thresh.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-def connectivity_overview(company: str) -> Dict[str, Any]:
+# plafond historique de la liste hors-ligne (mode non paginé)
+OFFLINE_MAX_ITEMS = 10_000
+
+# clé de tri stable de la liste hors-ligne (index node_type/last_com/address)
+OFFLINE_SORT = [("last_com", 1), ("address", 1)]
+
+OFFLINE_PROJ = {
+    "_id": 0,
+    "address": 1,
+    "batt": 1,
+    "parent": 1,
+    "rssi": 1,
+    "last_com": 1,
+}
+
+
+def _is_date(field: str) -> dict:
+    # count_documents({last_com: {$lt: d}}) ignore les valeurs non-date ;
+    # en $expr, null < date → on filtre explicitement sur le type.
+    return {"$eq": [{"$type": field}, "date"]}
+
+
+def connectivity_overview(
+    company: str,
+    page_size: int | None = None,
+    cursor: str | None = None,
+    use_rollup: bool = True,
+) -> Dict[str, Any]:
     """
-    Retourne l’état global des capteurs :
+    Retourne l’état global des capteurs (un seul aller-retour $facet hors
+    pagination) :
 
       connected_count      : nombre de capteurs en ligne
       disconnected_count   : nombre de capteurs hors-ligne
       total                : total capteurs (node_type = 2)
-      items                : capteurs hors-ligne (jusqu’à 10 000) avec
-                             address, batt, parent, rssi, last_com
+      items                : capteurs hors-ligne triés par (last_com, address)
+                             avec address, batt, parent, rssi, last_com
+
+    Sans `page_size` : jusqu’à OFFLINE_MAX_ITEMS items (comportement historique).
+    Avec `page_size` : une page de la liste (find trié + limit sur l’index,
+    hors $facet) + `next_cursor` (None à la fin), à repasser dans `cursor`
+    pour la page suivante. Sans rollup frais, les compteurs ne sont
+    calculés qu’à la première page (absents des pages suivantes).
+
+    Si le rollup `sensor_health_rollup` est frais, les compteurs en
+    viennent et seule la liste (index node_type/last_com/address) est lue.
     """
     seuil = _offline_threshold()
-    filt  = {"node_type": 2}
-
     nodes = get_nodes_collection(company)
 
-    connected     = nodes.count_documents({**filt, "last_com": {"$gte": seuil}})
-    disconnected  = nodes.count_documents({**filt, "last_com": {"$lt":  seuil}})
-    total         = connected + disconnected
-
-    # Projection
-    proj = {
-        "_id": 0,
-        "address": 1,
-        "batt": 1,
-        "parent": 1,
-        "rssi": 1,
-        "last_com": 1,
-    }
+    items_match: Dict[str, Any] = {"last_com": {"$lt": seuil}}
+    if cursor:
+        last = decode_cursor(cursor)
+        items_match = {"$and": [items_match, after_key_filter(OFFLINE_SORT, last)]}
 
-    items = (
-        nodes.find({**filt, "last_com": {"$lt": seuil}}, proj)
-             .sort("last_com", 1)
-             .limit(10_000)
-    )
-    items = list(items)
+    # une ligne de plus pour savoir s’il reste une page
+    limit = page_size + 1 if page_size else OFFLINE_MAX_ITEMS
+
+    rollup = read_rollup(company) if use_rollup else None
+    rolled = rollup_connectivity(rollup, seuil) if rollup else None
+    if rolled or page_size:
+        # liste : requête dédiée sur l’index node_type/last_com/address,
+        # jamais dans un $facet (qui relirait tous les capteurs à chaque page)
+        items = list(
+            nodes.find({"node_type": 2, **items_match}, OFFLINE_PROJ)
+                 .sort(OFFLINE_SORT)
+                 .limit(limit)
+        )
+        if rolled:
+            return _connectivity_result(rolled, items, page_size, rollup["refreshed_at"])
+        # compteurs live : première page seulement
+        counts = None if cursor else next(
+            nodes.aggregate([{"$match": {"node_type": 2}}, _counts_stage(seuil)]), {}
+        )
+        return _connectivity_result(counts, items, page_size)
+
+    pipeline = [
+        {"$match": {"node_type": 2}},
+        {"$facet": {
+            "counts": [_counts_stage(seuil)],
+            "items": [
+                {"$match": items_match},
+                {"$sort": dict(OFFLINE_SORT)},
+                {"$limit": limit},
+                {"$project": OFFLINE_PROJ},
+            ],
+        }},
+    ]
+
+    raw    = next(nodes.aggregate(pipeline, allowDiskUse=True), {})
+    counts = (raw.get("counts") or [{}])[0]
+    return _connectivity_result(counts, raw.get("items", []), page_size)
+
+
+def _counts_stage(seuil: datetime) -> dict:
+    return {"$group": {
+        "_id": None,
+        "connected": {"$sum": {"$cond": [
+            {"$and": [_is_date("$last_com"), {"$gte": ["$last_com", seuil]}]}, 1, 0
+        ]}},
+        "disconnected": {"$sum": {"$cond": [
+            {"$and": [_is_date("$last_com"), {"$lt": ["$last_com", seuil]}]}, 1, 0
+        ]}},
+    }}
 
-    return {
-        "connected_count": connected,
-        "disconnected_count": disconnected,
-        "total": total,
-        "items": items
-    }
+
+def _connectivity_result(
+    counts: Dict[str, int] | None,
+    items: list,
+    page_size: int | None,
+    as_of: datetime | None = None,
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"items": items, "source": "rollup" if as_of else "live"}
+    if counts is not None:
+        connected    = counts.get("connected", 0)
+        disconnected = counts.get("disconnected", 0)
+        result.update({
+            "connected_count": connected,
+            "disconnected_count": disconnected,
+            "total": connected + disconnected,
+        })
+    if as_of:
+        result["as_of"] = as_of
+
+    if page_size:
+        has_more = len(items) > page_size
+        items = items[:page_size]
+        result["items"] = items
+        result["next_cursor"] = (
+            encode_cursor({f: items[-1].get(f) for f, _ in OFFLINE_SORT})
+            if has_more and items else None
+        )
+
+    return result
 
 # --- Nouvelle fonction battery_overview ---
 DEFAULT_SAMPLE_SIZE = 10
 
+BATTERY_PROJ = {"_id": 0, "address": 1, "batt": 1, "parent": 1, "rssi": 1}
+
+# ordre de tri par catégorie (échantillons et liste complète)
+BATTERY_SORT = {
+    "critical": [("batt", 1),  ("address", 1)],
+    "warning":  [("batt", 1),  ("address", 1)],
+    "ok":       [("batt", -1), ("address", 1)],
+}
+
+
+def _battery_ranges(critical_threshold: int, warning_threshold: int) -> Dict[str, dict]:
+    """Filtre `batt` de chaque catégorie."""
+    if critical_threshold >= warning_threshold:
+        raise ValueError(
+            f"warning_threshold ({warning_threshold}) doit être > "
+            f"critical_threshold ({critical_threshold})"
+        )
+    return {
+        "critical": {"$lt": critical_threshold},
+        "warning":  {"$gte": critical_threshold, "$lt": warning_threshold},
+        "ok":       {"$gte": warning_threshold},
+    }
+
+
 def battery_overview(
     company: str,
     critical_threshold: int,
     warning_threshold: int,
-    sample_size: int = DEFAULT_SAMPLE_SIZE
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    use_rollup: bool = True,
 ) -> Dict[str, Any]:
     """
     Retourne l'état des batteries pour l'entreprise `company` :
@@ -81,6 +201,14 @@ def battery_overview(
       - warning  : critical_threshold <= batt < warning_threshold
       - ok       : batt >= warning_threshold
 
+    Une seule agrégation : $bucket sur `batt` (bornes = seuils) avec, par
+    bucket, le comptage et les `sample_size` plus basses / plus hautes
+    valeurs ($topN, MongoDB ≥ 5.2).
+
+    Si le rollup `sensor_health_rollup` est frais et les seuils alignés sur
+    ses tranches, les compteurs en viennent et seuls les échantillons sont
+    lus (`sample_size` premiers de chaque catégorie sur l’index).
+
     Renvoie :
       {
         "counts": {"critical": X, "warning": Y, "ok": Z},
@@ -90,52 +218,72 @@ def battery_overview(
       }
     """
     print(f"[DEBUG] battery_overview thresholds → critical={critical_threshold}, warning={warning_threshold}")
+    ranges = _battery_ranges(critical_threshold, warning_threshold)
     nodes = get_nodes_collection(company)
-    base_filter = {"node_type": 2}
-
-    # Comptages
-    crit_count = nodes.count_documents({
-        **base_filter, "batt": {"$lt": critical_threshold}
-    })
-    warn_count = nodes.count_documents({
-        **base_filter,
-        "batt": {"$gte": critical_threshold, "$lt": warning_threshold}
-    })
-    ok_count = nodes.count_documents({
-        **base_filter, "batt": {"$gte": warning_threshold}
-    })
-    print(f"[DEBUG] counts → critical={crit_count}, warning={warn_count}, ok={ok_count}")
-
-    # Projection
-    proj = {"_id": 0, "address": 1, "batt": 1, "parent": 1, "rssi": 1}
-
-    # Échantillons triés
-    items_critical = list(
-        nodes.find({**base_filter, "batt": {"$lt": critical_threshold}}, proj)
-             .sort("batt", 1)
-             .limit(sample_size)
-    )
-    items_warning = list(
-        nodes.find({
-            **base_filter,
-            "batt": {"$gte": critical_threshold, "$lt": warning_threshold}
-        }, proj)
-        .sort("batt", 1)
-        .limit(sample_size)
-    )
-    items_ok = list(
-        nodes.find({**base_filter, "batt": {"$gte": warning_threshold}}, proj)
-             .sort("batt", -1)
-             .limit(sample_size)
-    )
 
-    return {
-        "counts": {"critical": crit_count, "warning": warn_count, "ok": ok_count},
-        "items_critical": items_critical,
-        "items_warning": items_warning,
-        "items_ok": items_ok
+    rollup = read_rollup(company) if use_rollup else None
+    rolled = rollup_battery(rollup, critical_threshold, warning_threshold) if rollup else None
+    if rolled:
+        samples = {
+            cat: list(
+                nodes.find({"node_type": 2, "batt": rng}, BATTERY_PROJ)
+                     .sort(BATTERY_SORT[cat])
+                     .limit(sample_size)
+            ) if sample_size and rolled[cat] else []
+            for cat, rng in ranges.items()
+        }
+        return {
+            "counts": rolled,
+            "items_critical": samples["critical"],
+            "items_warning":  samples["warning"],
+            "items_ok":       samples["ok"],
+            "source": "rollup",
+            "as_of":  rollup["refreshed_at"],
+        }
+
+    sample = {k: f"${k}" for k, v in BATTERY_PROJ.items() if v}
+    output: Dict[str, Any] = {"count": {"$sum": 1}}
+    if sample_size > 0:                       # $topN refuse n = 0
+        output["lowest"] = {"$topN": {
+            "n": sample_size, "output": sample,
+            "sortBy": dict(BATTERY_SORT["critical"]),
+        }}
+        output["highest"] = {"$topN": {
+            "n": sample_size, "output": sample,
+            "sortBy": dict(BATTERY_SORT["ok"]),
+        }}
+    pipeline = [
+        # count_documents({batt: {$lt: …}}) n'a jamais compté les batt non numériques
+        {"$match": {"node_type": 2, "batt": {"$type": "number"}}},
+        {"$bucket": {
+            "groupBy": "$batt",
+            "boundaries": [float("-inf"), critical_threshold, warning_threshold, float("inf")],
+            # NaN (et ±inf) hors des bornes : bucket à part, ignoré ci-dessous
+            "default": "other",
+            "output": output,
+        }},
+    ]
+
+    # _id du bucket = borne inférieure
+    buckets = {b["_id"]: b for b in nodes.aggregate(pipeline) if b["_id"] != "other"}
+    crit = buckets.get(float("-inf"), {})
+    warn = buckets.get(critical_threshold, {})
+    ok   = buckets.get(warning_threshold, {})
+
+    counts = {
+        "critical": crit.get("count", 0),
+        "warning":  warn.get("count", 0),
+        "ok":       ok.get("count", 0),
     }
+    print(f"[DEBUG] counts → critical={counts['critical']}, warning={counts['warning']}, ok={counts['ok']}")
 
+    return {
+        "counts": counts,
+        "items_critical": crit.get("lowest", []),
+        "items_warning":  warn.get("lowest", []),
+        "items_ok":       ok.get("highest", []),
+        "source": "live",
+    }
 
 
 def battery_list(
@@ -143,16 +291,121 @@ def battery_list(
     category: str,  # "critical", "warning" ou "ok"
     critical_threshold: int,
     warning_threshold: int,
+    page_size: int | None = None,
+    cursor: str | None = None,
 ) -> dict:
     """
     Retourne la liste des addresses pour la catégorie demandée.
+
+    Requête dédiée (index node_type/batt/address) : liste complète par défaut,
+    ou une page de `page_size` adresses + `next_cursor` à repasser dans `cursor`.
     """
-    # On appelle l’overview pour récupérer toutes les listes
-    overview = battery_overview(company, critical_threshold, warning_threshold)
-    mapping = {
-        "critical": overview["items_critical"],
-        "warning":  overview["items_warning"],
-        "ok":       overview["items_ok"],
+    cat = (category or "").lower()
+    ranges = _battery_ranges(critical_threshold, warning_threshold)
+    if cat not in ranges:
+        return {"category": category, "addresses": [], "next_cursor": None}
+
+    sort = BATTERY_SORT[cat]
+    filt: Dict[str, Any] = {"node_type": 2, "batt": ranges[cat]}
+    if cursor:
+        filt = {"$and": [filt, after_key_filter(sort, decode_cursor(cursor))]}
+
+    nodes = get_nodes_collection(company)
+    cur = nodes.find(filt, {"_id": 0, "address": 1, "batt": 1}).sort(sort)
+    if page_size:
+        cur = cur.limit(page_size + 1)
+    docs = list(cur)
+
+    next_cursor = None
+    if page_size and len(docs) > page_size:
+        docs = docs[:page_size]
+        next_cursor = encode_cursor({f: docs[-1].get(f) for f, _ in sort})
+
+    return {
+        "category": category,
+        "addresses": [d["address"] for d in docs],
+        "next_cursor": next_cursor,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Vues « flotte » : toutes les entreprises en parallèle
+# ---------------------------------------------------------------------------
+FLEET_MAX_WORKERS = int(os.getenv("FLEET_MAX_WORKERS", "8"))
+FLEET_TOP_N       = 10
+
+
+def _fleet_companies(companies: list[str] | None) -> list[str]:
+    return sorted(companies or list_companies(), key=str.lower)
+
+
+def fleet_connectivity_overview(
+    companies: list[str] | None = None,
+    top_n: int = FLEET_TOP_N,
+    max_workers: int = FLEET_MAX_WORKERS,
+) -> Dict[str, Any]:
+    """
+    connectivity_overview sur plusieurs bases (toutes par défaut).
+    Chaque base ne renvoie que ses compteurs et ses `top_n` plus anciens
+    capteurs hors-ligne.
+
+      per_company : [{company, connected_count, disconnected_count, total, items}]
+      totals      : sommes sur la flotte
+      errors      : {company: message} pour les bases en échec
+    """
+    comps = _fleet_companies(companies)
+
+    def one(comp: str) -> Dict[str, Any]:
+        res = connectivity_overview(comp, page_size=top_n)
+        res.pop("next_cursor", None)
+        return res
+
+    results, errs = fan_out(comps, one, max_workers=max_workers)
+
+    per_company = [{"company": c, **results[c]} for c in comps if c in results]
+    totals = {
+        k: sum(r[k] for r in per_company)
+        for k in ("connected_count", "disconnected_count", "total")
+    }
+    return {
+        "fleet": "connectivity",
+        "per_company": per_company,
+        "totals": totals,
+        "errors": errs,
+    }
+
+
+def fleet_battery_overview(
+    critical_threshold: int,
+    warning_threshold: int,
+    companies: list[str] | None = None,
+    top_n: int = FLEET_TOP_N,
+    max_workers: int = FLEET_MAX_WORKERS,
+) -> Dict[str, Any]:
+    """
+    battery_overview sur plusieurs bases (toutes par défaut), `top_n`
+    échantillons par catégorie et par base.
+
+      per_company : [{company, counts, items_critical, items_warning, items_ok}]
+      totals      : {"critical": X, "warning": Y, "ok": Z} sur la flotte
+      errors      : {company: message} pour les bases en échec
+    """
+    _battery_ranges(critical_threshold, warning_threshold)      # validation
+    comps = _fleet_companies(companies)
+
+    def one(comp: str) -> Dict[str, Any]:
+        return battery_overview(comp, critical_threshold, warning_threshold, sample_size=top_n)
+
+    results, errs = fan_out(comps, one, max_workers=max_workers)
+
+    per_company = [{"company": c, **results[c]} for c in comps if c in results]
+    totals = {
+        k: sum(r["counts"][k] for r in per_company)
+        for k in ("critical", "warning", "ok")
+    }
+    return {
+        "fleet": "battery",
+        "per_company": per_company,
+        "totals": totals,
+        "errors": errs,
     }
-    items = mapping.get(category.lower(), [])
-    return {"category": category, "addresses": [d["address"] for d in items]}
@@ -16,18 +16,19 @@ Reconstruit un graphe **non dirigé** de connectivité pour une entreprise :
   collection sont créés avec le type `unknown`.
 
 La sortie est directement compatible avec le front (format `{nodes, links}`).
+Le graphe vit dans un `TopologyEngine` (tools/topology_engine.py) construit
+une fois puis patché à partir des changements de `network_nodes`.
 """
 
 from __future__ import annotations
 
-import time
 from typing import Any, Dict, List, Tuple, Set, Iterable
 from collections import defaultdict
 
 from backend.db import get_nodes_collection
 
 # ---------------------------------------------------------------------------
-# Constantes & cache
+# Constantes
 # ---------------------------------------------------------------------------
 import os
 
@@ -40,8 +41,6 @@ LQI_GOOD    = int(os.getenv("LQI_GOOD",    50))
 LQI_MEDIUM  = int(os.getenv("LQI_MEDIUM",  30))
 
 NULL_PREFIX  = "0000"
-_CACHE_TTL   = 60          # secondes
-_CACHE: dict[str, Tuple[float, dict[str, list[dict[str, Any]]]]] = {}
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -131,8 +130,55 @@ def _classify_quality(metrics: Dict[str, Any]) -> str:
 # ---------------------------------------------------------------------------
 # Construction du graphe
 # ---------------------------------------------------------------------------
+def _node_links(n: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Arêtes déclarées par UN document, dans l'ordre historique
+    (parent, parents[], neighbor_gateways, neighbor_transmitters) :
+    liste de (adresse cible, lien {source, target, kind, metrics, quality}).
+    Les doublons éventuels sont laissés à l'appelant.
+    """
+    src = _clean_addr(n.get("address"))
+    if not src:
+        return []
+    out: List[Tuple[str, Dict[str, Any]]] = []
+
+    def _link(target: str, kind: str, met: Dict[str, Any]) -> None:
+        out.append((target, {"source": src, "target": target, "kind": kind,
+                             "metrics": met, "quality": _classify_quality(met)}))
+
+    # Parents: 'parent' unique
+    addr_p = _clean_addr(n.get("parent"))
+    if addr_p:
+        _link(addr_p, "parent", _extract_metrics(n, "parent", None))
+
+    # Parents: liste
+    for raw in n.get("parents", []):
+        if isinstance(raw, str):
+            addr_p = _clean_addr(raw)
+        elif isinstance(raw, dict):
+            addr_p = _clean_addr(raw.get("address"))
+        else:
+            addr_p = None
+        if addr_p:
+            _link(addr_p, "parent", _extract_metrics(n, "parent", raw))
+
+    # Voisins: gateways & transmetteurs
+    for field in ("neighbor_gateways", "neighbor_transmitters"):
+        for raw in n.get(field, []):
+            if isinstance(raw, str):
+                addr_n, raw_entry = _clean_addr(raw), None
+            elif isinstance(raw, dict):
+                addr_n, raw_entry = _clean_addr(raw.get("address")), raw
+            else:
+                continue
+            if addr_n:
+                _link(addr_n, "neighbor", _extract_metrics(n, "neighbor", raw_entry))
+    return out
+
+
 def _collect_nodes_links(nodes: List[Dict[str, Any]]
                          ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Construction complète (une passe) ; les arêtes sont dédupliquées sans orientation."""
     node_kinds: Dict[str, str] = {}
     links_out: List[Dict[str, Any]] = []
     seen_edges: Set[frozenset[str]] = set()
@@ -148,57 +194,12 @@ def _collect_nodes_links(nodes: List[Dict[str, Any]]
             continue
         _add_node(src, _node_kind(n))
 
-        # -------------------- parents -------------------------------------
-        # Parents: 'parent' unique
-        raw_p = n.get("parent")
-        addr_p = _clean_addr(raw_p)
-        if addr_p:
-            key = frozenset((src, addr_p))
+        for target, link in _node_links(n):
+            key = frozenset((src, target))
             if key not in seen_edges:
                 seen_edges.add(key)
-                met = _extract_metrics(n, "parent", None)
-                qual = _classify_quality(met)
-                links_out.append({"source": src, "target": addr_p, "kind": "parent", "metrics": met, "quality": qual})
-            _add_node(addr_p, node_kinds.get(addr_p, "unknown"))
-
-        # Parents: liste
-        for raw in n.get("parents", []):
-            if isinstance(raw, str):
-                addr_p = _clean_addr(raw)
-            elif isinstance(raw, dict):
-                addr_p = _clean_addr(raw.get("address"))
-            else:
-                addr_p = None
-            if not addr_p:
-                continue
-            key = frozenset((src, addr_p))
-            if key not in seen_edges:
-                seen_edges.add(key)
-                met = _extract_metrics(n, "parent", raw)
-                qual = _classify_quality(met)
-                links_out.append({"source": src, "target": addr_p, "kind": "parent", "metrics": met, "quality": qual})
-            _add_node(addr_p, node_kinds.get(addr_p, "unknown"))
-
-        # Voisins: gateways & transmetteurs
-        for field, kind in (("neighbor_gateways", "neighbor"), ("neighbor_transmitters", "neighbor")):
-            for raw in n.get(field, []):
-                if isinstance(raw, str):
-                    addr_n = _clean_addr(raw)
-                    raw_entry = None
-                elif isinstance(raw, dict):
-                    addr_n = _clean_addr(raw.get("address"))
-                    raw_entry = raw
-                else:
-                    continue
-                if not addr_n:
-                    continue
-                key = frozenset((src, addr_n))
-                if key not in seen_edges:
-                    seen_edges.add(key)
-                    met = _extract_metrics(n, "neighbor", raw_entry)
-                    qual = _classify_quality(met)
-                    links_out.append({"source": src, "target": addr_n, "kind": kind, "metrics": met, "quality": qual})
-                _add_node(addr_n, node_kinds.get(addr_n, "unknown"))
+                links_out.append(link)
+            _add_node(target, node_kinds.get(target, "unknown"))
 
     nodes_out = [{"id": addr, "type": kind} for addr, kind in node_kinds.items()]
     return nodes_out, links_out
@@ -206,44 +207,38 @@ def _collect_nodes_links(nodes: List[Dict[str, Any]]
 # ---------------------------------------------------------------------------
 # API principale
 # ---------------------------------------------------------------------------
+NODE_PROJECTION = {
+    "_id": 1,
+    "address": 1,
+    "node_type": 1,
+    "battery": 1,
+    "last_com": 1,
+    "parent": 1,
+    "parents": 1,
+    "neighbor_gateways": 1,
+    "neighbor_transmitters": 1,
+    "lqi_up": 1,
+    "lqi_down": 1,
+    "rssi": 1,
+    "network_partition_id": 1,
+    "_updated": 1,
+}
+
+
 def get_network_topology(company: str, use_cache: bool = True
                          ) -> dict[str, list[dict[str, Any]]]:
     """
     Retourne un objet {nodes, links} prêt à être serialisé vers le front.
+
+    Le graphe est tenu en mémoire par un TopologyEngine (construit une fois
+    puis patché) ; `use_cache=False` force l'intégration immédiate des
+    derniers changements.
     """
-    if use_cache and company in _CACHE:
-        ts, cached = _CACHE[company]
-        if time.time() - ts < _CACHE_TTL:
-            return cached
-
-    coll = get_nodes_collection(company)
-    projection = {
-        "_id": 0,
-        "address": 1,
-        "node_type": 1,
-        "battery": 1,
-        "last_com": 1,
-        "parent": 1,
-        "parents": 1,
-        "neighbor_gateways": 1,
-        "neighbor_transmitters": 1,
-        "lqi_up": 1,
-        "lqi_down": 1,
-        "rssi": 1,
-    }
-    nodes: List[Dict[str, Any]] = list(coll.find({}, projection))
-
-    nodes_out, links_out = _collect_nodes_links(nodes)
-
-    raw_map = { _clean_addr(n["address"]): n for n in nodes }
-    for nd in nodes_out:
-        doc = raw_map.get(nd["id"], {})
-        nd["battery"] = doc.get("battery")
-        nd["last_com"] = doc.get("last_com")
-    topo = {"nodes": nodes_out, "links": links_out}
-
-    _CACHE[company] = (time.time(), topo)
-    return topo
+    from backend.tools.topology_engine import get_engine   # import local (cycle)
+
+    engine = get_engine(company)
+    engine.sync(force=not use_cache)
+    return engine.snapshot()
 
 
 def topology_to_d3(topology: dict[str, list[dict[str, Any]]]
@@ -0,0 +1,395 @@
+"""
+app/tools/topology_engine.py
+----------------------------
+
+Graphe de topologie **incrémental**, un moteur par entreprise :
+
+• construit une seule fois depuis `network_nodes` ;
+• patché ensuite nœud par nœud, soit par polling sur `_updated`
+  (`sync()`), soit par change streams (`watch()`, replica set requis) ;
+• un nœud modifié retire ses anciennes arêtes et déclare les nouvelles,
+  sans reconstruire le reste du graphe ;
+• `snapshot()` renvoie à tout moment le même format `{nodes, links}` que
+  `_collect_nodes_links` (snapshot mis en cache jusqu'au prochain changement).
+
+Chaque version effective est journalisée (`changelog`, anneau borné) avec
+l'état avant / après des nœuds touchés : `changes(since=jeton)` renvoie
+nœuds ajoutés / retirés, capteurs re-parentés et changements de qualité de
+lien sans renvoyer le graphe complet.
+
+Le jeton de version (`token()`, « epoch.version ») est propre à un moteur :
+`epoch` est tiré à sa création, donc un jeton émis par un autre worker ou
+avant un redémarrage / `drop_engine` est refusé (`full=True`, relire tout).
+
+Les suppressions ne sont visibles qu'en change stream ; en polling, un écart
+entre le nombre de documents connus et `estimated_document_count()` déclenche
+un rechargement complet. Un rechargement ne vide pas l'historique : l'écart
+avec l'état précédent (nœuds disparus compris) y est journalisé comme une
+version.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, List
+
+from pymongo import errors
+
+from backend.db import get_nodes_collection
+from backend.tools.topology import (
+    NODE_PROJECTION, _clean_addr, _node_kind, _node_links,
+)
+from backend.tools.topology_graph import CompactGraph
+from backend.utils.cache import MeteredTTLCache
+
+# ---------------------------------------------------------------------------
+# Paramètres
+# ---------------------------------------------------------------------------
+TOPO_POLL_INTERVAL = int(os.getenv("TOPO_POLL_INTERVAL", "60"))        # s
+TOPO_FULL_RELOAD   = int(os.getenv("TOPO_FULL_RELOAD", str(6 * 3600)))  # s
+TOPO_CHANGELOG     = int(os.getenv("TOPO_CHANGELOG", "500"))            # versions gardées
+
+
+class TopologyEngine:
+    """Graphe en mémoire d'une entreprise, patché par deltas."""
+
+    def __init__(self, company: str):
+        self.company = company
+        self._lock = threading.RLock()
+        self.version = 0                  # +1 à chaque changement effectif
+        self.hwm = None                   # plus grand `_updated` intégré
+        self.synced_at = 0.0
+        self.loaded_at = 0.0
+        self.started_at = 0.0             # premier chargement (début de l'historique)
+        self.epoch = uuid.uuid4().hex[:12]   # identifie l'historique de CE moteur
+        self.base_version = 0             # version du premier chargement
+        self.changelog: deque = deque(maxlen=TOPO_CHANGELOG)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.docs: Dict[str, Dict[str, Any]] = {}        # adresse → doc projeté
+        self.addr_by_id: Dict[Any, str] = {}             # _id Mongo → adresse
+        self.known_ids: set = set()                      # tous les _id lus
+        self.claims: Dict[frozenset, Dict[str, Dict[str, Any]]] = {}
+        #   paire non orientée → {source: lien} ; le premier déclarant est
+        #   celui qui est exposé (même règle que le build complet)
+        self.targets_by_src: Dict[str, List[str]] = {}
+        self._snapshot = None
+        self._snapshot_version = -1
+        self._compact: Dict[bool, Any] = {}           # include_neighbors → (version, graph)
+        self._before: Dict[str, Any] | None = None     # état avant du delta en cours
+
+    # ------------------------------------------------------------------
+    # Chargement / synchronisation
+    # ------------------------------------------------------------------
+    def load(self) -> None:
+        """Construction complète (premier accès ou rechargement)."""
+        coll = get_nodes_collection(self.company)
+        t0 = time.perf_counter()
+        with self._lock:
+            # état avant rechargement : l'écart est journalisé (suppressions comprises)
+            prev = {a: self._node_state(a) for a in self.docs} if self.loaded_at else None
+            self._reset()
+            self.hwm = None
+            self._apply_docs(coll.find({}, NODE_PROJECTION))
+            self.version += 1
+            self.loaded_at = self.synced_at = time.time()
+            if prev is None:
+                self.base_version = self.version
+                self.started_at = self.loaded_at
+            else:
+                self._before = {**{a: None for a in self.docs if a not in prev}, **prev}
+                try:
+                    self._log_changes()
+                finally:
+                    self._before = None
+        print(f"[TOPO] {self.company}: {len(self.docs)} nœuds chargés "
+              f"en {int((time.perf_counter() - t0) * 1000)}ms")
+
+    def sync(self, force: bool = False) -> int:
+        """
+        Intègre les nœuds modifiés depuis le dernier passage (`_updated` ≥ hwm).
+        Sans `force`, ne fait rien si le dernier sync date de moins de
+        TOPO_POLL_INTERVAL s. Renvoie le nombre de documents intégrés.
+        """
+        with self._lock:
+            now = time.time()
+            if not self.loaded_at or now - self.loaded_at > TOPO_FULL_RELOAD:
+                self.load()
+                return len(self.docs)
+            if not force and now - self.synced_at < TOPO_POLL_INTERVAL:
+                return 0
+            if self.hwm is None:                   # pas de `_updated` : rebuild seul possible
+                self.load()
+                return len(self.docs)
+
+            coll = get_nodes_collection(self.company)
+            changed = list(coll.find({"_updated": {"$gte": self.hwm}}, NODE_PROJECTION))
+            n = self.apply(changed)
+            self.synced_at = now
+            # suppressions invisibles en polling → rechargement si le compte diverge
+            if coll.estimated_document_count() != len(self.known_ids):
+                self.load()
+            return n
+
+    def watch(self, stop: threading.Event | None = None) -> None:
+        """Applique les change streams de `network_nodes` jusqu'à `stop`."""
+        if not self.loaded_at:
+            self.load()
+        coll = get_nodes_collection(self.company)
+        try:
+            with coll.watch(full_document="updateLookup", max_await_time_ms=1_000) as stream:
+                while stream.alive and not (stop and stop.is_set()):
+                    ev = stream.try_next()
+                    if ev is None:
+                        continue
+                    op = ev["operationType"]
+                    if op in ("insert", "update", "replace") and ev.get("fullDocument"):
+                        self.apply([ev["fullDocument"]])
+                    elif op == "delete":
+                        self.apply([], [ev["documentKey"]["_id"]])
+                    self.synced_at = time.time()
+        except errors.OperationFailure as exc:
+            logging.error(f"TopologyEngine.watch({self.company}) : change streams indisponibles – {exc}")
+            raise
+
+    # ------------------------------------------------------------------
+    # Deltas
+    # ------------------------------------------------------------------
+    def apply(self, docs: Iterable[Dict[str, Any]], deleted_ids: Iterable[Any] = ()) -> int:
+        """Upsert de documents + suppressions par _id ; renvoie le nombre intégré."""
+        with self._lock:
+            self._before = {}
+            try:
+                n = self._apply_docs(docs)
+                for _id in deleted_ids:
+                    self.known_ids.discard(_id)
+                    addr = self.addr_by_id.pop(_id, None)
+                    if addr:
+                        self._remove_node(addr)
+                        n += 1
+                if n:
+                    self.version += 1
+                    self._log_changes()
+            finally:
+                self._before = None
+            return n
+
+    def _touch(self, addr: str) -> None:
+        """Mémorise l'état d'un nœud avant sa première modification du delta."""
+        if self._before is not None and addr not in self._before:
+            self._before[addr] = self._node_state(addr)
+
+    def _node_state(self, addr: str) -> Dict[str, Any] | None:
+        """Type, parent et qualité des liens déclarés par le nœud (None si absent)."""
+        d = self.docs.get(addr)
+        if d is None:
+            return None
+        links = _node_links(d)
+        parent = next((t for t, l in links if l["kind"] == "parent"), None)
+        return {"type": _node_kind(d), "parent": parent,
+                "links": {t: l["quality"] for t, l in links}}
+
+    def _log_changes(self) -> None:
+        changes = {}
+        for addr, before in self._before.items():
+            after = self._node_state(addr)
+            if before != after:
+                changes[addr] = (before, after)
+        self.changelog.append({"version": self.version, "at": time.time(), "changes": changes})
+
+    def _apply_docs(self, docs: Iterable[Dict[str, Any]]) -> int:
+        n = 0
+        for d in docs:
+            self.known_ids.add(d.get("_id"))
+            addr = _clean_addr(d.get("address"))
+            if addr and self.docs.get(addr) == d:
+                continue                               # relu sans changement
+            prev_addr = self.addr_by_id.get(d.get("_id"))
+            if prev_addr and prev_addr != addr:
+                self._touch(prev_addr)
+                self._remove_node(prev_addr)           # adresse modifiée
+            if not addr:
+                self.addr_by_id.pop(d.get("_id"), None)
+                continue
+            self._touch(addr)
+            if addr in self.docs:
+                self._drop_links(addr)
+            self.docs[addr] = d
+            self.addr_by_id[d.get("_id")] = addr
+            targets = []
+            for target, link in _node_links(d):
+                self.claims.setdefault(frozenset((addr, target)), {}).setdefault(addr, link)
+                targets.append(target)
+            self.targets_by_src[addr] = targets
+            upd = d.get("_updated")
+            if upd is not None and (self.hwm is None or upd > self.hwm):
+                self.hwm = upd
+            n += 1
+        return n
+
+    def _drop_links(self, src: str) -> None:
+        for target in self.targets_by_src.pop(src, []):
+            key = frozenset((src, target))
+            owners = self.claims.get(key)
+            if owners is None:
+                continue
+            owners.pop(src, None)
+            if not owners:
+                del self.claims[key]
+
+    def _remove_node(self, addr: str) -> None:
+        self._touch(addr)
+        self._drop_links(addr)
+        self.docs.pop(addr, None)
+
+    # ------------------------------------------------------------------
+    # Lecture
+    # ------------------------------------------------------------------
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        """{nodes, links} courant (recalculé seulement si la version a changé)."""
+        with self._lock:
+            if self._snapshot is not None and self._snapshot_version == self.version:
+                return self._snapshot
+
+            node_kinds: Dict[str, str] = {a: _node_kind(d) for a, d in self.docs.items()}
+            links: List[Dict[str, Any]] = []
+            for owners in self.claims.values():
+                link = next(iter(owners.values()))
+                links.append(link)
+                node_kinds.setdefault(link["target"], "unknown")
+                node_kinds.setdefault(link["source"], "unknown")
+
+            nodes = []
+            for addr, kind in node_kinds.items():
+                doc = self.docs.get(addr, {})
+                part = doc.get("network_partition_id")
+                nodes.append({"id": addr, "type": kind,
+                              "battery": doc.get("battery"), "last_com": doc.get("last_com"),
+                              "partition": str(part) if part is not None else None})
+
+            self._snapshot = {"nodes": nodes, "links": links}
+            self._snapshot_version = self.version
+            return self._snapshot
+
+    def token(self) -> str:
+        """Jeton de version à renvoyer au client (en-tête X-Topology-Version)."""
+        return f"{self.epoch}.{self.version}"
+
+    def changes(self, since: str | None = None, since_ts: float | None = None) -> Dict[str, Any]:
+        """
+        Delta entre le jeton `since` (ou l'instant `since_ts`) et la version
+        courante. `full=True` si le jeton vient d'un autre moteur (autre
+        worker, redémarrage) ou si l'historique ne remonte pas jusque-là
+        (anneau dépassé) : le client doit relire la topologie complète.
+        """
+        with self._lock:
+            entries = list(self.changelog)
+            oldest = entries[0]["version"] - 1 if entries else self.version
+            out: Dict[str, Any] = {"version": self.token(), "since": since,
+                                   "epoch": self.epoch, "full": False}
+            if since_ts is not None:
+                entries = [e for e in entries if e["at"] >= since_ts]
+                out["covered_from"] = max(since_ts, self.started_at)
+            else:
+                epoch, _, ver = (since or "").rpartition(".")
+                if (epoch != self.epoch or not ver.isdigit()
+                        or int(ver) < max(self.base_version, oldest) or int(ver) > self.version):
+                    out["full"] = True
+                    return out
+                since_v = int(ver)
+                entries = [e for e in entries if e["version"] > since_v]
+
+        # état de départ (premier « avant ») et d'arrivée (dernier « après »)
+        merged: Dict[str, list] = {}
+        for e in entries:
+            for addr, (before, after) in e["changes"].items():
+                merged.setdefault(addr, [before, after])[1] = after
+
+        added, removed, reparented, quality = [], [], [], []
+        for addr, (before, after) in merged.items():
+            if before is None and after is not None:
+                added.append({"id": addr, "type": after["type"], "parent": after["parent"]})
+            elif before is not None and after is None:
+                removed.append({"id": addr, "type": before["type"]})
+            elif before is not None:
+                if before["parent"] != after["parent"]:
+                    reparented.append({"id": addr, "type": after["type"],
+                                       "from": before["parent"], "to": after["parent"]})
+                for target, q in after["links"].items():
+                    old = before["links"].get(target)
+                    if old is not None and old != q:
+                        quality.append({"source": addr, "target": target, "from": old, "to": q})
+
+        out.update({
+            "nodes_added":   added,
+            "nodes_removed": removed,
+            "reparented":    reparented,
+            "link_quality":  quality,
+        })
+        return out
+
+    def compact(self, include_neighbors: bool = False) -> CompactGraph:
+        """Graphe CSR de la version courante (voir tools/topology_graph.py)."""
+        with self._lock:
+            cached = self._compact.get(include_neighbors)
+            if cached and cached[0] == self.version:
+                return cached[1]
+            graph = CompactGraph(self.snapshot(), include_neighbors=include_neighbors)
+            self._compact[include_neighbors] = (self.version, graph)
+            return graph
+
+
+# ---------------------------------------------------------------------------
+# Registre des moteurs
+# ---------------------------------------------------------------------------
+# LRU borné : au plus TOPO_MAX_ENGINES entreprises en mémoire par worker. Le
+# délai d'expiration repart à chaque accès : seul un moteur inutilisé depuis
+# TOPO_ENGINE_IDLE s est oublié. Le rechargement périodique (TOPO_FULL_RELOAD)
+# reste celui de sync(), qui garde epoch et historique.
+# Hors budget d'octets (CACHE_BYTES_BUDGET) : un moteur grossit en place à
+# chaque delta, une pesée à l'insertion serait vite fausse, et l'évincer pour
+# faire de la place à une vue forcerait un rechargement complet.
+TOPO_MAX_ENGINES = int(os.getenv("TOPO_MAX_ENGINES", "32"))
+TOPO_ENGINE_IDLE = int(os.getenv("TOPO_ENGINE_IDLE", str(24 * 3600)))   # s sans accès
+
+_ENGINES = MeteredTTLCache("topology_engines", maxsize=TOPO_MAX_ENGINES, ttl=TOPO_ENGINE_IDLE)
+
+
+def get_engine(company: str) -> TopologyEngine:
+    with _ENGINES.lock:
+        engine = _ENGINES.lookup(company)
+        if engine is None:
+            engine = TopologyEngine(company)
+        _ENGINES.store(company, engine)        # (ré)arme le délai d'inactivité
+        return engine
+
+
+def topology_changes(company: str, since: str | None = None,
+                     hours: float | None = None) -> Dict[str, Any]:
+    """Point d'entrée route / outil : delta depuis un jeton de version ou depuis `hours` heures."""
+    engine = get_engine(company)
+    engine.sync()
+    since_ts = time.time() - hours * 3600 if hours is not None else None
+    return {"company": company, **engine.changes(since=since, since_ts=since_ts)}
+
+
+def drop_engine(company: str) -> bool:
+    """Oublie le moteur d'une entreprise (rechargé au prochain accès)."""
+    return bool(_ENGINES.invalidate(lambda k: k == company))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Suit les changements de network_nodes et maintient la topologie"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    args = parser.parse_args()
+    get_engine(args.company).watch()
@@ -0,0 +1,263 @@
+"""
+app/tools/topology_graph.py
+---------------------------
+
+Représentation compacte de la topologie pour les requêtes de graphe :
+
+• adresses internées → entiers 0..N-1 (`addrs` / `index`) ;
+• type de nœud dans un `array('b')` (0 unknown, 1 gateway, 2 sensor, 3 extender) ;
+• adjacence non orientée en CSR (`indptr`, `indices` : `array('i')`),
+  ~4 octets par demi-arête au lieu d'un dict + frozenset par lien.
+
+Par défaut seules les arêtes `parent` (chemin de routage) sont retenues ;
+`include_neighbors=True` ajoute les voisinages radio.
+
+Requêtes :
+    path_to_gateway(addr)    nombre de sauts + chemin jusqu'à la gateway
+    orphaned_sensors()       capteurs sans chemin vers une gateway
+    gateway_subtrees()       taille du sous-arbre rattaché à chaque gateway
+    articulation_points()    relais dont la perte isole des capteurs
+    removal_impact(addr)     capteurs isolés si ce nœud tombe
+    anchors()                nœud d'infrastructure de rattachement (vue LOD)
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections import deque
+from typing import Any, Dict, List
+
+KIND_CODE = {"unknown": 0, "gateway": 1, "sensor": 2, "extender": 3}
+KIND_NAME = {v: k for k, v in KIND_CODE.items()}
+GATEWAY, SENSOR, EXTENDER = 1, 2, 3
+
+
+class CompactGraph:
+    """Graphe CSR immuable construit depuis un snapshot {nodes, links}."""
+
+    def __init__(self, topo: dict[str, list[dict[str, Any]]], include_neighbors: bool = False):
+        self.addrs: List[str] = [n["id"] for n in topo["nodes"]]
+        self.index: Dict[str, int] = {a: i for i, a in enumerate(self.addrs)}
+        self.kinds = array("b", (KIND_CODE.get(n["type"], 0) for n in topo["nodes"]))
+        n = len(self.addrs)
+
+        src, dst = array("i"), array("i")
+        for l in topo["links"]:
+            if l["kind"] != "parent" and not include_neighbors:
+                continue
+            a, b = self.index.get(l["source"]), self.index.get(l["target"])
+            if a is None or b is None or a == b:
+                continue
+            src.append(a); dst.append(b)
+
+        # CSR par tri comptage (arêtes dans les deux sens)
+        deg = array("i", [0]) * (n + 1)
+        for a, b in zip(src, dst):
+            deg[a + 1] += 1
+            deg[b + 1] += 1
+        for i in range(n):
+            deg[i + 1] += deg[i]
+        self.indptr = deg
+        fill = array("i", deg[:-1]) if n else array("i")
+        self.indices = array("i", [0]) * (2 * len(src))
+        for a, b in zip(src, dst):
+            self.indices[fill[a]] = b; fill[a] += 1
+            self.indices[fill[b]] = a; fill[b] += 1
+
+        self._bfs = None
+
+    # ------------------------------------------------------------------
+    def _neighbors(self, v: int):
+        return self.indices[self.indptr[v]:self.indptr[v + 1]]
+
+    def _gateways(self) -> List[int]:
+        return [i for i, k in enumerate(self.kinds) if k == GATEWAY]
+
+    def _reach(self, removed: int = -1):
+        """BFS multi-source depuis toutes les gateways : (dist, pred, root)."""
+        n = len(self.addrs)
+        dist = array("i", [-1]) * n
+        pred = array("i", [-1]) * n
+        root = array("i", [-1]) * n
+        q = deque()
+        for g in self._gateways():
+            if g != removed:
+                dist[g], root[g] = 0, g
+                q.append(g)
+        while q:
+            v = q.popleft()
+            for w in self._neighbors(v):
+                if dist[w] < 0 and w != removed:
+                    dist[w], pred[w], root[w] = dist[v] + 1, v, root[v]
+                    q.append(w)
+        return dist, pred, root
+
+    def _base(self):
+        if self._bfs is None:
+            self._bfs = self._reach()
+        return self._bfs
+
+    # ------------------------------------------------------------------
+    # Requêtes
+    # ------------------------------------------------------------------
+    def path_to_gateway(self, addr: str) -> Dict[str, Any]:
+        v = self.index.get(addr.strip().upper())
+        if v is None:
+            raise KeyError(f"Nœud {addr} absent de la topologie")
+        dist, pred, root = self._base()
+        if dist[v] < 0:
+            return {"address": self.addrs[v], "gateway": None, "hops": None, "path": []}
+        path = [v]
+        while pred[path[-1]] >= 0:
+            path.append(pred[path[-1]])
+        return {
+            "address": self.addrs[v],
+            "gateway": self.addrs[root[v]],
+            "hops":    dist[v],
+            "path":    [self.addrs[i] for i in path],
+        }
+
+    def anchors(self) -> array:
+        """
+        Pour chaque nœud, l'index du nœud d'infrastructure (non-capteur) auquel
+        il se rattache dans l'arbre BFS : lui-même pour une gateway / un
+        extender, -1 pour un nœud sans chemin vers une gateway.
+        """
+        dist, pred, _ = self._base()
+        anchor = array("i", [-1]) * len(self.addrs)
+        for i in sorted((i for i in range(len(dist)) if dist[i] >= 0), key=dist.__getitem__):
+            anchor[i] = i if self.kinds[i] != SENSOR else anchor[pred[i]]
+        return anchor
+
+    def subtree(self, addr: str) -> set[str]:
+        """Adresses sous `addr` dans l'arbre BFS (`addr` compris)."""
+        v = self.index.get(addr.strip().upper())
+        if v is None:
+            raise KeyError(f"Nœud {addr} absent de la topologie")
+        dist, pred, _ = self._base()
+        inside = array("b", [0]) * len(self.addrs)
+        inside[v] = 1
+        for i in sorted((i for i in range(len(dist)) if dist[i] > dist[v]), key=dist.__getitem__):
+            if inside[pred[i]]:
+                inside[i] = 1
+        return {self.addrs[i] for i, x in enumerate(inside) if x}
+
+    def orphaned_sensors(self) -> List[str]:
+        dist, _, _ = self._base()
+        return [self.addrs[i] for i, k in enumerate(self.kinds) if k == SENSOR and dist[i] < 0]
+
+    def gateway_subtrees(self) -> List[Dict[str, Any]]:
+        """Nœuds rattachés à chaque gateway (gateway la plus proche en sauts)."""
+        dist, _, root = self._base()
+        acc: Dict[int, Dict[str, int]] = {
+            g: {"sensors": 0, "extenders": 0, "max_hops": 0} for g in self._gateways()
+        }
+        for i, r in enumerate(root):
+            if r < 0 or i == r:
+                continue
+            st = acc[r]
+            if self.kinds[i] == SENSOR:
+                st["sensors"] += 1
+            elif self.kinds[i] == EXTENDER:
+                st["extenders"] += 1
+            st["max_hops"] = max(st["max_hops"], dist[i])
+        out = [{"gateway": self.addrs[g], **st} for g, st in acc.items()]
+        out.sort(key=lambda d: -d["sensors"])
+        return out
+
+    def articulation_points(self) -> List[Dict[str, Any]]:
+        """
+        Nœuds (hors gateways) dont la perte coupe des capteurs de toute gateway,
+        avec le nombre de capteurs isolés. Tarjan itératif depuis une racine
+        virtuelle reliée à toutes les gateways : O(N + E).
+        """
+        n = len(self.addrs)
+        root = n                                        # racine virtuelle
+        gws = self._gateways()
+        disc = array("i", [-1]) * (n + 1)
+        low  = array("i", [0]) * (n + 1)
+        sens = array("i", [0]) * (n + 1)                # capteurs dans le sous-arbre DFS
+        cut  = {}                                       # v → capteurs isolés
+        t = 0
+
+        def nbrs(v):
+            # arêtes virtuelles dans les deux sens : une gateway atteinte par
+            # un relais remonte quand même à la racine (low = disc[root])
+            if v == root:
+                return gws
+            if self.kinds[v] == GATEWAY:
+                return [*self._neighbors(v), root]
+            return self._neighbors(v)
+
+        disc[root] = low[root] = t; t += 1
+        stack = [(root, -1, iter(nbrs(root)))]
+        while stack:
+            v, parent, it = stack[-1]
+            advanced = False
+            for w in it:
+                if disc[w] < 0:
+                    disc[w] = low[w] = t; t += 1
+                    sens[w] = 1 if self.kinds[w] == SENSOR else 0
+                    stack.append((w, v, iter(nbrs(w))))
+                    advanced = True
+                    break
+                if w != parent:
+                    low[v] = min(low[v], disc[w])
+            if advanced:
+                continue
+            stack.pop()
+            if parent >= 0:
+                low[parent] = min(low[parent], low[v])
+                sens[parent] += sens[v]
+                # v isole son sous-arbre si on retire `parent`
+                if parent != root and low[v] >= disc[parent] and sens[v]:
+                    cut[parent] = cut.get(parent, 0) + sens[v]
+
+        out = [
+            {"address": self.addrs[v], "type": KIND_NAME[self.kinds[v]], "isolated_sensors": k}
+            for v, k in cut.items() if self.kinds[v] != GATEWAY
+        ]
+        out.sort(key=lambda d: -d["isolated_sensors"])
+        return out
+
+    def removal_impact(self, addr: str) -> Dict[str, Any]:
+        """Capteurs qui perdent toute gateway si `addr` disparaît."""
+        v = self.index.get(addr.strip().upper())
+        if v is None:
+            raise KeyError(f"Nœud {addr} absent de la topologie")
+        before = self._base()[0]
+        after = self._reach(removed=v)[0]
+        lost = [
+            self.addrs[i] for i, k in enumerate(self.kinds)
+            if k == SENSOR and i != v and before[i] >= 0 and after[i] < 0
+        ]
+        return {"address": self.addrs[v], "type": KIND_NAME[self.kinds[v]],
+                "isolated_count": len(lost), "isolated_sensors": lost}
+
+
+def analyze_topology(company: str, query: str, address: str | None = None,
+                     include_neighbors: bool = False) -> Dict[str, Any]:
+    """Point d'entrée des outils / routes : exécute `query` sur le graphe compact."""
+    from backend.tools.topology_engine import get_engine   # import local (cycle)
+
+    engine = get_engine(company)
+    engine.sync()
+    g = engine.compact(include_neighbors=include_neighbors)
+
+    if query == "path_to_gateway":
+        if not address:
+            raise ValueError("address requis pour path_to_gateway")
+        result: Any = g.path_to_gateway(address)
+    elif query == "removal_impact":
+        if not address:
+            raise ValueError("address requis pour removal_impact")
+        result = g.removal_impact(address)
+    elif query == "articulation_points":
+        result = g.articulation_points()
+    elif query == "orphaned_sensors":
+        result = g.orphaned_sensors()
+    elif query == "gateway_subtrees":
+        result = g.gateway_subtrees()
+    else:
+        raise ValueError(f"Requête topologique inconnue : {query}")
+    return {"topology_query": query, "company": company, "result": result}
@@ -0,0 +1,198 @@
+"""
+app/tools/topology_lod.py
+-------------------------
+
+Vue « niveau de détail » de la topologie pour les grands réseaux.
+
+• Gateways, extenders (et nœuds `unknown`) restent visibles.
+• Les capteurs sont regroupés en un nœud `cluster` par nœud d'infrastructure
+  de rattachement (arbre des liens `parent`), avec nombre de capteurs,
+  capteurs hors-ligne et répartition de la qualité de lien.
+• `expand=[adresse, …]` déplie le(s) cluster(s) de ces gateways / extenders
+  (capteurs et liens réels).
+• `partition` ne garde que les nœuds d'un `network_partition_id` ;
+  `root` ne garde que le sous-arbre d'une gateway / d'un extender.
+
+Les vues calculées sont mises en cache (LRU + TTL, budget en octets) avec
+un etag = hash du contenu, pour les réponses `304 Not Modified`.
+
+La taille de la réponse dépend de l'infrastructure visible et des clusters
+dépliés, plus du nombre total de capteurs.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Tuple
+
+from backend.utils.cache import ByteBudgetCache
+
+ORPHAN_CLUSTER = "cluster:orphans"
+
+
+def _naive_utc(d: datetime) -> datetime:
+    return d.astimezone(timezone.utc).replace(tzinfo=None) if d.tzinfo else d
+
+
+def _is_offline(last_com: Any, seuil: datetime) -> bool:
+    return isinstance(last_com, datetime) and _naive_utc(last_com) < seuil
+
+
+def cluster_topology(
+    engine,
+    expand: Iterable[str] = (),
+    partition: str | None = None,
+    root: str | None = None,
+) -> dict[str, Any]:
+    """Snapshot LOD {nodes, links} à partir d'un TopologyEngine synchronisé."""
+    from backend.tools.sensor_tools import _offline_threshold
+
+    topo   = engine.snapshot()
+    g      = engine.compact()
+    anchor = g.anchors()
+    seuil  = _naive_utc(_offline_threshold())
+    expand = {a.strip().upper() for a in expand}
+
+    # nœud d'infrastructure de rattachement (adresse), None si orphelin
+    def anchor_of(addr: str) -> str | None:
+        i = g.index.get(addr)
+        if i is None or anchor[i] < 0:
+            return None
+        return g.addrs[anchor[i]]
+
+    scope = g.subtree(root) if root else None
+
+    def in_scope(n: dict[str, Any]) -> bool:
+        if partition and n.get("partition") != partition:
+            return False
+        return scope is None or n["id"] in scope
+
+    visible: Dict[str, dict] = {}
+    clusters: Dict[str, Dict[str, Any]] = {}
+    member_cluster: Dict[str, str] = {}
+
+    for n in topo["nodes"]:
+        if not in_scope(n):
+            continue
+        if n["type"] != "sensor":
+            visible[n["id"]] = n
+            continue
+        anc = anchor_of(n["id"])
+        if anc in expand:
+            visible[n["id"]] = n
+            continue
+        cid = f"cluster:{anc}" if anc else ORPHAN_CLUSTER
+        c = clusters.setdefault(cid, {
+            "id": cid, "type": "cluster", "parent": anc,
+            "count": 0, "offline": 0, "quality": Counter(),
+        })
+        c["count"] += 1
+        c["offline"] += _is_offline(n.get("last_com"), seuil)
+        member_cluster[n["id"]] = cid
+
+    links: List[Dict[str, Any]] = []
+    for l in topo["links"]:
+        s, t = l["source"], l["target"]
+        if s in visible and t in visible:
+            links.append(l)
+            continue
+        # lien capteur → son parent d'infra : agrégé dans le cluster
+        if l["kind"] == "parent":
+            for member, other in ((s, t), (t, s)):
+                cid = member_cluster.get(member)
+                if cid and clusters[cid]["parent"] == other:
+                    clusters[cid]["quality"][l["quality"]] += 1
+
+    for cid, c in clusters.items():
+        q = c["quality"]
+        c["quality"] = dict(q)
+        if c["parent"] and c["parent"] in visible:
+            dominant = q.most_common(1)[0][0] if q else "unknown"
+            links.append({"source": cid, "target": c["parent"], "kind": "cluster",
+                          "metrics": {"count": c["count"]}, "quality": dominant})
+
+    return {
+        "lod": "cluster",
+        "nodes": list(visible.values()) + list(clusters.values()),
+        "links": links,
+        "expanded": sorted(expand),
+        "totals": {"nodes": len(topo["nodes"]), "links": len(topo["links"])},
+    }
+
+
+def filter_partition(topo: dict[str, list[dict[str, Any]]], partition: str | None,
+                     scope: set[str] | None = None) -> dict[str, list[dict[str, Any]]]:
+    """Vue complète restreinte à un `network_partition_id` et/ou à `scope` (adresses)."""
+    nodes = [n for n in topo["nodes"]
+             if (not partition or n.get("partition") == partition)
+             and (scope is None or n["id"] in scope)]
+    keep = {n["id"] for n in nodes}
+    links = [l for l in topo["links"] if l["source"] in keep and l["target"] in keep]
+    return {"nodes": nodes, "links": links}
+
+
+# Vues déjà calculées : clé (company, chargement, version, paramètres) →
+# (etag, vue, taille JSON). Budget en octets de JSON, par worker.
+TOPO_VIEW_CACHE_BYTES = int(os.getenv("TOPO_VIEW_CACHE_BYTES", str(64 * 1024 * 1024)))
+TOPO_VIEW_TTL         = int(os.getenv("TOPO_VIEW_TTL", "600"))          # s
+
+_VIEWS = ByteBudgetCache("topology_views", maxsize=TOPO_VIEW_CACHE_BYTES,
+                         ttl=TOPO_VIEW_TTL, getsizeof=lambda e: e[2])
+
+
+def get_topology_view_tagged(
+    company: str,
+    lod: str = "full",
+    expand: Iterable[str] = (),
+    partition: str | None = None,
+    root: str | None = None,
+) -> Tuple[str, dict[str, Any], str]:
+    """
+    (etag, vue, jeton de version du graphe « epoch.version ») ; l'etag est un
+    hash du contenu, stable tant que le graphe et les paramètres ne changent
+    pas (y compris entre workers).
+    """
+    from backend.tools.topology_engine import get_engine   # import local (cycle)
+
+    engine = get_engine(company)
+    engine.sync()
+    expand = tuple(sorted({a.strip().upper() for a in expand}))
+    state = (engine.loaded_at, engine.version)
+    key = (company, *state, lod, expand, partition, root)
+
+    hit = _VIEWS.lookup(key)
+    if hit is not None:
+        return hit[0], hit[1], engine.token()
+
+    if lod == "cluster":
+        view = cluster_topology(engine, expand=expand, partition=partition, root=root)
+    else:
+        topo = engine.snapshot()
+        scope = engine.compact().subtree(root) if root else None
+        view = filter_partition(topo, partition, scope) if partition or root else topo
+
+    body = json.dumps(view, default=str).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    # les vues d'une version antérieure du graphe ne resserviront plus
+    _VIEWS.invalidate(lambda k: k[0] == company and k[1:3] != state)
+    _VIEWS.store(key, (etag, view, len(body)))
+    return etag, view, engine.token()
+
+
+def get_topology_view(company: str, lod: str = "full", expand: Iterable[str] = (),
+                      partition: str | None = None, root: str | None = None
+                      ) -> dict[str, Any]:
+    """Point d'entrée des outils : vue complète (`full`) ou en clusters (`cluster`)."""
+    return get_topology_view_tagged(company, lod, expand, partition, root)[1]
+
+
+def invalidate_topology(company: str) -> int:
+    """Invalidation explicite : vues en cache + moteur de l'entreprise."""
+    from backend.tools.topology_engine import drop_engine
+
+    n = _VIEWS.invalidate(lambda k: k[0] == company)
+    return n + drop_engine(company)
@@ -0,0 +1,147 @@
+# app/tools/transmitter_totals.py
+"""
+Nombre de MP (assets) par transmitter, matérialisé par entreprise :
+
+    transmitter_totals       : {_id: id texte du transmitter, totalMP, name}
+    transmitter_totals_meta  : {_id: "meta", assets_count, assets_updated, refreshed_at}
+
+La table est recalculée (agrégation `$out`) seulement quand l’empreinte de
+`assets` (nombre de documents + plus grand `_updated`) a changé, ou après
+`invalidate_transmitter_totals()`. Entre deux contrôles d’empreinte
+(TX_TOTALS_CHECK s), la map est servie depuis un cache mémoire.
+L’empreinte lit le plus grand `_updated` via l’index assets.idx_updated
+(create_index.py).
+
+Limite : une réaffectation de transmitter qui ne touche pas `_updated`
+(ni le nombre d’assets) ne change pas l’empreinte ; elle reste invisible
+jusqu’à l’expiration de la table (TX_TOTALS_MAX_AGE s, recalcul forcé) ou
+un `invalidate_transmitter_totals()` explicite.
+
+Lue par detect_misconfig (`byTransmitter`) et l’outil `top_transmitters`.
+
+Usage CLI :
+    python -m backend.tools.transmitter_totals --company MA_COMPAGNIE
+"""
+
+import os
+from datetime import datetime
+from typing import Any, Dict, List
+
+from pymongo import DESCENDING
+
+from backend.db import client
+from backend.utils.cache import MeteredTTLCache
+
+# ── Paramètres ───────────────────────────────────────────────
+TOTALS_COLL     = "transmitter_totals"
+META_COLL       = "transmitter_totals_meta"
+META_ID         = "meta"
+TX_TOTALS_CHECK = int(os.getenv("TX_TOTALS_CHECK", "60"))     # s entre deux contrôles
+TX_TOTALS_MAX_AGE = int(os.getenv("TX_TOTALS_MAX_AGE", str(6 * 3600)))   # s, recalcul forcé
+
+_MAPS = MeteredTTLCache("transmitter_totals", maxsize=256, ttl=TX_TOTALS_CHECK)
+
+
+def _fingerprint(db) -> Dict[str, Any]:
+    """Empreinte bon marché de `assets` : nombre + plus grand `_updated`."""
+    last = db["assets"].find_one({"_updated": {"$exists": True}}, {"_updated": 1},
+                                 sort=[("_updated", DESCENDING)])
+    return {
+        "assets_count":   db["assets"].estimated_document_count(),
+        "assets_updated": (last or {}).get("_updated"),
+    }
+
+
+def refresh_transmitter_totals(company: str) -> int:
+    """Recalcule la table (remplacement atomique via $out) ; renvoie le nb de transmitters."""
+    db = client[company]
+    fp = _fingerprint(db)
+    db["assets"].aggregate([
+        {"$match": {"optionals.transmitter": {"$exists": True}}},
+
+        # représentation texte uniforme pour le regroupement
+        {"$addFields": {
+            "txKey": {
+                "$cond": [
+                    { "$eq": [{ "$type": "$optionals.transmitter" }, "objectId"] },
+                    { "$toString": "$optionals.transmitter" },
+                    "$optionals.transmitter"
+                ]
+            }
+        }},
+        # groupement sur la clé texte → on ne rate jamais un asset
+        {"$group": {"_id": "$txKey", "totalMP": {"$sum": 1}}},
+
+        # nom « humain » du transmitter
+        {"$addFields": {
+            "txObj": {"$convert": {"input": "$_id", "to": "objectId",
+                                   "onError": None, "onNull": None}}
+        }},
+        {"$lookup": {"from": "assets", "localField": "txObj", "foreignField": "_id",
+                     "pipeline": [{"$project": {"name": 1}}], "as": "tx"}},
+        {"$project": {"totalMP": 1, "name": {"$first": "$tx.name"}}},
+        {"$out": TOTALS_COLL},
+    ], allowDiskUse=True)
+    db[META_COLL].replace_one(
+        {"_id": META_ID}, {**fp, "refreshed_at": datetime.utcnow()}, upsert=True
+    )
+    _MAPS.invalidate(lambda k: k == company)
+    return db[TOTALS_COLL].estimated_document_count()
+
+
+def _ensure_fresh(company: str) -> None:
+    db = client[company]
+    meta = db[META_COLL].find_one({"_id": META_ID}) or {}
+    fp = _fingerprint(db)
+    refreshed = meta.get("refreshed_at")
+    expired = refreshed is None or (datetime.utcnow() - refreshed).total_seconds() > TX_TOTALS_MAX_AGE
+    if expired or any(meta.get(k) != v for k, v in fp.items()):
+        refresh_transmitter_totals(company)
+
+
+def get_transmitter_totals(company: str) -> Dict[str, int]:
+    """{id texte du transmitter: nombre de MP}, recalculé si `assets` a changé."""
+    cached = _MAPS.lookup(company)
+    if cached is not None:
+        return cached
+    _ensure_fresh(company)
+    totals = {d["_id"]: d["totalMP"] for d in client[company][TOTALS_COLL].find({}, {"totalMP": 1})}
+    _MAPS.store(company, totals)
+    return totals
+
+
+def top_transmitters(company: str, limit: int = 10) -> Dict[str, Any]:
+    """Transmitters ayant le plus de MP (lecture de la table matérialisée)."""
+    if _MAPS.lookup(company) is None:
+        get_transmitter_totals(company)
+    rows: List[Dict[str, Any]] = list(
+        client[company][TOTALS_COLL]
+        .find({}, {"totalMP": 1, "name": 1})
+        .sort([("totalMP", DESCENDING), ("_id", 1)])
+        .limit(limit)
+    )
+    return {
+        "company": company,
+        "transmitters": [
+            {"transmitter": r["_id"], "name": r.get("name"), "totalMP": r["totalMP"]}
+            for r in rows
+        ],
+    }
+
+
+def invalidate_transmitter_totals(company: str) -> None:
+    """Force le recalcul au prochain accès (ex. après un import d’assets)."""
+    client[company][META_COLL].delete_one({"_id": META_ID})
+    _MAPS.invalidate(lambda k: k == company)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Recalcule transmitter_totals pour une compagnie donnée"
+    )
+    parser.add_argument("--company", "-c", default="ACME",
+                        help="Nom de la DB Mongo / compagnie (défaut: ACME)")
+    args = parser.parse_args()
+    n = refresh_transmitter_totals(args.company)
+    print(f"[{args.company}] {n} transmitters")
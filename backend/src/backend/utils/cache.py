@@ -0,0 +1,168 @@
+# utils/cache.py
+"""
+Caches LRU + TTL bornés et instrumentés.
+
+`MeteredTTLCache` est un `cachetools.TTLCache` qui compte hits / misses /
+évictions (LRU) / expirations. Avec `getsizeof`, `maxsize` devient un budget
+(ex. en octets estimés) plutôt qu'un nombre d'entrées.
+
+`ByteBudgetCache` pèse chaque valeur en octets (`deep_sizeof` par défaut) et
+partage en plus un budget global par worker (CACHE_BYTES_BUDGET) avec les
+autres caches du même type : au-delà, le cache le plus gros évince ses
+entrées les moins récemment utilisées.
+
+Chaque cache nommé est enregistré pour `cache_stats()` (route /api/cache/stats).
+Les caches sont par processus : chaque worker uvicorn a les siens.
+"""
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from cachetools import TTLCache
+
+_REGISTRY: Dict[str, "MeteredTTLCache"] = {}
+
+
+class MeteredTTLCache(TTLCache):
+    """TTLCache avec compteurs ; accès protégés par un verrou (`self.lock`)."""
+
+    def __init__(self, name: str, maxsize: float, ttl: float,
+                 getsizeof: Optional[Callable[[Any], float]] = None):
+        super().__init__(maxsize=maxsize, ttl=ttl, getsizeof=getsizeof)
+        self.name = name
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        _REGISTRY[name] = self
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.expirations += len(expired)
+        return expired
+
+    def lookup(self, key, default=None):
+        """`get` thread-safe et compté (les accès internes — éviction, pop — ne le sont pas)."""
+        with self.lock:
+            try:
+                value = self[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def store(self, key, value) -> None:
+        """Insertion thread-safe ; une valeur plus grosse que le budget est ignorée."""
+        with self.lock:
+            try:
+                self[key] = value
+            except ValueError:
+                pass
+
+    def invalidate(self, predicate: Callable[[Any], bool] | None = None) -> int:
+        """Supprime toutes les clés (ou celles qui satisfont `predicate`)."""
+        with self.lock:
+            keys = [k for k in list(self.keys()) if predicate is None or predicate(k)]
+            for k in keys:
+                self.pop(k, None)
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries":     len(self),
+                "size":        self.currsize,
+                "maxsize":     self.maxsize,
+                "ttl":         self.ttl,
+                "hits":        self.hits,
+                "misses":      self.misses,
+                "hit_ratio":   round(self.hits / total, 3) if total else None,
+                "evictions":   self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def deep_sizeof(obj: Any) -> int:
+    """Taille approximative (octets) de `obj` et de tout ce qu'il contient."""
+    seen, stack, total = set(), [obj], 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Budget global en octets (par worker)
+# ---------------------------------------------------------------------------
+CACHE_BYTES_BUDGET = int(os.getenv("CACHE_BYTES_BUDGET", str(256 * 1024 * 1024)))
+
+_BYTE_CACHES: List["ByteBudgetCache"] = []
+_BUDGET_LOCK = threading.RLock()          # un seul verrou : pas d'interblocage entre caches
+
+
+def _global_bytes() -> int:
+    return sum(c.currsize for c in _BYTE_CACHES)
+
+
+def _enforce_budget() -> None:
+    """Évince (LRU) dans le plus gros cache tant que le budget global est dépassé."""
+    for c in _BYTE_CACHES:
+        c.expire()
+    while _global_bytes() > CACHE_BYTES_BUDGET:
+        biggest = max(_BYTE_CACHES, key=lambda c: c.currsize)
+        if not len(biggest):
+            break
+        biggest.popitem()
+
+
+class ByteBudgetCache(MeteredTTLCache):
+    """
+    MeteredTTLCache dont `maxsize` est un budget en octets ; la somme de tous
+    les ByteBudgetCache du worker reste sous CACHE_BYTES_BUDGET.
+
+    La valeur est pesée AVANT de prendre le verrou global (partagé par tous
+    ces caches) : chaque entrée est stockée en `(valeur, taille)` et le
+    TTLCache ne lit que la taille précalculée.
+    """
+
+    def __init__(self, name: str, maxsize: float, ttl: float,
+                 getsizeof: Callable[[Any], float] = deep_sizeof):
+        super().__init__(name, maxsize=maxsize, ttl=ttl, getsizeof=lambda e: e[1])
+        self._weigh = getsizeof
+        self.lock = _BUDGET_LOCK
+        _BYTE_CACHES.append(self)
+
+    def lookup(self, key, default=None):
+        entry = super().lookup(key)
+        return default if entry is None else entry[0]
+
+    def store(self, key, value) -> None:
+        entry = (value, self._weigh(value))        # hors verrou : deep_sizeof peut être long
+        with self.lock:
+            super().store(key, entry)
+            _enforce_budget()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**super().stats(),
+                    "global_bytes":  _global_bytes(),
+                    "global_budget": CACHE_BYTES_BUDGET}
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Statistiques de tous les caches instrumentés du processus."""
+    return {name: c.stats() for name, c in _REGISTRY.items()}
@@ -0,0 +1,78 @@
+# utils/cursor.py
+"""
+Jetons de pagination opaques (keyset pagination).
+
+Le jeton encode les valeurs de la clé de tri du dernier document renvoyé ;
+bson.json_util conserve les types Mongo (datetime, ObjectId…) à l’aller-retour.
+
+Les jetons « signés » (HMAC, CURSOR_SECRET) transportent aussi l’état de la
+requête (collection, filtre, projection) : le client ne peut pas les forger.
+Sans CURSOR_SECRET configuré, aucun jeton signé n’est émis ni accepté
+(RuntimeError) : pas de secret par défaut connu de tous.
+"""
+import os
+import hmac
+import base64
+import hashlib
+from typing import Any
+
+from bson import json_util
+
+
+def encode_cursor(values: dict[str, Any]) -> str:
+    raw = json_util.dumps(values, sort_keys=True).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> dict[str, Any]:
+    """Décode un jeton ; lève ValueError s’il est illisible."""
+    try:
+        pad = "=" * (-len(token) % 4)
+        return json_util.loads(base64.urlsafe_b64decode(token + pad))
+    except Exception as exc:
+        raise ValueError(f"cursor invalide : {token!r}") from exc
+
+
+_SECRET = os.getenv("CURSOR_SECRET", "").encode()
+
+
+def signing_enabled() -> bool:
+    """Jetons signés disponibles (CURSOR_SECRET configuré) ?"""
+    return bool(_SECRET)
+
+
+def _sign(body: str) -> str:
+    if not _SECRET:
+        raise RuntimeError("CURSOR_SECRET non configuré : jetons de pagination signés désactivés")
+    return hmac.new(_SECRET, body.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def encode_signed_cursor(values: dict[str, Any]) -> str:
+    body = encode_cursor(values)
+    return f"{body}.{_sign(body)}"
+
+
+def decode_signed_cursor(token: str) -> dict[str, Any]:
+    """
+    Décode un jeton signé ; lève ValueError s’il est illisible ou altéré,
+    RuntimeError si CURSOR_SECRET n’est pas configuré.
+    """
+    body, _, sig = token.rpartition(".")
+    if not body or not hmac.compare_digest(sig, _sign(body)):
+        raise ValueError(f"cursor invalide : {token!r}")
+    return decode_cursor(body)
+
+
+def after_key_filter(sort_keys: list[tuple[str, int]], last: dict[str, Any]) -> dict:
+    """
+    Filtre « strictement après `last` » pour un tri composite, ex.
+    [("last_com", 1), ("address", 1)] →
+      {$or: [{last_com: {$gt: t}}, {last_com: t, address: {$gt: a}}]}
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort_keys):
+        op = "$gt" if direction >= 0 else "$lt"
+        branch = {f: last[f] for f, _ in sort_keys[:i]}
+        branch[field] = {op: last[field]}
+        branches.append(branch)
+    return {"$or": branches} if len(branches) > 1 else branches[0]
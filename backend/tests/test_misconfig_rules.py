@@ -0,0 +1,175 @@
+# tests/test_misconfig_rules.py
+"""
+Les trois implémentations des règles de detect_misconfig doivent donner le
+même verdict sur des historiques d'errcodes générés :
+
+  • misconfig_vector.score_arrays (moteur « numpy ») ;
+  • misconfig_state._rules (moteur « state ») ;
+  • misconfiguration._rule_stages (pipelines « lookup » / « window »),
+    évaluées par un mini-interpréteur des opérateurs d'agrégation utilisés.
+
+Pas de MongoDB : `backend.db` (qui se connecte à l'import) est remplacé par
+un module vide le temps des imports.
+"""
+
+import sys
+import types
+import random
+import importlib
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pymongo")
+pytest.importorskip("diskcache")
+
+LAST_N = 10
+
+
+@pytest.fixture(scope="module")
+def mods():
+    fake_db = types.ModuleType("backend.db")
+    fake_db.client = {}
+    fake_db.afan_out = fake_db.list_companies = None
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setitem(sys.modules, "backend.db", fake_db)
+        yield types.SimpleNamespace(
+            pipeline=importlib.import_module("backend.tools.misconfiguration"),
+            state=importlib.import_module("backend.tools.misconfig_state"),
+            vector=importlib.import_module("backend.tools.misconfig_vector"),
+        )
+
+
+# ---------------------------------------------------------------------------
+# Mini-interpréteur d'expressions d'agrégation (sous-ensemble de _rule_stages)
+# ---------------------------------------------------------------------------
+def _get(obj, parts):
+    for p in parts:
+        if isinstance(obj, list):
+            obj = [_get(o, [p]) for o in obj]
+        else:
+            obj = obj.get(p) if isinstance(obj, dict) else None
+    return obj
+
+
+def _key(v):
+    return (v is not None, v if v is not None else 0)     # champ absent < nombres
+
+
+def _ev(x, doc, var):
+    if isinstance(x, str) and x.startswith("$$"):
+        name, *path = x[2:].split(".")
+        return _get(var[name], path)
+    if isinstance(x, str) and x.startswith("$"):
+        return _get(doc, x[1:].split("."))
+    if isinstance(x, list):
+        return [_ev(i, doc, var) for i in x]
+    if isinstance(x, dict):
+        if len(x) == 1 and next(iter(x)).startswith("$"):
+            op, arg = next(iter(x.items()))
+            return _OPS[op](arg, doc, var)
+        return {k: _ev(v, doc, var) for k, v in x.items()}
+    return x
+
+
+def _args(arg, doc, var):
+    return [_ev(a, doc, var) for a in arg]
+
+
+def _reduce(a, doc, var):
+    value = _ev(a["initialValue"], doc, var)
+    for item in _ev(a["input"], doc, var):
+        value = _ev(a["in"], doc, {**var, "value": value, "this": item})
+    return value
+
+
+def _switch(a, doc, var):
+    for br in a["branches"]:
+        if _ev(br["case"], doc, var):
+            return _ev(br["then"], doc, var)
+    return _ev(a["default"], doc, var)
+
+
+def _elem(a, doc, var):
+    arr, i = _args(a, doc, var)
+    return arr[i] if i < len(arr) else None
+
+
+_OPS = {
+    "$map":      lambda a, d, v: [_ev(a["in"], d, {**v, a["as"]: i}) for i in _ev(a["input"], d, v)],
+    "$filter":   lambda a, d, v: [i for i in _ev(a["input"], d, v) if _ev(a["cond"], d, {**v, a["as"]: i})],
+    "$reduce":   _reduce,
+    "$switch":   _switch,
+    "$arrayElemAt": _elem,
+    "$ifNull":   lambda a, d, v: next((x for x in _args(a, d, v) if x is not None), None),
+    "$size":     lambda a, d, v: len(_ev(a, d, v)),
+    "$max":      lambda a, d, v: max(_ev(a, d, v)),
+    "$eq":       lambda a, d, v: (lambda x, y: x == y)(*_args(a, d, v)),
+    "$gt":       lambda a, d, v: (lambda x, y: _key(x) > _key(y))(*_args(a, d, v)),
+    "$gte":      lambda a, d, v: (lambda x, y: _key(x) >= _key(y))(*_args(a, d, v)),
+    "$and":      lambda a, d, v: all(_args(a, d, v)),
+    "$or":       lambda a, d, v: any(_args(a, d, v)),
+    "$cond":     lambda a, d, v: _ev(a[1] if _ev(a[0], d, v) else a[2], d, v),
+    "$add":      lambda a, d, v: sum(_args(a, d, v)),
+    "$literal":  lambda a, d, v: a,
+    "$concat":   lambda a, d, v: "".join(_args(a, d, v)),
+    "$toString": lambda a, d, v: str(_ev(a, d, v)),
+}
+
+
+def _run_stages(stages, doc):
+    for st in stages:
+        (op, fields), = st.items()
+        assert op == "$addFields", op
+        doc.update({k: _ev(e, doc, {}) for k, e in fields.items()})
+    return doc
+
+
+# ---------------------------------------------------------------------------
+# Données générées
+# ---------------------------------------------------------------------------
+def _histories(seed, mods, n_assets=200):
+    """{asset: errcodes récents d'abord} ; None = log.errcode absent."""
+    rnd = random.Random(seed)
+    meta = mods.pipeline.ERR_META
+    warn = [c for c, m in meta.items() if m.get("severity") == "Warning"]
+    crit = [c for c, m in meta.items() if m.get("severity") == "Critical"]
+    pool = [0] * 6 + warn * 2 + crit[:2] + [999, None]
+    return {a: [rnd.choice(pool) for _ in range(rnd.randint(1, 2 * LAST_N))]
+            for a in range(n_assets)}
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("freq", [2, 3, 5])
+def test_rules_agree(mods, seed, freq):
+    hist = _histories(seed, mods)
+    t0 = datetime(2026, 1, 1)
+
+    # moteur numpy : lignes mélangées, triées par score_arrays
+    rows = [(a, t0 - timedelta(hours=k), e or 0)
+            for a, codes in hist.items() for k, e in enumerate(codes)]
+    random.Random(seed).shuffle(rows)
+    s = mods.vector.score_arrays(
+        np.array([r[0] for r in rows], dtype=np.int64),
+        np.array([r[1] for r in rows], dtype="datetime64[ms]"),
+        np.array([r[2] for r in rows], dtype=np.int64),
+        len(hist), LAST_N, freq,
+    )
+
+    stages = mods.pipeline._rule_stages(freq)
+    for a, codes in hist.items():
+        last = codes[:LAST_N]
+        ref = mods.state._rules([e or 0 for e in last], freq)
+
+        doc = _run_stages(stages, {"lastStats": [
+            {"acqend": t0 - timedelta(hours=k), "log": {} if e is None else {"errcode": e}}
+            for k, e in enumerate(last)
+        ]})
+        assert (doc["freq_err"], doc["last_errcode"], doc["consec_count"]["count"],
+                bool(doc["misconfigured"])) == \
+               (ref["freq_err"], ref["last_errcode"], ref["consec"], ref["misconfigured"]), (a, last)
+
+        assert (int(s["freq_err"][a]), int(s["last_errcode"][a]), int(s["consec"][a]),
+                bool(s["misconfigured"][a])) == \
+               (ref["freq_err"], ref["last_errcode"], ref["consec"], ref["misconfigured"]), (a, last)
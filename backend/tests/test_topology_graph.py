@@ -0,0 +1,59 @@
+# tests/test_topology_graph.py
+"""
+CompactGraph.articulation_points doit donner, pour chaque nœud, le même
+nombre de capteurs isolés que removal_impact (recalcul BFS sans le nœud).
+Graphes construits à la main : pas de MongoDB.
+"""
+
+import random
+
+import pytest
+
+from backend.tools.topology_graph import CompactGraph
+
+
+def _topo(nodes: dict[str, str], links: list[tuple[str, str]]) -> dict:
+    return {
+        "nodes": [{"id": a, "type": t} for a, t in nodes.items()],
+        "links": [{"source": a, "target": b, "kind": "parent"} for a, b in links],
+    }
+
+
+def _check(g: CompactGraph) -> None:
+    points = {p["address"]: p["isolated_sensors"] for p in g.articulation_points()}
+    for addr, kind in zip(g.addrs, g.kinds):
+        if kind == 1:                                   # gateways exclues
+            continue
+        assert points.get(addr, 0) == g.removal_impact(addr)["isolated_count"], addr
+
+
+def test_relay_between_two_gateways():
+    # E relie G1 et G2 ; S ne passe que par E, S2 reste sur G2
+    g = CompactGraph(_topo(
+        {"G1": "gateway", "G2": "gateway", "E": "extender", "S": "sensor", "S2": "sensor"},
+        [("E", "G1"), ("E", "G2"), ("S", "E"), ("S2", "G2")],
+    ))
+    points = {p["address"]: p["isolated_sensors"] for p in g.articulation_points()}
+    assert points == {"E": 1}
+    _check(g)
+
+
+def test_chain_and_orphans():
+    g = CompactGraph(_topo(
+        {"G": "gateway", "E1": "extender", "E2": "extender",
+         "S1": "sensor", "S2": "sensor", "S3": "sensor", "X": "sensor"},
+        [("E1", "G"), ("E2", "E1"), ("S1", "E2"), ("S2", "S1"), ("S3", "E1")],
+    ))
+    points = {p["address"]: p["isolated_sensors"] for p in g.articulation_points()}
+    assert points == {"E1": 3, "E2": 2, "S1": 1}
+    _check(g)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_graphs_match_removal_impact(seed):
+    rnd = random.Random(seed)
+    n = rnd.randint(5, 40)
+    kinds = rnd.choices(["gateway", "extender", "sensor", "unknown"], [1, 2, 6, 1], k=n)
+    nodes = {f"N{i}": k for i, k in enumerate(kinds)}
+    links = [(f"N{rnd.randrange(n)}", f"N{rnd.randrange(n)}") for _ in range(rnd.randint(n // 2, 2 * n))]
+    _check(CompactGraph(_topo(nodes, links)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test de concurrence sur l’API (serveur uvicorn déjà lancé).
+
+Mesure la latence de N requêtes « légères » lancées en parallèle,
+d’abord seules, puis pendant qu’une requête `/api/misconfig` lourde tourne.
+La sonde par défaut est `/api/connectivity/{company}` (une page), servie
+par le pool "default" : avec la couche d’accès asynchrone et les pools
+séparés, son p99 doit rester à peu près plat.
+
+Dépendance de dev : httpx (`uv sync --group dev` ou
+`pip install -r backend/requirements-dev.txt`).
+
+Usage :
+    python bench_chat_latency.py --company Icare_Brussels --n 50
+    python bench_chat_latency.py --mode chat --message "état des batteries de Cabot"
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000/api")
+
+
+def _pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+async def _light(cli: httpx.AsyncClient, args) -> float:
+    t0 = time.perf_counter()
+    if args.mode == "chat":
+        r = await cli.post("/chat", json={"message": args.message, "locale": "fr"})
+    else:
+        r = await cli.get(f"/connectivity/{args.company}", params={"page_size": 50})
+    r.raise_for_status()
+    return (time.perf_counter() - t0) * 1000
+
+
+async def _burst(cli: httpx.AsyncClient, args) -> list[float]:
+    return await asyncio.gather(*[_light(cli, args) for _ in range(args.n)])
+
+
+def _report(label: str, lat: list[float]) -> None:
+    print(f"{label:<22} n={len(lat):<4} p50={statistics.median(lat):8.1f} ms "
+          f"p99={_pct(lat, 99):8.1f} ms  max={max(lat):8.1f} ms")
+
+
+async def main(args) -> None:
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=300) as cli:
+        await _light(cli, args)                      # warm-up (caches, connexions)
+
+        _report("idle", await _burst(cli, args))
+
+        heavy = asyncio.create_task(
+            cli.get(f"/misconfig/{args.company}", params={"since_days": args.since_days})
+        )
+        await asyncio.sleep(0.2)                     # laisse partir l’agrégation
+        _report("with heavy misconfig", await _burst(cli, args))
+
+        t0 = time.perf_counter()
+        (await heavy).raise_for_status()
+        print(f"heavy misconfig done in {(time.perf_counter() - t0) * 1000:.0f} ms (after burst)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="p99 des requêtes légères sous charge")
+    parser.add_argument("--company", "-c", default=os.getenv("DB_NAME", "Icare_Brussels"))
+    parser.add_argument("--n", type=int, default=50, help="Requêtes parallèles par salve")
+    parser.add_argument("--mode", choices=["connectivity", "chat"], default="connectivity")
+    parser.add_argument("--message", default="Combien de capteurs sont hors ligne chez Icare Brussels ?")
+    parser.add_argument("--since-days", type=int, default=30)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark connectivity_overview : ancienne version (2 count_documents +
+find trié) vs. agrégation $facet unique (rollup désactivé), pagination, et
+lecture des compteurs depuis le rollup santé capteurs (rafraîchi avant).
+
+À lancer sur une base remplie par sample_dataset.py :
+    python sample_dataset.py
+    python bench_connectivity.py --runs 20
+"""
+
+import os
+import time
+import argparse
+import statistics
+
+from dotenv import load_dotenv
+
+from backend.db import get_nodes_collection
+from backend.tools.sensor_tools import connectivity_overview, _offline_threshold, OFFLINE_PROJ
+from backend.tools.sensor_rollup import refresh_rollup
+
+load_dotenv()
+DB_NAME = os.getenv("DB_NAME", "Icare_Brussels")
+
+
+def legacy_connectivity_overview(company: str) -> dict:
+    """Copie de l’implémentation d’origine (3 parcours de la collection)."""
+    seuil = _offline_threshold()
+    filt  = {"node_type": 2}
+    nodes = get_nodes_collection(company)
+    connected    = nodes.count_documents({**filt, "last_com": {"$gte": seuil}})
+    disconnected = nodes.count_documents({**filt, "last_com": {"$lt":  seuil}})
+    items = list(
+        nodes.find({**filt, "last_com": {"$lt": seuil}}, OFFLINE_PROJ)
+             .sort("last_com", 1)
+             .limit(10_000)
+    )
+    return {"connected_count": connected, "disconnected_count": disconnected, "items": items}
+
+
+def _time(fn, runs: int) -> list[float]:
+    out = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000)
+    return out
+
+
+def main(company: str, runs: int, page_size: int) -> None:
+    old = legacy_connectivity_overview(company)
+    new = connectivity_overview(company, use_rollup=False)
+    assert old["connected_count"] == new["connected_count"]
+    assert old["disconnected_count"] == new["disconnected_count"]
+    assert len(old["items"]) == len(new["items"])
+
+    # toutes les pages concaténées == liste complète
+    paged, cursor = [], None
+    while True:
+        page = connectivity_overview(company, page_size=page_size, cursor=cursor,
+                                     use_rollup=False)
+        paged.extend(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert [d["address"] for d in paged] == [d["address"] for d in new["items"]]
+
+    refresh_rollup(company)
+    rolled = connectivity_overview(company, use_rollup=True)
+    assert rolled["connected_count"] == new["connected_count"]
+    assert rolled["disconnected_count"] == new["disconnected_count"]
+
+    for label, fn in (
+        ("legacy (3 queries)", lambda: legacy_connectivity_overview(company)),
+        ("$facet (1 query)",   lambda: connectivity_overview(company, use_rollup=False)),
+        (f"find page={page_size}",
+         lambda: connectivity_overview(company, page_size=page_size, use_rollup=False)),
+        ("rollup",             lambda: connectivity_overview(company, use_rollup=True)),
+    ):
+        lat = _time(fn, runs)
+        print(f"{label:<22} median={statistics.median(lat):8.1f} ms  min={min(lat):8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark connectivity_overview")
+    parser.add_argument("--company", "-c", default=DB_NAME)
+    parser.add_argument("--runs", "-n", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+    main(args.company, args.runs, args.page_size)
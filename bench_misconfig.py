@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Benchmark detect_misconfig sur un jeu synthétique `assets` / `tasks` /
+`statistics` créé dans une base dédiée (jamais la base de prod) :
+
+1. métadonnées errcode via `$function` JS (implémentation d'origine, la
+   table ERR_META passée en argument à chaque appel) vs. `$switch` natif ;
+2. moteurs côte à côte : "lookup" ($lookup par task), "window"
+   ($setWindowFields, un parcours de statistics), "numpy" (règles
+   vectorisées côté Python) et "state"
+   (misconfig_state reconstruit avant la mesure).
+
+Chaque comparaison vérifie d'abord l'équivalence des résultats (items,
+compteurs, répartitions) puis mesure le coût par asset :
+    python bench_misconfig.py --assets 5000 --stats 20 --runs 5
+"""
+
+import os
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from backend.db import client
+from backend.tools.misconfiguration import (
+    ERR_META, build_misconfig_pipeline, detect_misconfig, shape_misconfig,
+)
+from backend.tools.transmitter_totals import get_transmitter_totals, invalidate_transmitter_totals
+from backend.tools.misconfig_state import refresh_state
+
+load_dotenv()
+BENCH_DB = os.getenv("BENCH_MISCONFIG_DB", "bench_misconfig")
+
+ERR_META_STR = {str(k): v for k, v in ERR_META.items()}
+
+
+def _js(field: str, default: str) -> dict:
+    return {"$function": {
+        "lang": "js",
+        "args": ["$last_errcode", ERR_META_STR],
+        "body": f"function(c,m){{return m[String(c)]?m[String(c)].{field}:{default};}}",
+    }}
+
+
+def legacy_pipeline(cutoff: datetime, last_n: int, freq_threshold: int) -> list[dict]:
+    """
+    Pipeline courant dont le lookup natif est remplacé par les appels JS
+    d'origine (3 `$function` par asset ; l'original en faisait 2 par asset
+    + 4 par asset mal configuré).
+    """
+    pipeline = build_misconfig_pipeline(cutoff, last_n, freq_threshold)
+    for i, stage in enumerate(pipeline):
+        if "err" in stage.get("$addFields", {}):
+            pipeline[i] = {"$addFields": {"err": {
+                "name":     _js("name", "'ERR_'+c"),
+                "severity": _js("severity", "'Unknown'"),
+                "cause":    _js("cause", "'unknown'"),
+            }}}
+            return pipeline
+    raise RuntimeError("étape `err` introuvable dans build_misconfig_pipeline")
+
+
+def seed(n_assets: int, n_stats: int, n_tx: int = 50) -> None:
+    db = client[BENCH_DB]
+    for c in ("assets", "tasks", "statistics"):
+        db[c].drop()
+
+    now   = datetime.utcnow()
+    codes = list(ERR_META) + [999]                 # + un code inconnu
+    txs   = [{"_id": ObjectId(), "name": f"TX-{i:03d}"} for i in range(n_tx)]
+    mps, tasks, stats = [], [], []
+    for i in range(n_assets):
+        tx = random.choice(txs)["_id"]
+        mp = {"_id": ObjectId(), "name": f"MP-{i:05d}",
+              "optionals": {"transmitter": tx if i % 2 else str(tx)}}
+        mps.append(mp)
+        tasks.append({"_id": ObjectId(), "asset": mp["_id"]})
+        faulty = random.random() < 0.2
+        for k in range(n_stats):
+            err = random.choice(codes) if faulty and random.random() < 0.5 else 0
+            stats.append({"asset": mp["_id"], "acqend": now - timedelta(hours=6 * k),
+                          "log": {"errcode": err}})
+    db.assets.insert_many(txs + mps)
+    db.tasks.insert_many(tasks)
+    db.statistics.insert_many(stats)
+    db.statistics.create_index([("asset", 1), ("acqend", -1)], name="idx_asset_acqend")
+    db.tasks.create_index([("asset", 1)], name="idx_asset")
+    invalidate_transmitter_totals(BENCH_DB)
+    print(f"[seed] {n_assets} assets, {len(stats)} statistics dans {BENCH_DB}")
+
+
+def _run(pipeline: list[dict]) -> dict:
+    db = client[BENCH_DB]
+    raw = list(db.tasks.aggregate(pipeline, allowDiskUse=True))[0]
+    return shape_misconfig(raw, get_transmitter_totals(BENCH_DB))
+
+
+FACETS = ("severityAll", "bySeverity", "dailyNew")
+
+
+def _norm(res: dict) -> tuple:
+    items = {
+        str(it["asset_id"]): (it["err_name"], it["severity"], str(it["errcodes"]),
+                              it["freq_err"], str(it["last_acq"]))
+        for it in res["items"]
+    }
+    rows = {k: sorted((str(d["_id"]), d["count"]) for d in res[k]) for k in FACETS}
+    return res["counts"], items, rows
+
+
+def _check_same(label: str, got: dict, ref: dict) -> None:
+    """
+    Vérifie l'équivalence avec la référence (explicite : pas d'`assert`,
+    ignoré sous `python -O`) et nomme les assets / compteurs divergents.
+    """
+    (g_counts, g_items, g_rows), (r_counts, r_items, r_rows) = _norm(got), _norm(ref)
+    problems = []
+    if g_counts != r_counts:
+        problems.append(f"counts {g_counts} ≠ {r_counts}")
+    for asset in sorted(g_items.keys() | r_items.keys()):
+        if g_items.get(asset) != r_items.get(asset):
+            problems.append(f"asset {asset} : {g_items.get(asset)} ≠ {r_items.get(asset)}")
+            if len(problems) >= 5:
+                break
+    for k in FACETS:
+        if g_rows[k] != r_rows[k]:
+            problems.append(f"{k} : {g_rows[k]} ≠ {r_rows[k]}")
+    if problems:
+        raise RuntimeError(f"{label} : résultats différents\n  " + "\n  ".join(problems))
+
+
+def _bench(label: str, fn, runs: int, n: int) -> None:
+    lat = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        lat.append((time.perf_counter() - t0) * 1000)
+    med = statistics.median(lat)
+    print(f"{label:<16} median={med:8.1f} ms  ({med * 1000 / n:6.1f} µs/asset)")
+
+
+def main(n_assets: int, n_stats: int, runs: int, reseed: bool) -> None:
+    if reseed or client[BENCH_DB].tasks.estimated_document_count() == 0:
+        seed(n_assets, n_stats)
+    n = client[BENCH_DB].tasks.estimated_document_count()
+    cutoff = datetime.utcnow() - timedelta(days=30)
+
+    old = legacy_pipeline(cutoff, 10, 3)
+    new = build_misconfig_pipeline(cutoff, 10, 3)
+    _check_same("$function vs $switch", _run(old), _run(new))
+
+    print("── métadonnées errcode")
+    for label, pipe in (("$function (JS)", old), ("$switch (natif)", new)):
+        _bench(label, lambda: _run(pipe), runs, n)
+
+    print("── moteurs")
+    refresh_state(BENCH_DB, full=True)
+    engines = ("lookup", "window", "numpy", "state")
+    ref = detect_misconfig(BENCH_DB, engine="lookup", cache=False)
+    for engine in engines[1:]:
+        _check_same(f"{engine} vs lookup", detect_misconfig(BENCH_DB, engine=engine, cache=False), ref)
+    for engine in engines:
+        _bench(engine, lambda: detect_misconfig(BENCH_DB, engine=engine, cache=False), runs, n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark detect_misconfig (métadonnées errcode, moteurs)")
+    parser.add_argument("--assets", type=int, default=5000)
+    parser.add_argument("--stats", type=int, default=20, help="statistics par asset")
+    parser.add_argument("--runs", "-n", type=int, default=5)
+    parser.add_argument("--reseed", action="store_true")
+    args = parser.parse_args()
+    main(args.assets, args.stats, args.runs, args.reseed)